@@ -14,12 +14,39 @@ bcrypt = Bcrypt(app)
 
 # auth
 from app import models
+from app.hashing import hasher
+from app.presence import presence
+from app.storage import media
 from quart_auth import AuthManager
 auth_manager = AuthManager()
 auth_manager.user_class = models.User
 
 auth_manager.init_app(app)
 
+
+# database pool lifecycle: one pool per serving process
+@app.before_serving
+async def _open_db_pool():
+    await models._DataBase.init_pool()
+    await models.bus.start()
+
+
+@app.before_serving
+async def _precompile_templates():
+    if app.config.get('TEMPLATES_PRECOMPILE', True):
+        from app.rendering import precompile_templates
+        precompile_templates(app)
+
+
+@app.after_serving
+async def _close_db_pool():
+    await models.drain_writers()
+    await models.bus.close()
+    await models._DataBase.close_pool()
+    hasher.shutdown()
+    media.shutdown()
+    presence.close()
+
 ''' # bootstrap
 from flask_bootstrap import Bootstrap
 bootstrap = Bootstrap()
@@ -35,6 +62,19 @@ app.register_blueprint(auth_bp)
 from app.blog import bp as blog_bp
 app.register_blueprint(blog_bp)
 
+from app.chat import bp as chat_bp
+app.register_blueprint(chat_bp)
+
+from app.media import bp as media_bp
+app.register_blueprint(media_bp)
+
+from app.monitoring import bp as monitoring_bp
+app.register_blueprint(monitoring_bp)
+
+# request/query instrumentation (METRICS_ENABLED)
+from app import metrics
+metrics.init_app(app)
+
 
 '''
 cd PycharmProjects/quart_chat
@@ -5,6 +5,7 @@ from quart_auth import login_user, current_user, logout_user
 from werkzeug.urls import url_parse
 
 from app.models import User
+from app.ratelimit import limiter
 
 from .forms import LoginForm, RegistrationForm
 
@@ -13,14 +14,14 @@ from app.auth import bp
 
 
 @bp.route('/login', methods=['GET', 'POST'])
+@limiter.limit()
 async def login():
     if await current_user.is_authenticated:
         return redirect(url_for('blog.index'))
     form = await LoginForm.create_form()
     if await form.validate_on_submit():
-        print('form VALIDATE')
         user = await User.get_by_login(form.login.data)
-        if user is None or not user.check_password(form.password.data):
+        if user is None or not await user.check_password(form.password.data):
             await flash('Invalid login or password')
             return redirect(url_for('auth.login'))
         # логиним пользоватаеля в системе самого quart
@@ -40,13 +41,14 @@ async def logout():
 
 
 @bp.route('/register', methods=['GET', 'POST'])
+@limiter.limit()
 async def register():
     if await current_user.is_authenticated:
         return redirect(url_for('blog.index'))
     form = await RegistrationForm.create_form()
     if await form.validate_on_submit():
         user = User(login=form.login.data, name=form.name.data)
-        user.set_password(form.password.data)
+        await user.set_password(form.password.data)
         # add new user in database
         await User.add(user)
         await flash('you are registered!')
@@ -0,0 +1,85 @@
+import asyncio
+from typing import Any, AsyncContextManager, Awaitable, Callable
+
+from asyncpg import Connection
+
+
+class BatchWriter(object):
+    '''
+    write-behind стадия: копит строки до max_delay секунд или max_size штук
+    и пишет их одной транзакцией через flush_fn(con, rows) -> [result];
+    каждый submit() получает свой результат (id) или свою ошибку
+    '''
+
+    def __init__(self,
+                 transaction: Callable[[], AsyncContextManager[Connection]],
+                 flush_fn: Callable[[Connection, list], Awaitable[list]],
+                 max_size: int = 500,
+                 max_delay: float = 0.005):
+        self._transaction = transaction
+        self._flush_fn = flush_fn
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._pending: list[tuple[Any, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._in_flight: set[asyncio.Future] = set()
+
+    async def submit(self, row) -> Any:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((row, fut))
+        if len(self._pending) >= self.max_size:
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush_now)
+        return await fut
+
+    def _flush_now(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._flush(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def drain(self):
+        ''' сбрасывает накопленное и ждёт незавершённые записи (при остановке) '''
+        self._flush_now()
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+    async def _write(self, rows: list) -> list:
+        async with self._transaction() as con:
+            return await self._flush_fn(con, rows)
+
+    async def _flush(self, batch: list):
+        try:
+            results = await self._write([row for row, _ in batch])
+        except Exception as ex:
+            if len(batch) == 1:
+                _resolve(batch[0][1], exception=ex)
+                return
+            # одна плохая строка откатила всю пачку - пишем по одной,
+            # чтобы ошибку получил только её отправитель
+            for row, fut in batch:
+                try:
+                    result = (await self._write([row]))[0]
+                except Exception as row_ex:
+                    _resolve(fut, exception=row_ex)
+                else:
+                    _resolve(fut, result)
+            return
+        for (_, fut), result in zip(batch, results):
+            _resolve(fut, result)
+
+
+def _resolve(fut: asyncio.Future, result=None, exception: BaseException | None = None):
+    # вызывающего могли отменить, пока пачка писалась
+    if fut.done():
+        return
+    if exception is not None:
+        fut.set_exception(exception)
+    else:
+        fut.set_result(result)
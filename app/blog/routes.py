@@ -1,15 +1,88 @@
 
-from quart import render_template
-from quart_auth import current_user
+from quart import render_template, request, abort
+from quart_auth import current_user, login_required
 
+from app import app
 from app.blog import bp
-from app.models import Post
+from app.export import export_response, FORMATS
+from app.models import Post, User, Comment
+from app.rendering import render_post_cards, make_etag, not_modified, conditional_response
 
 
 @bp.route('/')
 @bp.route('/index')
+@login_required
 async def index():
-    posts = Post.get_followed_posts(current_user.id)
+    limit = app.config.get('POSTS_PER_PAGE', 20)
+    cursor = request.args.get('cursor')
+    try:
+        posts = await Post.get_followed_posts(int(current_user.auth_id), limit, cursor)
+    except ValueError:
+        abort(400)
     if posts is None:
         posts = []
-    return await render_template('index.html', title='Home', posts=posts)
+    next_cursor = posts[-1].cursor() if len(posts) == limit else None
+    # ключи карточек (post.comment_count приходит вместе с постом) - до остальных запросов
+    etag = make_etag(current_user.auth_id, cursor,
+                     [(post.id, post.last_edit_date, post.comment_count) for post in posts])
+    if not_modified(etag):
+        return await conditional_response('', etag, 304)
+    await Post.load_authors(posts)
+    # последние комментарии всех постов страницы - один запрос
+    await Post.load_comments(posts, with_authors=True)
+    body = await render_template('index.html', title='Home', cards=await render_post_cards(posts),
+                                 next_cursor=next_cursor)
+    return await conditional_response(body, etag)
+
+
+@bp.route('/search')
+@login_required
+async def search():
+    text = request.args.get('q', '').strip()
+    # отрицательный OFFSET postgres отвергает
+    page = max(0, request.args.get('page', 0, type=int))
+    limit = app.config.get('SEARCH_PER_PAGE', 20)
+    posts, users = [], []
+    if text:
+        posts = await Post.search_by_text(text, limit, page * limit) or []
+        users = await User.search_by_word(text, limit, page * limit) or []
+        await Post.load_comments(posts, with_authors=True)
+    has_next = len(posts) == limit or len(users) == limit
+    return await render_template('search.html', title='Search', q=text, page=page,
+                                 cards=await render_post_cards(posts), users=users, has_next=has_next)
+
+
+@bp.route('/post/<int:post_id>/comments')
+@login_required
+async def comments(post_id: int):
+    ''' "показать ещё": комментарии поста страницами (JSON), курсор ведёт к более старым '''
+    limit = app.config.get('COMMENTS_PER_PAGE', 20)
+    try:
+        page = await Comment.get_page_by_post_id(post_id, limit, request.args.get('cursor'),
+                                                 with_authors=True)
+    except ValueError:
+        abort(400)
+    next_cursor = page[-1].cursor() if len(page) == limit else None
+    items = []
+    for comment in page:
+        item = comment.to_dict()
+        item['author'] = comment.author.login if comment.author is not None else None
+        items.append(item)
+    return {'comments': items, 'next_cursor': next_cursor}
+
+
+@bp.route('/export/<what>')
+@login_required
+async def export(what: str):
+    ''' выгрузка своих постов или комментариев '''
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        abort(400)
+    user_id = int(current_user.auth_id)
+    if what == 'posts':
+        chunks = Post.iter_chunks_by_user_id(user_id)
+    elif what == 'comments':
+        chunks = Comment.iter_chunks_by_commentator_id(user_id)
+    else:
+        abort(404)
+    return export_response(chunks, fmt, f'{what}-{user_id}')
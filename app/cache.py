@@ -0,0 +1,204 @@
+import pickle
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from app import app
+
+# маркер промаха, т.к. None - допустимое значение
+_MISSING = object()
+
+
+class LRUCache(object):
+    '''
+    LRU в памяти процесса, у каждой записи свой TTL
+    '''
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=_MISSING):
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float | None = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class SharedCacheBackend(object):
+    '''
+    интерфейс общего (межпроцессного) уровня кэша, например redis/memcached
+    значения - bytes, сериализацию делает TieredCache
+    '''
+
+    async def get(self, key: str) -> bytes | None:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+
+class InMemorySharedBackend(SharedCacheBackend):
+    '''
+    локальная замена общего уровня для тестов и одиночного процесса
+    '''
+
+    def __init__(self):
+        self._data: dict[str, tuple[float, bytes]] = {}
+
+    async def get(self, key: str) -> bytes | None:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[0] < time.monotonic():
+            del self._data[key]
+            return None
+        return item[1]
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        self._data[key] = (time.monotonic() + ttl, value)
+
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+
+class TieredCache(object):
+    '''
+    read-through кэш: локальный LRU -> общий уровень (если есть) -> loader
+    None от loader не кэшируется
+    '''
+
+    def __init__(self, name: str, local: LRUCache,
+                 shared: SharedCacheBackend | None = None,
+                 shared_ttl: float = 300.0):
+        self.name = name
+        self.local = local
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+        self.shared_hits = 0
+        self.shared_misses = 0
+        _caches.append(self)
+
+    def _shared_key(self, key) -> str:
+        return f'{self.name}:{key}'
+
+    async def get_or_load(self, key, loader: Callable[[], Awaitable[Any]]):
+        value = self.local.get(key)
+        if value is not _MISSING:
+            return value
+        if self.shared is not None:
+            raw = await self.shared.get(self._shared_key(key))
+            if raw is not None:
+                self.shared_hits += 1
+                value = pickle.loads(raw)
+                self.local.set(key, value)
+                return value
+            self.shared_misses += 1
+        value = await loader()
+        if value is not None:
+            self.local.set(key, value)
+            if self.shared is not None:
+                await self.shared.set(self._shared_key(key), pickle.dumps(value), self.shared_ttl)
+        return value
+
+    async def invalidate(self, key):
+        self.local.delete(key)
+        if _event_bus is not None:
+            # локальные LRU остальных воркеров; ключ - число, строка или tuple из них
+            _event_bus.publish('cache', {'cache': self.name, 'key': key}, local=False)
+        if self.shared is not None:
+            await self.shared.delete(self._shared_key(key))
+
+    def stats(self) -> dict:
+        stats = self.local.stats()
+        stats['shared_hits'] = self.shared_hits
+        stats['shared_misses'] = self.shared_misses
+        return stats
+
+
+_caches: list[TieredCache] = []
+
+
+def cache_stats() -> dict:
+    ''' счётчики hit/miss/eviction по всем кэшам '''
+    return {c.name: c.stats() for c in _caches}
+
+
+def set_shared_backend(backend: SharedCacheBackend | None):
+    for c in _caches:
+        c.shared = backend
+
+
+_event_bus = None
+
+
+def _on_remote_invalidate(payload: dict):
+    key = payload['key']
+    # json превращает tuple в list
+    if isinstance(key, list):
+        key = tuple(key)
+    for c in _caches:
+        if c.name == payload['cache']:
+            c.local.delete(key)
+
+
+def set_event_bus(bus):
+    ''' invalidate рассылается остальным воркерам через bus (app.events) '''
+    global _event_bus
+    _event_bus = bus
+    bus.subscribe('cache', _on_remote_invalidate)
+
+
+_shared_backend: SharedCacheBackend | None = app.config.get('CACHE_SHARED_BACKEND')
+
+user_cache = TieredCache('user',
+                         LRUCache(app.config.get('USER_CACHE_SIZE', 10000),
+                                  app.config.get('USER_CACHE_TTL', 60.0)),
+                         _shared_backend)
+profile_cache = TieredCache('profile',
+                            LRUCache(app.config.get('PROFILE_CACHE_SIZE', 10000),
+                                     app.config.get('PROFILE_CACHE_TTL', 60.0)),
+                            _shared_backend)
+# html карточек постов, ключ (post.id, last_edit_date, comment_count) - правка поста или новый комментарий дают новый ключ
+post_card_cache = TieredCache('post_card',
+                              LRUCache(app.config.get('POST_CARD_CACHE_SIZE', 5000),
+                                       app.config.get('POST_CARD_CACHE_TTL', 3600.0)),
+                              _shared_backend)
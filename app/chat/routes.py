@@ -0,0 +1,145 @@
+
+import asyncio
+import json
+from datetime import datetime
+
+from quart import websocket, copy_current_websocket_context, request, abort
+from quart_auth import current_user, login_required
+
+from app import app
+from app.export import export_response, FORMATS
+from app.hub import hub, Subscription, SlowConsumer
+from app.models import Chat, Message, User, UserInChat
+from app.presence import presence
+from app.ratelimit import limiter, RateLimited
+
+# import chat blueprint
+from app.chat import bp
+
+
+async def _send_events(sub: Subscription):
+    while True:
+        event = await sub.get()
+        await websocket.send(json.dumps(event))
+
+
+async def _receive_messages(chat_id: int, user_id: int):
+    while True:
+        raw = await websocket.receive()
+        try:
+            data = json.loads(raw)
+            await _handle_frame(chat_id, user_id, data)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # кривой кадр не должен закрывать соединение
+            await websocket.send(json.dumps({'type': 'error', 'error': 'bad_request'}))
+
+
+async def _handle_frame(chat_id: int, user_id: int, data: dict):
+    # любое сообщение клиента продлевает online
+    await presence.heartbeat(user_id)
+    kind = data.get('type')
+    if kind == 'ping':
+        return
+    if kind == 'typing':
+        await presence.typing(chat_id, user_id)
+        return
+    if kind == 'read':
+        await UserInChat.mark_read(user_id, chat_id, int(data['message_id']))
+        return
+    text = data.get('text', '')
+    if not text or not isinstance(text, str):
+        return
+    parent_id = data.get('parent_id')
+    if parent_id is not None:
+        parent_id = int(parent_id)
+    try:
+        await limiter.hit('chat.send', user=user_id)
+    except RateLimited as ex:
+        # сообщение отбрасывается до записи в БД, клиент узнаёт когда повторить
+        await websocket.send(json.dumps({'type': 'error', 'error': 'rate_limited',
+                                         'retry_after': ex.retry_after}))
+        return
+    await presence.stop_typing(chat_id, user_id)
+    message = Message(chat_id=chat_id,
+                      user_id=user_id,
+                      parent_id=parent_id,
+                      mes_text=text,
+                      sends_time=datetime.now())
+    # сообщение вернётся отправителю через hub вместе с остальными участниками
+    await Message.add(message)
+
+
+@bp.route('/<int:chat_id>/messages')
+@login_required
+async def history(chat_id: int):
+    ''' страница истории чата (JSON), курсор ведёт к более старым сообщениям '''
+    if not await UserInChat.is_member(int(current_user.auth_id), chat_id):
+        abort(403)
+    limit = app.config.get('MESSAGES_PER_PAGE', 50)
+    try:
+        messages = await Message.get_all_by_chat_id(chat_id, limit, request.args.get('cursor'))
+    except ValueError:
+        abort(400)
+    if messages is None:
+        messages = []
+    next_cursor = messages[0].cursor() if len(messages) == limit else None
+    return {'messages': [message.to_dict() for message in messages], 'next_cursor': next_cursor}
+
+
+@bp.route('/direct/<int:user_id>', methods=['POST'])
+@login_required
+async def direct(user_id: int):
+    ''' личный чат с user_id: существующий или новый '''
+    if await User.get_by_id(user_id) is None:
+        abort(404)
+    chat, created = await Chat.get_or_create_direct(int(current_user.auth_id), user_id)
+    return {'chat_id': chat.id, 'created': created}
+
+
+@bp.route('/presence')
+@login_required
+async def online():
+    ''' ?ids=1,2,3 -> кто из них online (без обращения к бд) '''
+    try:
+        user_ids = [int(user_id) for user_id in request.args.get('ids', '').split(',') if user_id]
+    except ValueError:
+        abort(400)
+    return {'online': sorted(await presence.online(user_ids[:500]))}
+
+
+@bp.route('/<int:chat_id>/export')
+@login_required
+async def export(chat_id: int):
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        abort(400)
+    if not await UserInChat.is_member(int(current_user.auth_id), chat_id):
+        abort(403)
+    return export_response(Message.iter_chunks_by_chat_id(chat_id), fmt, f'chat-{chat_id}')
+
+
+@bp.websocket('/<int:chat_id>/ws')
+@login_required
+async def chat_ws(chat_id: int):
+    user_id = int(current_user.auth_id)
+    if not await UserInChat.is_member(user_id, chat_id):
+        await websocket.close(1008)
+        return
+    await websocket.accept()
+    sub = hub.subscribe(chat_id, user_id)
+    await presence.join(chat_id, user_id)
+    sender = asyncio.ensure_future(copy_current_websocket_context(_send_events)(sub))
+    receiver = asyncio.ensure_future(copy_current_websocket_context(_receive_messages)(chat_id, user_id))
+    try:
+        done, pending = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if isinstance(task.exception(), SlowConsumer):
+                # 1013 - try again later
+                await websocket.close(1013)
+    finally:
+        sender.cancel()
+        receiver.cancel()
+        hub.unsubscribe(sub)
+        await presence.leave(chat_id, user_id)
@@ -3,9 +3,33 @@ from quart import redirect, url_for
 from quart_auth import Unauthorized
 
 from app.errors import bp
+from app.hashing import HasherBusy
+from app.ratelimit import RateLimited
+from app.storage import MediaBusy, MediaRejected
 
 
 @bp.errorhandler(Unauthorized)
 async def redirect_to_login(*_: Exception):
     return redirect(url_for('auth.login'))
 
+
+@bp.app_errorhandler(HasherBusy)
+async def hasher_busy(*_: Exception):
+    return 'Too many sign-in attempts in progress, try again shortly', 503, {'Retry-After': '1'}
+
+
+@bp.app_errorhandler(RateLimited)
+async def rate_limited(error: RateLimited):
+    return 'Too many requests, try again later', 429, {'Retry-After': error.retry_after_header}
+
+
+@bp.app_errorhandler(MediaBusy)
+async def media_busy(*_: Exception):
+    return 'Too many images in processing, try again shortly', 503, {'Retry-After': '1'}
+
+
+@bp.app_errorhandler(MediaRejected)
+async def media_rejected(error: MediaRejected):
+    if error.reason == 'too_large':
+        return 'Image is too large', 413
+    return 'Unsupported image format', 415
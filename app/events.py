@@ -0,0 +1,231 @@
+import asyncio
+import inspect
+import itertools
+import json
+import uuid
+from datetime import datetime
+from typing import Any, Callable
+
+import asyncpg
+
+from app import app
+from app.statements import statements
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+class EventBus(object):
+    '''
+    события между процессами (воркерами): канал -> обработчики payload (dict);
+    publish не ждёт доставки, порядок событий одного процесса сохраняется
+    '''
+
+    def __init__(self):
+        self._handlers: dict[str, list[Callable[[dict], Any]]] = {}
+
+    def subscribe(self, channel: str, handler: Callable[[dict], Any]):
+        ''' handler(payload) - обычная функция или корутина '''
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def publish(self, channel: str, payload: dict, local: bool = True):
+        '''
+        local=False - только другим процессам, когда этот уже применил изменение сам
+        '''
+        if local:
+            for handler in self._handlers.get(channel, ()):
+                result = handler(payload)
+                if inspect.isawaitable(result):
+                    asyncio.ensure_future(result)
+        self._send_remote(channel, payload)
+
+    async def _dispatch(self, channel: str, payload: dict):
+        for handler in self._handlers.get(channel, ()):
+            try:
+                result = handler(payload)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                app.logger.exception(f'event handler failed on {channel!r}')
+
+    def _send_remote(self, channel: str, payload: dict):
+        raise NotImplementedError
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+class InMemoryEventBus(EventBus):
+    ''' один процесс: других получателей нет '''
+
+    def _send_remote(self, channel: str, payload: dict):
+        pass
+
+
+class PostgresEventBus(EventBus):
+    '''
+    LISTEN/NOTIFY: отправка пачками через пул (_DataBase), приём - отдельным
+    соединением с переподключением. payload больше max_payload байт (лимит
+    NOTIFY - 8000) кладётся в event_payload, в NOTIFY уходит только его id
+
+    событие, пришедшее во время переподключения, теряется - кэши ограничены TTL
+    '''
+
+    _q_notify_many = statements.register('events.notify_many', '''
+        SELECT pg_notify($1, t.payload)
+        FROM unnest($2::text[]) WITH ORDINALITY AS t(payload, n)
+        ORDER BY t.n ''')
+
+    _q_notify_ref = statements.register('events.notify_ref', '''
+        WITH stored AS (
+            INSERT INTO event_payload (payload) VALUES ($2)
+            RETURNING id
+        )
+        SELECT pg_notify($1, json_build_object('o', $3::text, 'ref', stored.id)::text)
+        FROM stored ''')
+
+    _q_load_ref = statements.register('events.load_ref', '''
+        SELECT payload FROM event_payload WHERE id = $1 ''')
+
+    _q_cleanup = statements.register('events.cleanup', '''
+        DELETE FROM event_payload WHERE created_at < now() - $1::interval ''')
+
+    def __init__(self, db, dsn: str, channel: str = 'app_events',
+                 max_payload: int = 7000, batch_size: int = 100,
+                 payload_retention: float = 600.0):
+        super().__init__()
+        self._db = db
+        self._dsn = dsn
+        self.channel = channel
+        self.max_payload = max_payload
+        self.batch_size = batch_size
+        self.payload_retention = payload_retention
+        # свои уведомления приходят и этому процессу - их отбрасываем по origin
+        self.origin = uuid.uuid4().hex
+        self._seq = itertools.count()
+        self._outbox: asyncio.Queue = asyncio.Queue()
+        self._inbox: asyncio.Queue = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+        self.sent = 0
+        self.received = 0
+        self.send_errors = 0
+
+    async def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._send_loop()),
+                           asyncio.ensure_future(self._listen_loop()),
+                           asyncio.ensure_future(self._receive_loop())]
+
+    async def close(self):
+        await self._flush_outbox()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _send_remote(self, channel: str, payload: dict):
+        # seq: одинаковые NOTIFY в одной транзакции postgres склеивает
+        envelope = {'o': self.origin, 's': next(self._seq), 'c': channel, 'p': payload}
+        self._outbox.put_nowait(json.dumps(envelope, default=_encode))
+
+    async def _send(self, messages: list[str]):
+        ''' подряд идущие маленькие - одним запросом, большие - по ссылке, порядок сохраняется '''
+        small = []
+        for message in messages:
+            if len(message.encode('utf-8')) <= self.max_payload:
+                small.append(message)
+                continue
+            if small:
+                await self._db.execute_query(self._q_notify_many, self.channel, small, fetch=True)
+                small = []
+            await self._db.execute_query(self._q_notify_ref, self.channel, message, self.origin, fetch=True)
+        if small:
+            await self._db.execute_query(self._q_notify_many, self.channel, small, fetch=True)
+        self.sent += len(messages)
+
+    async def _send_loop(self):
+        while True:
+            batch = [await self._outbox.get()]
+            while len(batch) < self.batch_size and not self._outbox.empty():
+                batch.append(self._outbox.get_nowait())
+            try:
+                await self._send(batch)
+            except Exception:
+                self.send_errors += len(batch)
+                app.logger.exception('event bus: failed to send %d events', len(batch))
+
+    async def _flush_outbox(self):
+        batch = []
+        while not self._outbox.empty():
+            batch.append(self._outbox.get_nowait())
+        if batch:
+            try:
+                await self._send(batch)
+            except Exception:
+                app.logger.exception('event bus: failed to flush %d events', len(batch))
+
+    def _on_notify(self, con, pid, channel, payload: str):
+        self._inbox.put_nowait(payload)
+
+    async def _listen_loop(self):
+        delay = 1.0
+        cleanup_at = 0.0
+        loop = asyncio.get_running_loop()
+        while True:
+            con = None
+            try:
+                con = await asyncpg.connect(self._dsn)
+                lost = asyncio.Event()
+                con.add_termination_listener(lambda _: lost.set())
+                await con.add_listener(self.channel, self._on_notify)
+                delay = 1.0
+                while not lost.is_set():
+                    # заодно чистим старые payload-ы по ссылке
+                    if loop.time() >= cleanup_at:
+                        cleanup_at = loop.time() + self.payload_retention / 2
+                        await self._db.execute_query(self._q_cleanup, f'{self.payload_retention} seconds',
+                                                     execute=True)
+                    try:
+                        await asyncio.wait_for(lost.wait(), self.payload_retention / 2)
+                    except asyncio.TimeoutError:
+                        pass
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                app.logger.exception('event bus: listener connection failed')
+            finally:
+                if con is not None and not con.is_closed():
+                    await con.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+    async def _receive_loop(self):
+        while True:
+            raw = await self._inbox.get()
+            try:
+                envelope = json.loads(raw)
+                if envelope.get('o') == self.origin:
+                    continue
+                if 'ref' in envelope:
+                    stored = await self._db.execute_query(self._q_load_ref, envelope['ref'],
+                                                          fetchval=True, readonly=False)
+                    if stored is None:
+                        continue
+                    envelope = json.loads(stored)
+                self.received += 1
+                await self._dispatch(envelope['c'], envelope['p'])
+            except Exception:
+                app.logger.exception('event bus: bad event')
+
+    def stats(self) -> dict:
+        return {'sent': self.sent,
+                'received': self.received,
+                'send_errors': self.send_errors,
+                'outbox': self._outbox.qsize()}
@@ -0,0 +1,52 @@
+import csv
+import io
+import json
+from typing import AsyncIterator
+
+from quart import Response
+
+from app import app
+
+# тип экспорта -> (mimetype, расширение файла)
+FORMATS = {'ndjson': ('application/x-ndjson', 'ndjson'),
+           'csv': ('text/csv', 'csv')}
+
+
+def _json_default(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+async def ndjson_body(chunks: AsyncIterator[list]) -> AsyncIterator[bytes]:
+    ''' одна пачка записей -> один кусок тела ответа '''
+    async for chunk in chunks:
+        yield ''.join(json.dumps(dict(record), default=_json_default, ensure_ascii=False) + '\n'
+                      for record in chunk).encode('utf-8')
+
+
+async def csv_body(chunks: AsyncIterator[list]) -> AsyncIterator[bytes]:
+    header_sent = False
+    async for chunk in chunks:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if not header_sent:
+            writer.writerow(chunk[0].keys())
+            header_sent = True
+        writer.writerows(tuple(record.values()) for record in chunk)
+        yield buffer.getvalue().encode('utf-8')
+
+
+def export_response(chunks: AsyncIterator[list], fmt: str, filename: str) -> Response:
+    '''
+    потоковый ответ: следующая пачка читается (отдельным keyset-запросом) только
+    после того, как сервер отправил предыдущую - память не растёт с размером
+    выгрузки, а медленный клиент не держит соединение с БД
+    '''
+    mimetype, extension = FORMATS[fmt]
+    body = ndjson_body(chunks) if fmt == 'ndjson' else csv_body(chunks)
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}.{extension}"'
+    # выгрузка большого чата может идти дольше RESPONSE_TIMEOUT, но не бесконечно
+    response.timeout = app.config.get('EXPORT_TIMEOUT', 3600.0)
+    return response
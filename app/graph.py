@@ -0,0 +1,174 @@
+import bisect
+from array import array
+
+from app.cache import LRUCache, _MISSING
+from app.statements import statements
+
+
+class SocialGraph(object):
+    '''
+    чтение графа подписок по id пользователей (объекты User собирает модель);
+    db - models._DataBase
+
+    счётчики подписчиков/подписок берутся из follow_stats (ведутся при записи
+    в Follows), множества подписчиков популярных аккаунтов (>= hot_threshold)
+    держатся в памяти отсортированным array и обновляются при follow/unfollow
+    '''
+
+    _q_is_following_many = statements.register('graph.is_following_many', '''
+        SELECT followed_id FROM follows
+        WHERE follower_id = $1 AND followed_id = ANY($2::int[]) ''')
+
+    _q_counts = statements.register('graph.counts', '''
+        SELECT user_id, followers, followings FROM follow_stats
+        WHERE user_id = ANY($1::int[]) ''')
+
+    _q_follower_ids = statements.register('graph.follower_ids', '''
+        SELECT follower_id FROM follows
+        WHERE followed_id = $1 AND follower_id > $2
+        ORDER BY follower_id
+        LIMIT $3 ''')
+
+    _q_following_ids = statements.register('graph.following_ids', '''
+        SELECT followed_id FROM follows
+        WHERE follower_id = $1 AND followed_id > $2
+        ORDER BY followed_id
+        LIMIT $3 ''')
+
+    _q_mutual_ids = statements.register('graph.mutual_ids', '''
+        SELECT f.followed_id FROM follows f
+        JOIN follows back ON back.follower_id = f.followed_id AND back.followed_id = f.follower_id
+        WHERE f.follower_id = $1 AND f.followed_id > $2
+        ORDER BY f.followed_id
+        LIMIT $3 ''')
+
+    # друзья друзей: кого читают те, кого читает user_id, по числу общих связей
+    _q_suggestions = statements.register('graph.suggestions', '''
+        SELECT f2.followed_id, count(*) AS common
+        FROM follows f1
+        JOIN follows f2 ON f2.follower_id = f1.followed_id
+        WHERE f1.follower_id = $1
+        AND f2.followed_id <> $1
+        AND NOT EXISTS (SELECT 1 FROM follows x
+                        WHERE x.follower_id = $1 AND x.followed_id = f2.followed_id)
+        GROUP BY f2.followed_id
+        ORDER BY common DESC, f2.followed_id
+        LIMIT $2 ''')
+
+    _q_all_follower_ids = statements.register('graph.all_follower_ids', '''
+        SELECT coalesce(array_agg(follower_id ORDER BY follower_id), '{}')
+        FROM follows WHERE followed_id = $1 ''')
+
+    def __init__(self, db, hot_threshold: int = 10000, hot_cache_size: int = 100,
+                 hot_cache_ttl: float = 600.0):
+        self._db = db
+        self.hot_threshold = hot_threshold
+        # followed_id -> array('i') id подписчиков по возрастанию
+        self._hot = LRUCache(hot_cache_size, hot_cache_ttl)
+        self._bus = None
+
+    def attach_bus(self, bus):
+        ''' follow/unfollow других воркеров обновляют и здешние hot-множества '''
+        self._bus = bus
+        bus.subscribe('graph', self._on_remote)
+
+    def _on_remote(self, payload: dict):
+        if payload['op'] == 'follow':
+            self._add(payload['follower_id'], payload['followed_id'])
+        else:
+            self._remove(payload['follower_id'], payload['followed_id'])
+
+    def _publish(self, op: str, follower_id: int, followed_id: int):
+        if self._bus is not None:
+            self._bus.publish('graph', {'op': op, 'follower_id': follower_id, 'followed_id': followed_id},
+                              local=False)
+
+    def stats(self) -> dict:
+        return self._hot.stats()
+
+    async def is_following_many(self, follower_id: int, user_ids: list[int]) -> dict[int, bool]:
+        ''' подписан ли follower_id на каждого из user_ids, одним запросом '''
+        result = {}
+        unknown = []
+        for user_id in user_ids:
+            followers = self._hot.get(user_id)
+            if followers is _MISSING:
+                unknown.append(user_id)
+            else:
+                result[user_id] = self._contains(followers, follower_id)
+        if unknown:
+            res = await self._db.execute_query(self._q_is_following_many, follower_id, unknown,
+                                               fetch=True, readonly=True)
+            found = {row[0] for row in res}
+            for user_id in unknown:
+                result[user_id] = user_id in found
+        return result
+
+    async def is_following(self, follower_id: int, followed_id: int) -> bool:
+        return (await self.is_following_many(follower_id, [followed_id]))[followed_id]
+
+    async def counts(self, user_ids: list[int]) -> dict[int, tuple[int, int]]:
+        ''' {user_id: (подписчиков, подписок)} без подсчёта строк follows '''
+        res = await self._db.execute_query(self._q_counts, user_ids, fetch=True, readonly=True)
+        counts = {user_id: (0, 0) for user_id in user_ids}
+        for row in res:
+            counts[row[0]] = (row[1], row[2])
+            if row[1] >= self.hot_threshold and self._hot.get(row[0]) is _MISSING:
+                await self._load_hot(row[0])
+        return counts
+
+    async def follower_count(self, user_id: int) -> int:
+        return (await self.counts([user_id]))[user_id][0]
+
+    async def follower_ids(self, user_id: int, limit: int = 50, after: int = 0) -> list[int]:
+        ''' страница подписчиков, курсор - последний id предыдущей страницы '''
+        res = await self._db.execute_query(self._q_follower_ids, user_id, after, limit,
+                                           fetch=True, readonly=True)
+        return [row[0] for row in res]
+
+    async def following_ids(self, user_id: int, limit: int = 50, after: int = 0) -> list[int]:
+        res = await self._db.execute_query(self._q_following_ids, user_id, after, limit,
+                                           fetch=True, readonly=True)
+        return [row[0] for row in res]
+
+    async def mutual_ids(self, user_id: int, limit: int = 50, after: int = 0) -> list[int]:
+        ''' взаимные подписки: user_id читает их, они читают user_id '''
+        res = await self._db.execute_query(self._q_mutual_ids, user_id, after, limit,
+                                           fetch=True, readonly=True)
+        return [row[0] for row in res]
+
+    async def suggestion_ids(self, user_id: int, limit: int = 20) -> list[tuple[int, int]]:
+        ''' [(user_id, число общих связей)] - на кого подписаться '''
+        res = await self._db.execute_query(self._q_suggestions, user_id, limit,
+                                           fetch=True, readonly=True)
+        return [(row[0], row[1]) for row in res]
+
+    async def _load_hot(self, user_id: int):
+        ids = await self._db.execute_query(self._q_all_follower_ids, user_id,
+                                           fetchval=True, readonly=True)
+        self._hot.set(user_id, array('i', ids))
+
+    @staticmethod
+    def _contains(followers: array, user_id: int) -> bool:
+        i = bisect.bisect_left(followers, user_id)
+        return i < len(followers) and followers[i] == user_id
+
+    def on_follow(self, follower_id: int, followed_id: int):
+        self._add(follower_id, followed_id)
+        self._publish('follow', follower_id, followed_id)
+
+    def on_unfollow(self, follower_id: int, followed_id: int):
+        self._remove(follower_id, followed_id)
+        self._publish('unfollow', follower_id, followed_id)
+
+    def _add(self, follower_id: int, followed_id: int):
+        followers = self._hot.get(followed_id)
+        if followers is not _MISSING and not self._contains(followers, follower_id):
+            followers.insert(bisect.bisect_left(followers, follower_id), follower_id)
+
+    def _remove(self, follower_id: int, followed_id: int):
+        followers = self._hot.get(followed_id)
+        if followers is not _MISSING:
+            i = bisect.bisect_left(followers, follower_id)
+            if i < len(followers) and followers[i] == follower_id:
+                del followers[i]
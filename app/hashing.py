@@ -0,0 +1,67 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app
+from app import metrics
+from app import bcrypt as bc
+
+
+class HasherBusy(Exception):
+    ''' очередь хэширования переполнена - запрос отклоняется сразу '''
+    pass
+
+
+class PasswordHasher(object):
+    '''
+    bcrypt вне event loop: ограниченный пул потоков (bcrypt отпускает GIL)
+    и admission control - не больше max_pending операций в работе и в очереди
+    '''
+
+    def __init__(self, workers: int = 2, max_pending: int = 64, rounds: int = 12):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rounds = rounds
+        self._executor: ThreadPoolExecutor | None = None
+        self._pending = 0
+        self.rejected = 0
+
+    async def _submit(self, fn, *args):
+        if self._pending >= self.max_pending:
+            self.rejected += 1
+            raise HasherBusy()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='bcrypt')
+        self._pending += 1
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+            if metrics.enabled:
+                metrics.observe_bcrypt(fn.__name__, time.perf_counter() - start)
+
+    async def hash(self, password: str) -> str:
+        res = await self._submit(bc.generate_password_hash, password, self.rounds)
+        return res.decode('utf-8')
+
+    async def verify(self, password_hash: str, password: str) -> bool:
+        return await self._submit(bc.check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        ''' хэш посчитан с другой стоимостью, чем BCRYPT_LOG_ROUNDS '''
+        # $2b$12$<salt+hash>
+        try:
+            return int(password_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+hasher = PasswordHasher(app.config.get('BCRYPT_WORKERS', 2),
+                        app.config.get('BCRYPT_MAX_PENDING', 64),
+                        app.config.get('BCRYPT_LOG_ROUNDS', 12))
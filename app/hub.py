@@ -0,0 +1,111 @@
+import asyncio
+
+from app import app
+
+
+class SlowConsumer(Exception):
+    ''' подписчик не успевает забирать события и был отключён '''
+    pass
+
+
+class Subscription(object):
+    '''
+    подписка одного websocket-клиента на события чата
+    '''
+
+    def __init__(self, chat_id: int, user_id: int, maxsize: int):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        # очередь ограничена: зависший клиент не раздувает память
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+        self.closed = False
+
+    def offer(self, event: dict, policy: str) -> bool:
+        ''' кладёт без ожидания; при полной очереди - политика для медленных подписчиков '''
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            pass
+        if policy == 'drop_oldest':
+            self.queue.get_nowait()
+            self.queue.put_nowait(event)
+            self.dropped += 1
+            return True
+        # 'disconnect': отправитель заметит это на следующем get() и закроет сокет
+        self.closed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        return False
+
+    async def get(self) -> dict:
+        if self.closed:
+            raise SlowConsumer()
+        event = await self.queue.get()
+        if self.closed:
+            raise SlowConsumer()
+        return event
+
+
+class ChatHub(object):
+    '''
+    рассылка внутри процесса: chat_id -> подписки
+    publish ничего не ждёт, так что медленный клиент не задерживает остальных
+
+    с шиной событий (attach_bus) publish доходит и до подписчиков других воркеров
+    '''
+
+    def __init__(self, queue_size: int = 100, policy: str = 'drop_oldest'):
+        if policy not in ('drop_oldest', 'disconnect'):
+            raise ValueError(f'unknown slow consumer policy: {policy}')
+        self.queue_size = queue_size
+        self.policy = policy
+        self._subscribers: dict[int, set[Subscription]] = {}
+        self._bus = None
+
+    def attach_bus(self, bus):
+        self._bus = bus
+        bus.subscribe('chat', self._on_remote)
+
+    def _on_remote(self, payload: dict):
+        self.deliver(payload['chat_id'], payload['event'])
+
+    def subscribe(self, chat_id: int, user_id: int) -> Subscription:
+        sub = Subscription(chat_id, user_id, self.queue_size)
+        self._subscribers.setdefault(chat_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        subs = self._subscribers.get(sub.chat_id)
+        if subs is None:
+            return
+        subs.discard(sub)
+        if not subs:
+            del self._subscribers[sub.chat_id]
+
+    def publish(self, chat_id: int, event: dict) -> int:
+        ''' возвращает количество подписчиков этого процесса, получивших событие '''
+        if self._bus is not None:
+            self._bus.publish('chat', {'chat_id': chat_id, 'event': event}, local=False)
+        return self.deliver(chat_id, event)
+
+    def deliver(self, chat_id: int, event: dict) -> int:
+        ''' только локальные подписчики '''
+        subs = self._subscribers.get(chat_id)
+        if not subs:
+            return 0
+        delivered = 0
+        for sub in tuple(subs):
+            if sub.offer(event, self.policy):
+                delivered += 1
+        return delivered
+
+    def subscribers_count(self, chat_id: int) -> int:
+        return len(self._subscribers.get(chat_id, ()))
+
+
+hub = ChatHub(app.config.get('HUB_QUEUE_SIZE', 100),
+              app.config.get('HUB_SLOW_CONSUMER_POLICY', 'drop_oldest'))
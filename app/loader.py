@@ -0,0 +1,69 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable, Iterable
+
+from quart import g, has_app_context
+
+
+class DataLoader(object):
+    '''
+    собирает все load(key) одного тика event loop и разрешает их
+    одним вызовом batch_fn(keys) -> {key: value}; повторные ключи дедуплицируются
+    '''
+
+    def __init__(self, batch_fn: Callable[[list], Awaitable[dict]]):
+        self._batch_fn = batch_fn
+        self._futures: dict[Hashable, asyncio.Future] = {}
+        self._queue: list = []
+        # loop держит задачи слабыми ссылками: без ссылки здесь _dispatch
+        # может быть собран сборщиком мусора, и load() не дождутся ответа
+        self._tasks: set[asyncio.Task] = set()
+
+    def load(self, key: Hashable) -> asyncio.Future:
+        fut = self._futures.get(key)
+        if fut is not None:
+            return fut
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._futures[key] = fut
+        self._queue.append(key)
+        if len(self._queue) == 1:
+            # запуск после того, как все задачи этого тика добавят свои ключи
+            loop.call_soon(self._schedule_dispatch)
+        return fut
+
+    def _schedule_dispatch(self):
+        task = asyncio.get_running_loop().create_task(self._dispatch())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def load_many(self, keys: Iterable[Hashable]) -> list:
+        return await asyncio.gather(*[self.load(key) for key in keys])
+
+    def clear(self, key: Hashable):
+        self._futures.pop(key, None)
+
+    async def _dispatch(self):
+        keys, self._queue = self._queue, []
+        try:
+            values = await self._batch_fn(keys)
+        except BaseException as ex:
+            for key in keys:
+                fut = self._futures.pop(key)
+                if not fut.done():
+                    fut.set_exception(ex)
+            return
+        for key in keys:
+            fut = self._futures[key]
+            if not fut.done():
+                fut.set_result(values.get(key))
+
+
+def request_loader(name: str, batch_fn: Callable[[list], Awaitable[dict]]) -> DataLoader:
+    ''' загрузчик, живущий в рамках текущего запроса (quart.g) '''
+    if not has_app_context():
+        return DataLoader(batch_fn)
+    loaders: dict[str, Any] = g.setdefault('_data_loaders', {})
+    loader = loaders.get(name)
+    if loader is None:
+        loader = loaders[name] = DataLoader(batch_fn)
+    return loader
@@ -0,0 +1,6 @@
+
+from quart import Blueprint
+
+bp = Blueprint('media', __name__, url_prefix='/media')
+
+from app.media import routes
@@ -0,0 +1,85 @@
+
+import os
+
+from quart import request, abort, send_file
+from quart_auth import current_user, login_required
+
+from app import app
+from app.models import Chat, Profile, UserInChat
+from app.ratelimit import limiter
+from app.storage import media, media_url, parse_key, MediaRejected
+
+# import media blueprint
+from app.media import bp
+
+
+async def _upload() -> str:
+    ''' тело запроса (сама картинка, не multipart) потоком в хранилище -> ключ '''
+    await limiter.hit('media.upload', user=current_user.auth_id)
+    if request.content_length is not None and request.content_length > media.max_size:
+        raise MediaRejected('too_large')
+    return await media.save(request.body)
+
+
+def _urls(key: str) -> dict:
+    urls = {name: media_url(key, name) for name in media.variants}
+    urls['original'] = media_url(key)
+    return urls
+
+
+async def _send(key: str, variant: str | None):
+    found = await media.resolve(key, variant)
+    if found is None:
+        abort(404)
+    path, mimetype = found
+    name = os.path.basename(path)
+    response = await send_file(path, mimetype, add_etags=False,
+                               cache_timeout=app.config.get('MEDIA_MAX_AGE', 365 * 24 * 3600))
+    # файл по ключу не меняется: ETag из хэша, кэш без перепроверки
+    response.set_etag(f'{parse_key(key)[0]}-{name}')
+    if variant is None or name.startswith(f'{variant}.'):
+        response.cache_control.immutable = True
+    else:
+        # вместо варианта отдан оригинал (нет Pillow) - позже url может дать другой файл
+        response.cache_control.max_age = 3600
+    await response.make_conditional(request, accept_ranges=True, complete_length=response.content_length)
+    return response
+
+
+@bp.route('/<key>')
+async def get(key: str):
+    return await _send(key, None)
+
+
+@bp.route('/<key>/<variant>')
+async def get_variant(key: str, variant: str):
+    return await _send(key, variant)
+
+
+@bp.route('/upload', methods=['POST'])
+@login_required
+async def upload():
+    ''' загрузка без привязки (например картинка нового поста, ключ передаётся в Post.image) '''
+    key = await _upload()
+    return {'key': key, 'urls': _urls(key)}, 201
+
+
+@bp.route('/avatar', methods=['POST'])
+@login_required
+async def avatar():
+    user_id = int(current_user.auth_id)
+    key = await _upload()
+    profile = await Profile.get_by_id(user_id) or Profile(user_id)
+    profile.profile_img = key
+    await Profile.update(profile)
+    return {'key': key, 'urls': _urls(key)}, 201
+
+
+@bp.route('/chat/<int:chat_id>', methods=['POST'])
+@login_required
+async def chat_image(chat_id: int):
+    if not await UserInChat.is_member(int(current_user.auth_id), chat_id):
+        abort(403)
+    key = await _upload()
+    await Chat.update_image(chat_id, key)
+    return {'key': key, 'urls': _urls(key)}, 201
@@ -0,0 +1,237 @@
+import asyncio
+import contextvars
+import random
+import re
+import time
+import traceback
+
+from quart import Quart, request
+from quart.signals import before_render_template, template_rendered
+
+from app import app
+
+# выключено - все хуки сводятся к проверке одного флага
+enabled: bool = app.config.get('METRICS_ENABLED', False)
+slow_query_ms: float | None = app.config.get('SLOW_QUERY_MS')
+slow_request_ms: float | None = app.config.get('SLOW_REQUEST_MS')
+stack_sample_rate: float = app.config.get('SLOW_LOG_STACK_SAMPLE_RATE', 0.1)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+_whitespace = re.compile(r'\s+')
+
+
+def normalize_sql(query: str) -> str:
+    ''' параметры уже вынесены в $n, достаточно схлопнуть пробелы '''
+    return _whitespace.sub(' ', query).strip()[:200]
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Histogram(object):
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [bucket counts..., sum, count]
+        self._series: dict[tuple, list] = {}
+        _registry.append(self)
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label_values, series in self._series.items():
+            for bound, count in zip(self.buckets, series):
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labels, label_values, le)} {count}')
+            le = 'le="+Inf"'
+            lines.append(f'{self.name}_bucket{_labels(self.labels, label_values, le)} {series[-1]}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, label_values)} {series[-2]}')
+            lines.append(f'{self.name}_count{_labels(self.labels, label_values)} {series[-1]}')
+        return lines
+
+
+_registry: list[Histogram] = []
+
+request_seconds = Histogram('http_request_seconds', 'Request latency', ('endpoint',))
+request_queries = Histogram('http_request_queries', 'Database queries per request', ('endpoint',), COUNT_BUCKETS)
+query_seconds = Histogram('db_query_seconds', 'Query latency by normalized SQL', ('query',))
+acquire_seconds = Histogram('db_pool_acquire_seconds', 'Wait for a pool connection')
+bcrypt_seconds = Histogram('bcrypt_seconds', 'bcrypt hash/verify time', ('op',))
+render_seconds = Histogram('template_render_seconds', 'Template render time', ('template',))
+
+
+class RequestStats(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.acquire_wait = 0.0
+        self.bcrypt_time = 0.0
+        self.render_time = 0.0
+        self.render_start = 0.0
+        self.stack: str | None = None
+        self.watchdog: asyncio.TimerHandle | None = None
+
+
+_current: contextvars.ContextVar[RequestStats | None] = contextvars.ContextVar('request_stats', default=None)
+
+
+class Exposition(object):
+    '''
+    сэмплы для /metrics, сгруппированные по имени метрики: HELP/TYPE выводятся
+    один раз, за ними все сэмплы семейства (иначе prometheus не примет ответ)
+    '''
+
+    def __init__(self):
+        # name -> (help, type, [строки сэмплов])
+        self._families: dict[str, tuple[str, str, list[str]]] = {}
+
+    def _add(self, kind: str, name: str, help: str, value, labels: dict | None):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = (help, kind, [])
+        elif family[1] != kind:
+            raise ValueError(f'metric {name} registered as {family[1]}, not {kind}')
+        label_str = _labels(tuple(labels), tuple(labels.values())) if labels else ''
+        family[2].append(f'{name}{label_str} {value}')
+
+    def gauge(self, name: str, help: str, value, labels: dict | None = None):
+        self._add('gauge', name, help, value, labels)
+
+    def counter(self, name: str, help: str, value, labels: dict | None = None):
+        ''' монотонно растущее значение (с момента старта процесса) '''
+        self._add('counter', name, help, value, labels)
+
+    def render(self) -> str:
+        lines = []
+        for name, (help, kind, samples) in self._families.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+def render() -> str:
+    lines = []
+    for histogram in _registry:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
+
+
+def observe_query(query: str, seconds: float):
+    sql = normalize_sql(query)
+    query_seconds.observe(seconds, sql)
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += seconds
+    if slow_query_ms is not None and seconds * 1000 >= slow_query_ms:
+        message = f'slow query {seconds * 1000:.1f}ms: {sql}'
+        if random.random() < stack_sample_rate:
+            message += '\n' + ''.join(traceback.format_stack(limit=12)[:-1])
+        app.logger.warning(message)
+
+
+def observe_acquire(seconds: float):
+    acquire_seconds.observe(seconds)
+    stats = _current.get()
+    if stats is not None:
+        stats.acquire_wait += seconds
+
+
+def observe_bcrypt(op: str, seconds: float):
+    bcrypt_seconds.observe(seconds, op)
+    stats = _current.get()
+    if stats is not None:
+        stats.bcrypt_time += seconds
+
+
+def _capture_stack(stats: RequestStats, task: asyncio.Task):
+    # запрос ещё выполняется дольше порога - запоминаем, где он сейчас ждёт
+    # (task.get_stack() у приостановленной корутины отдаёт один кадр, идём по цепочке await)
+    frames = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is not None:
+            frames.append((frame, frame.f_lineno))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    stats.stack = ''.join(traceback.format_list(traceback.StackSummary.extract(frames)))
+
+
+async def _before_request():
+    stats = RequestStats()
+    _current.set(stats)
+    if slow_request_ms is not None and random.random() < stack_sample_rate:
+        task = asyncio.current_task()
+        stats.watchdog = asyncio.get_running_loop().call_later(
+            slow_request_ms / 1000, _capture_stack, stats, task)
+
+
+async def _after_request(response):
+    stats = _current.get()
+    if stats is None:
+        return response
+    _current.set(None)
+    if stats.watchdog is not None:
+        stats.watchdog.cancel()
+    elapsed = time.perf_counter() - stats.start
+    endpoint = request.endpoint or 'unknown'
+    request_seconds.observe(elapsed, endpoint)
+    request_queries.observe(stats.queries, endpoint)
+    if slow_request_ms is not None and elapsed * 1000 >= slow_request_ms:
+        message = (f'slow request {endpoint} {elapsed * 1000:.1f}ms: '
+                   f'queries={stats.queries} db={stats.db_time * 1000:.1f}ms '
+                   f'acquire={stats.acquire_wait * 1000:.1f}ms bcrypt={stats.bcrypt_time * 1000:.1f}ms '
+                   f'render={stats.render_time * 1000:.1f}ms')
+        if stats.stack:
+            message += '\n' + stats.stack
+        app.logger.warning(message)
+    return response
+
+
+async def _template_started(sender, template, context, **_):
+    stats = _current.get()
+    if stats is not None:
+        stats.render_start = time.perf_counter()
+
+
+async def _template_finished(sender, template, context, **_):
+    stats = _current.get()
+    if stats is None or not stats.render_start:
+        return
+    seconds = time.perf_counter() - stats.render_start
+    stats.render_time += seconds
+    stats.render_start = 0.0
+    render_seconds.observe(seconds, template.name)
+
+
+def init_app(quart_app: Quart):
+    ''' хуки регистрируются только при METRICS_ENABLED '''
+    if not enabled:
+        return
+    quart_app.before_request(_before_request)
+    quart_app.after_request(_after_request)
+    before_render_template.connect(_template_started, quart_app)
+    template_rendered.connect(_template_finished, quart_app)
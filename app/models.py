@@ -1,13 +1,47 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
 
 import asyncpg
 from asyncpg import Connection
 from asyncpg.pool import Pool
 
+from quart import g, has_app_context
 from quart_auth import AuthUser
 
-from app import bcrypt as bc
 from app import app
+from app import metrics
+from app.hashing import hasher
+from app.hub import hub
+from app.cache import user_cache, profile_cache, set_event_bus
+from app.loader import request_loader
+from app.batching import BatchWriter
+from app.pagination import encode_cursor, decode_cursor
+from app.replicas import ReplicaSet, ReplicaLost, CONNECTION_ERRORS
+from app.timeline import PostgresTimelineStore, InMemoryTimelineStore, ReplicatedTimelineStore
+from app.events import InMemoryEventBus, PostgresEventBus
+from app.graph import SocialGraph
+from app.statements import Statement, StatementConnection, statements
+from app.storage import media_url
+
+
+class _PoolMetrics(object):
+    '''
+    счётчики ожидания соединения из пула
+    '''
+
+    def __init__(self):
+        self.acquires = 0
+        self.acquire_timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds: float):
+        self.acquires += 1
+        self.wait_total += seconds
+        if seconds > self.wait_max:
+            self.wait_max = seconds
 
 
 class _DataBase(object):
@@ -17,35 +51,270 @@ class _DataBase(object):
     _db_host = app.config['DB_HOST']
     _db_port = app.config['DB_PORT']
     _pool: Pool | None = None
+    _pool_lock = asyncio.Lock()
+    _acquire_timeout: float | None = app.config.get('DB_ACQUIRE_TIMEOUT', 10.0)
+    metrics = _PoolMetrics()
+    _replicas = ReplicaSet(app.config.get('DB_REPLICA_DSNS', []),
+                           app.config.get('DB_REPLICA_STRATEGY', 'round_robin'),
+                           app.config.get('DB_REPLICA_HEALTH_INTERVAL', 5.0))
+
+    @classmethod
+    def _dsn(cls) -> str:
+        return f"postgres://{cls._db_user}:{cls._user_password}@{cls._db_host}:{cls._db_port}/{cls._db_name}"
+
+    @classmethod
+    async def init_pool(cls):
+        ''' создаёт пул один раз, даже если первые запросы пришли одновременно '''
+        async with cls._pool_lock:
+            if cls._pool is not None:
+                return
+            pool_kwargs = dict(
+                min_size=app.config.get('DB_POOL_MIN_SIZE', 10),
+                max_size=app.config.get('DB_POOL_MAX_SIZE', 10),
+                max_queries=app.config.get('DB_POOL_MAX_QUERIES', 50000),
+                max_inactive_connection_lifetime=app.config.get('DB_POOL_MAX_INACTIVE_LIFETIME', 300.0),
+                statement_cache_size=app.config.get('DB_STATEMENT_CACHE_SIZE', 100),
+                # именованные запросы моделей готовятся на каждом новом соединении;
+                # ошибка в любом из них (схема не совпадает) не даёт подняться пулу
+                connection_class=StatementConnection,
+                init=statements.prepare_all)
+            cls._pool = await asyncpg.create_pool(cls._dsn(), **pool_kwargs)
+            await cls._replicas.start(**pool_kwargs)
+
+    @classmethod
+    async def close_pool(cls):
+        async with cls._pool_lock:
+            if cls._pool is None:
+                return
+            await cls._replicas.close()
+            await cls._pool.close()
+            cls._pool = None
+
+    @staticmethod
+    def mark_write():
+        ''' после записи чтения этого запроса идут в primary (read-after-write) '''
+        if has_app_context():
+            g._db_primary = True
+
+    @staticmethod
+    def _pinned_to_primary() -> bool:
+        return has_app_context() and g.get('_db_primary', False)
 
     @classmethod
-    async def _create_pool(cls):
-        dsn: str = f"postgres://{cls._db_user}:{cls._user_password}@{cls._db_host}:{cls._db_port}/{cls._db_name}"
+    async def _acquire_from(cls, pool: Pool) -> Connection:
+        start = time.perf_counter()
+        try:
+            con = await pool.acquire(timeout=cls._acquire_timeout)
+        except asyncio.TimeoutError:
+            cls.metrics.acquire_timeouts += 1
+            raise
+        wait = time.perf_counter() - start
+        cls.metrics.record_wait(wait)
+        if metrics.enabled:
+            metrics.observe_acquire(wait)
+        return con
+
+    @classmethod
+    @asynccontextmanager
+    async def acquire(cls, readonly: bool = False, primary: bool = False):
+        '''
+        readonly - соединение с реплики, если она есть и запрос ещё не писал;
+        отказ реплики во время работы с соединением -> ReplicaLost
+        '''
+        if cls._pool is None:
+            await cls.init_pool()
+        pool = cls._pool
+        replica = None
+        if readonly and not primary and not cls._pinned_to_primary():
+            replica = cls._replicas.choose()
+        if replica is not None:
+            try:
+                con = await cls._acquire_from(replica.pool)
+                pool = replica.pool
+            except CONNECTION_ERRORS:
+                # реплика упала между проверками здоровья
+                cls._replicas.mark_unhealthy(replica)
+                replica = None
+                con = await cls._acquire_from(pool)
+        else:
+            con = await cls._acquire_from(pool)
         try:
-            cls._pool: Pool = await asyncpg.create_pool(dsn)
-        except BaseException as ex:
-            print(ex)
+            yield con
+        except CONNECTION_ERRORS as ex:
+            if replica is None:
+                raise
+            cls._replicas.mark_unhealthy(replica)
+            raise ReplicaLost(replica.dsn.rsplit('@', 1)[-1]) from ex
+        finally:
+            await pool.release(con)
+
+    @classmethod
+    def pool_stats(cls) -> dict:
+        size = idle = 0
+        if cls._pool is not None:
+            size = cls._pool.get_size()
+            idle = cls._pool.get_idle_size()
+        m = cls.metrics
+        return {'size': size,
+                'in_use': size - idle,
+                'idle': idle,
+                'acquires': m.acquires,
+                'acquire_timeouts': m.acquire_timeouts,
+                'wait_total': m.wait_total,
+                'wait_max': m.wait_max,
+                'wait_avg': m.wait_total / m.acquires if m.acquires else 0.0,
+                'replicas': cls._replicas.stats()}
 
     @classmethod
-    async def execute_query(cls, query: str, *args,
+    async def execute_query(cls, query: str | Statement, *args,
                             execute: bool = False,
                             fetch: bool = False,
                             fetchrow: bool = False,
-                            fetchval: bool = False):
-        if cls._pool is None:
-            await cls._create_pool()
-        async with cls._pool.acquire() as con:
-            con: Connection
+                            fetchval: bool = False,
+                            readonly: bool = False):
+        '''
+        readonly - одиночный SELECT, выполняется без явной транзакции
+        (экономит BEGIN/COMMIT round trip)
+        query - Statement из реестра (уже подготовлен на соединении) или текст запроса
+        '''
+        if not readonly:
+            cls.mark_write()
+        try:
+            return await cls._execute(query, args, execute, fetch, fetchrow, fetchval, readonly)
+        except ReplicaLost:
+            # одиночный SELECT можно безопасно повторить на primary
+            return await cls._execute(query, args, execute, fetch, fetchrow, fetchval, readonly, primary=True)
+
+    @classmethod
+    async def _execute(cls, query: str | Statement, args: tuple,
+                       execute: bool, fetch: bool, fetchrow: bool, fetchval: bool,
+                       readonly: bool, primary: bool = False):
+        async with cls.acquire(readonly, primary) as con:
+            start = time.perf_counter() if metrics.enabled else 0.0
+            if readonly:
+                result = await cls._run(con, query, args, execute, fetch, fetchrow, fetchval)
+            else:
+                async with con.transaction():
+                    result = await cls._run(con, query, args, execute, fetch, fetchrow, fetchval)
+            if metrics.enabled:
+                label = query.name if isinstance(query, Statement) else query
+                metrics.observe_query(label, time.perf_counter() - start)
+            return result
+
+    @staticmethod
+    async def _run(con: Connection, query: str | Statement, args: tuple,
+                   execute: bool, fetch: bool, fetchrow: bool, fetchval: bool):
+        if isinstance(query, Statement):
+            return await statements.run(con, query, args, execute, fetch, fetchrow, fetchval)
+        if execute:
+            return await con.execute(query, *args)
+        elif fetch:
+            return await con.fetch(query, *args)
+        elif fetchrow:
+            return await con.fetchrow(query, *args)
+        elif fetchval:
+            return await con.fetchval(query, *args)
+
+    @classmethod
+    async def run(cls, con: Connection, query: str | Statement, *args,
+                  execute: bool = False,
+                  fetch: bool = False,
+                  fetchrow: bool = False,
+                  fetchval: bool = False):
+        ''' запрос на уже взятом соединении (внутри transaction()) '''
+        return await cls._run(con, query, args, execute, fetch, fetchrow, fetchval)
+
+    @classmethod
+    @asynccontextmanager
+    async def transaction(cls):
+        ''' соединение с открытой транзакцией для нескольких запросов подряд '''
+        cls.mark_write()
+        async with cls.acquire() as con:
             async with con.transaction():
-                if execute:
-                    result = await con.execute(query, *args)
-                elif fetch:
-                    result = await con.fetch(query, *args)
-                elif fetchrow:
-                    result = await con.fetchrow(query, *args)
-                elif fetchval:
-                    result = await con.fetchval(query, *args)
-        return result
+                yield con
+
+    @classmethod
+    async def next_ids(cls, con: Connection, table: str, count: int) -> list[int]:
+        ''' заранее выделяет id из serial-последовательности (для COPY) '''
+        query = ''' SELECT array_agg(nextval(pg_get_serial_sequence($1, 'id')))
+        FROM generate_series(1, $2) '''
+        return await con.fetchval(query, table, count)
+
+    @classmethod
+    async def stream_chunks(cls, query: str | Statement, *args, chunk_size: int = 1000):
+        '''
+        async-генератор пачек записей через серверный курсор: в памяти не больше
+        chunk_size строк, сколько бы их ни было в результате; следующая пачка
+        читается только когда потребитель забрал предыдущую
+        '''
+        async with cls.acquire(readonly=True) as con:
+            # серверный курсор живёт только внутри транзакции
+            async with con.transaction(readonly=True):
+                if isinstance(query, Statement):
+                    ps = await statements.prepared(con, query)
+                    cursor = await ps.cursor(*args)
+                else:
+                    cursor = await con.cursor(query, *args)
+                while True:
+                    chunk = await cursor.fetch(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+
+    @classmethod
+    async def keyset_chunks(cls, first: str | Statement, page: str | Statement, *args,
+                            key: tuple[str, ...], chunk_size: int = 1000):
+        '''
+        async-генератор пачек записей keyset-запросами: first(*args, limit),
+        page(*args, *key последней записи, limit); соединение берётся только на
+        один запрос, так что медленный потребитель (клиент выгрузки) не держит
+        ни соединение, ни транзакцию. снимка данных на всю выгрузку нет
+        '''
+        chunk = await cls.execute_query(first, *args, chunk_size, fetch=True, readonly=True)
+        while chunk:
+            yield chunk
+            if len(chunk) < chunk_size:
+                break
+            last = chunk[-1]
+            chunk = await cls.execute_query(page, *args, *(last[name] for name in key), chunk_size,
+                                            fetch=True, readonly=True)
+
+    @classmethod
+    async def stream(cls, query: str | Statement, *args, prefetch: int = 1000):
+        ''' то же, что stream_chunks, но по одной записи '''
+        async for chunk in cls.stream_chunks(query, *args, chunk_size=prefetch):
+            for record in chunk:
+                yield record
+
+
+class _LazyField(object):
+    '''
+    необязательное поле модели в __slots__: значение создаётся factory()
+    только при первом обращении (child_list, author, comments ...)
+    '''
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __set_name__(self, owner, name):
+        self.slot = '_' + name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            value = self.factory()
+            setattr(obj, self.slot, value)
+            return value
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+
+def _none():
+    return None
 
 
 class User(AuthUser):
@@ -64,57 +333,143 @@ class User(AuthUser):
         string = f'{self.name}:' + '\r\n' + f'{self.login}'
         return string
 
-    def set_password(self, password: str):
-        self.password_hash = bc.generate_password_hash(password).decode('utf-8')
+    async def set_password(self, password: str):
+        self.password_hash = await hasher.hash(password)
 
-    def check_password(self, password: str):
-        return bc.check_password_hash(self.password_hash, password)
+    async def check_password(self, password: str) -> bool:
+        ''' при успешной проверке хэш со старой стоимостью пересчитывается '''
+        if not await hasher.verify(self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            await self.set_password(password)
+            await User.update_password(self)
+        return True
 
     def tup(self) -> tuple:
         return (self.login,
                 self.password_hash,
                 self.name,)
 
+    _q_add = statements.register('user.add', '''
+        INSERT INTO users (login, password_hash, name)
+        VALUES ($1, $2, $3)
+        RETURNING id''')
+
     @classmethod
     async def add(cls, user):
-        query = '''
-        INSERT INTO users (login, password_hash, name)
-        VALUES ($1, $2, $3)'''
-        return await _DataBase.execute_query(query, *user.tup(), execute=True)
+        query = cls._q_add
+        user.id = await _DataBase.execute_query(query, *user.tup(), fetchval=True)
+        await user_cache.invalidate(user.id)
+        return user.id
+
+    _q_update_password = statements.register('user.update_password', '''
+        UPDATE users SET password_hash = $1
+        WHERE id = $2''')
+
+    @classmethod
+    async def update_password(cls, user):
+        ''' сохраняет user.password_hash (после set_password) '''
+        query = cls._q_update_password
+        res = await _DataBase.execute_query(query, user.password_hash, user.id, execute=True)
+        await user_cache.invalidate(user.id)
+        return res
+
+    _q_get_by_login = statements.register('user.get_by_login', '''
+        SELECT id, login, password_hash, name FROM users
+        WHERE login = $1''')
 
     @classmethod
     async def get_by_login(cls, login: str):
-        query = '''
-        SELECT * FROM users
-        WHERE login = $1'''
-        res = await _DataBase.execute_query(query, login, fetchrow=True)
+        query = cls._q_get_by_login
+        res = await _DataBase.execute_query(query, login, fetchrow=True, readonly=True)
         if res is None:
             return None
         return User(*res)
 
+    _q_get_by_id = statements.register('user.get_by_id', '''
+        SELECT id, login, password_hash, name FROM users
+        WHERE id = $1''')
+
     @classmethod
     async def get_by_id(cls, user_id: int):
-        query = '''
-        SELECT  * FROM users
-        WHERE id = $1'''
-        res = await _DataBase.execute_query(query, user_id, fetchrow=True)
+        query = cls._q_get_by_id
+
+        async def load():
+            row = await _DataBase.execute_query(query, user_id, fetchrow=True, readonly=True)
+            return None if row is None else tuple(row)
+
+        user_id = int(user_id)
+        res = await user_cache.get_or_load(user_id, load)
         if res is None:
             return None
         return User(*res)
 
+    _q_load_batch = statements.register('user.load_batch', '''
+            SELECT id, login, password_hash, name FROM users
+            WHERE id = ANY($1::int[])''')
+
+    @classmethod
+    async def _load_batch(cls, user_ids: list) -> dict:
+        found = {}
+        missing = []
+        for user_id in user_ids:
+            row = user_cache.local.get(user_id, None)
+            if row is None:
+                missing.append(user_id)
+            else:
+                found[user_id] = row
+        if missing:
+            query = cls._q_load_batch
+            res = await _DataBase.execute_query(query, missing, fetch=True, readonly=True)
+            for row in res:
+                row = tuple(row)
+                user_cache.local.set(row[0], row)
+                found[row[0]] = row
+        return {user_id: User(*row) for user_id, row in found.items()}
+
     @classmethod
-    async def search_by_word(cls, key_word: str) -> list | None:
-        query = '''
-        SELECT * FROM users
-        WHERE name LIKE %$1% OR
-        login LIKE %$2%'''
-        res = await _DataBase.execute_query(query, key_word, key_word, fetch=True)
+    async def get_many(cls, user_ids: list[int]) -> list:
+        '''
+        пакетная загрузка пользователей: все вызовы за один тик event loop
+        в рамках запроса объединяются в один запрос к бд
+        '''
+        return await request_loader('users', cls._load_batch).load_many(user_ids)
+
+    _q_search_by_word = statements.register('user.search_by_word', '''
+        SELECT id, login, password_hash, name FROM users
+        WHERE login ILIKE $2 OR name ILIKE $2 OR
+        login % $1 OR name % $1
+        ORDER BY GREATEST(similarity(login, $1), similarity(name, $1)) DESC, id
+        LIMIT $3 OFFSET $4''')
+
+    @classmethod
+    async def search_by_word(cls, key_word: str, limit: int = 20, offset: int = 0) -> list | None:
+        '''
+        префиксный поиск + поиск по сходству (pg_trgm) по login и name,
+        оба условия обслуживаются gin-индексами users_*_trgm_idx
+        '''
+        query = cls._q_search_by_word
+        prefix = _escape_like(key_word) + '%'
+        res = await _DataBase.execute_query(query, key_word, prefix, limit, offset, fetch=True, readonly=True)
         if res is None or len(res) == 0:
             return None
         res = list(map(lambda x: User(*x), res))
         return res
 
 
+def _escape_like(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+async def _attach_authors(items: list, key: str):
+    ''' заполняет item.author по item.<key> одним пакетным запросом '''
+    if not items:
+        return
+    authors = await User.get_many([getattr(item, key) for item in items])
+    for item, author in zip(items, authors):
+        item.author = author
+
+
 class Profile(object):
     '''
     класс описывающий профиль пользователя
@@ -136,90 +491,180 @@ class Profile(object):
                 self.biography,
                 self.about,)
 
-    def avatar(self) -> str:
-        if self.profile_img == '' or self.profile_img is None:
-            return None
-        return self.profile_img
+    def avatar(self, variant: str | None = 'thumb') -> str | None:
+        ''' url варианта аватара (profile_img - ключ app.storage) '''
+        return media_url(self.profile_img, variant)
+
+    _q_add = statements.register('profile.add', '''
+        INSERT INTO profile_info (id, profile_img, biography, about)
+        VALUES ($1, $2, $3, $4)''')
 
     @classmethod
     async def add(cls, profile):
-        query = '''
-        INSERT INTO profile_info (id, profile_img, biography, about)
-        VALUES ($1, $2, $3, $4)'''
-        return await _DataBase.execute_query(query, *profile.tup(), execute=True)
+        query = cls._q_add
+        res = await _DataBase.execute_query(query, *profile.tup(), execute=True)
+        await profile_cache.invalidate(profile.id)
+        return res
+
+    _q_get_by_id = statements.register('profile.get_by_id', '''
+        SELECT id, profile_img, biography, about FROM profile_info
+        WHERE id = $1''')
 
     @classmethod
     async def get_by_id(cls, user_id: int):
-        query = '''
-        SELECT * FROM profile_info
-        WHERE id = $1'''
-        res = await _DataBase.execute_query(query, user_id, fetchrow=True)
+        query = cls._q_get_by_id
+
+        async def load():
+            row = await _DataBase.execute_query(query, user_id, fetchrow=True, readonly=True)
+            return None if row is None else tuple(row)
+
+        user_id = int(user_id)
+        res = await profile_cache.get_or_load(user_id, load)
         if res is None:
             return None
         return Profile(*res)
 
+    _q_update = statements.register('profile.update', '''
+        UPDATE profile_info 
+        SET profile_img = $1,
+        biography = $2,
+        about = $3
+        WHERE id = $4''')
+
     @classmethod
     async def update(cls, new_profile):
-        profile = cls.get_by_id(new_profile.id)
+        profile = await cls.get_by_id(new_profile.id)
         if profile is None:
             return await cls.add(new_profile)
-        query = ''' UPDATE profile_info 
-        SET profile_img = $1,
-        biography = $2,
-        about = $3,
-        WHERE id = $4'''
-        return await _DataBase.execute_query(query, new_profile.profile_img, new_profile.biography,
-                                             new_profile.about, new_profile.id, execute=True)
+        query = cls._q_update
+        res = await _DataBase.execute_query(query, new_profile.profile_img, new_profile.biography,
+                                            new_profile.about, new_profile.id, execute=True)
+        await profile_cache.invalidate(new_profile.id)
+        return res
 
 
 class Follows(object):
-    @classmethod
-    async def add(cls, follower_id: int, followed_id: int):
-        query = ''' INSERT INTO follows (follower_id, followed_id)
-        VALUES ($1, $2)'''
-        return await _DataBase.execute_query(query, follower_id, followed_id, execute=True)
+    _q_insert_rows = statements.register('follows.insert_rows', '''
+        WITH inserted AS (
+            INSERT INTO follows (follower_id, followed_id)
+            SELECT * FROM unnest($1::int[], $2::int[])
+            ON CONFLICT DO NOTHING
+            RETURNING follower_id, followed_id
+        ), deltas AS (
+            SELECT followed_id AS user_id, 1 AS followers, 0 AS followings FROM inserted
+            UNION ALL
+            SELECT follower_id, 0, 1 FROM inserted
+        ), stats AS (
+            INSERT INTO follow_stats (user_id, followers, followings)
+            SELECT user_id, sum(followers), sum(followings) FROM deltas
+            GROUP BY user_id
+            ORDER BY user_id
+            ON CONFLICT (user_id) DO UPDATE
+            SET followers = follow_stats.followers + excluded.followers,
+            followings = follow_stats.followings + excluded.followings
+        )
+        SELECT follower_id, followed_id FROM inserted ''')
+
+    @staticmethod
+    async def _insert_rows(con: Connection, rows: list) -> list[bool]:
+        ''' -> [подписка создана]; повторная подписка не пишется и не считается '''
+        res = await _DataBase.run(con, Follows._q_insert_rows,
+                                  [row[0] for row in rows], [row[1] for row in rows], fetch=True)
+        inserted = {tuple(row) for row in res}
+        created = []
+        for row in rows:
+            # одинаковые пары в одной пачке: создана только первая
+            created.append(row in inserted)
+            inserted.discard(row)
+        return created
 
     @classmethod
-    async def delete(cls, follower_id: int, followed_id: int) -> bool:
-        query = ''' DELETE FROM follows
+    async def add(cls, follower_id: int, followed_id: int) -> bool:
+        _DataBase.mark_write()
+        created = await _follows_writer.submit((follower_id, followed_id))
+        if created:
+            graph.on_follow(follower_id, followed_id)
+            await Post.backfill_timeline(follower_id, followed_id)
+        return created
+
+    _q_delete = statements.register('follows.delete', '''
+        WITH deleted AS (
+            DELETE FROM follows
             WHERE follower_id = $1
-            AND followed_id = $2 '''
-        return await _DataBase.execute_query(query, follower_id, followed_id, execute=True)
+            AND followed_id = $2
+            RETURNING follower_id, followed_id
+        ), stats AS (
+            UPDATE follow_stats
+            SET followers = followers - (follow_stats.user_id = d.followed_id)::int,
+            followings = followings - (follow_stats.user_id = d.follower_id)::int
+            FROM deleted d
+            WHERE follow_stats.user_id IN (d.follower_id, d.followed_id)
+        )
+        SELECT count(*) FROM deleted ''')
 
     @classmethod
-    async def is_following(cls, follower_id, followed_id) -> bool:
-        query = ''' SELECT COUNT(*) FROM follows
-            WHERE follower_id = $1
-            AND followed_id = $2 '''
-        res = await _DataBase.execute_query(query, follower_id, followed_id, fetchval=True)
-        if res is None or res == 0:
+    async def delete(cls, follower_id: int, followed_id: int) -> bool:
+        query = cls._q_delete
+        deleted = await _DataBase.execute_query(query, follower_id, followed_id, fetchval=True)
+        if not deleted:
             return False
+        graph.on_unfollow(follower_id, followed_id)
+        await _timeline.prune(follower_id, followed_id)
         return True
 
     @classmethod
-    async def get_followers(cls, user_id: int) -> list[User] | None:
-        ''' получаем подписчиков user(user_id) '''
-        query = ''' SELECT * FROM follows 
-        INNER JOIN users ON follows.follower_id = users.id 
-        WHERE followed_id = $1 '''
-        res = await _DataBase.execute_query(query, user_id, fetch=True)
-        if res is None or len(res) == 0:
+    async def is_following(cls, follower_id, followed_id) -> bool:
+        return await graph.is_following(int(follower_id), int(followed_id))
+
+    @classmethod
+    async def is_following_many(cls, follower_id: int, user_ids: list[int]) -> dict[int, bool]:
+        ''' {user_id: подписан ли follower_id} для кнопок "подписаться" на странице '''
+        return await graph.is_following_many(follower_id, user_ids)
+
+    @classmethod
+    async def get_counts(cls, user_ids: list[int]) -> dict[int, tuple[int, int]]:
+        ''' {user_id: (подписчиков, подписок)} '''
+        return await graph.counts(user_ids)
+
+    @staticmethod
+    async def _users(user_ids: list[int]) -> list[User]:
+        users = await User.get_many(user_ids)
+        return [user for user in users if user is not None]
+
+    @classmethod
+    async def get_followers(cls, user_id: int, limit: int = 50, after: int = 0) -> list[User] | None:
+        ''' получаем подписчиков user(user_id); after - id последнего на предыдущей странице '''
+        res = await cls._users(await graph.follower_ids(user_id, limit, after))
+        if len(res) == 0:
             return None
-        return list(map(lambda x: User(x[2::]), res))
+        return res
 
     @classmethod
-    async def get_followings(cls, user_id: int) -> list[User] | None:
+    async def get_followings(cls, user_id: int, limit: int = 50, after: int = 0) -> list[User] | None:
         ''' получаем подписки user(user_id) '''
-        query = ''' SELECT * FROM follows 
-        INNER JOIN users ON follows.followed_id = users.id 
-        WHERE follower_id = $1 '''
-        res = await _DataBase.execute_query(query, user_id, fetch=True)
-        if res is None or len(res) == 0:
+        res = await cls._users(await graph.following_ids(user_id, limit, after))
+        if len(res) == 0:
             return None
-        return list(map(lambda x: User(x[2::]), res))
+        return res
+
+    @classmethod
+    async def get_mutual(cls, user_id: int, limit: int = 50, after: int = 0) -> list[User]:
+        ''' взаимные подписки '''
+        return await cls._users(await graph.mutual_ids(user_id, limit, after))
+
+    @classmethod
+    async def get_suggestions(cls, user_id: int, limit: int = 20) -> list[User]:
+        ''' на кого подписаться: друзья друзей по числу общих связей '''
+        return await cls._users([id for id, _ in await graph.suggestion_ids(user_id, limit)])
 
 
 class Chat(object):
+    __slots__ = ('id', 'name', 'counter', 'image', '_unread', '_last_message')
+
+    # поля не из таблицы chat, заполняются get_users_chats_overview
+    unread = _LazyField(int)
+    last_message = _LazyField(_none)
+
     def __init__(self,
                  id: int = 0,
                  name: str = '',
@@ -227,6 +672,7 @@ class Chat(object):
                  image: str | None = None):
         self.id = id
         self.name = name
+        # номер (seq) последнего сообщения в чате
         self.counter = counter
         self.image = image
 
@@ -235,75 +681,246 @@ class Chat(object):
                 self.counter,
                 self.image,)
 
+    def image_url(self, variant: str | None = 'thumb') -> str | None:
+        ''' для списка чатов хватает миниатюры '''
+        return media_url(self.image, variant)
+
+    _q_add = statements.register('chat.add', '''
+        INSERT INTO chat (name, counter, image)
+        VALUES  ($1, $2, $3)
+        RETURNING id ''')
+
     @classmethod
     async def add(cls, chat):
-        query = ''' INSERT INTO chat (name, counter, image)
-        VALUES  ($1, $2, $3)
-        RETURNING id '''
+        query = cls._q_add
         return await _DataBase.execute_query(query, chat.name, chat.counter, chat.image, fetchval=True)
 
+    _q_get_by_id = statements.register('chat.get_by_id', '''
+        SELECT id, name, counter, image FROM chat
+        WHERE id = $1''')
+
     @classmethod
     async def get_by_id(cls, chat_id: int):
-        query = ''' SELECT * FROM chat
-        WHERE id = $1'''
-        res = await _DataBase.execute_query(query, chat_id, fetchrow=True)
+        query = cls._q_get_by_id
+        res = await _DataBase.execute_query(query, chat_id, fetchrow=True, readonly=True)
         if res is None:
             return None
         return Chat(*res)
 
+    _q_delete = statements.register('chat.delete', '''
+        DELETE FROM chat WHERE id = $1 ''')
+
     @classmethod
     async def delete(cls, chat_id: int):
-        query = ''' DELETE chat WHERE id = $1 '''
+        query = cls._q_delete
         return await _DataBase.execute_query(query, chat_id, execute=True)
 
+    _q_get_direct = statements.register('chat.get_direct', '''
+        SELECT chat.id, chat.name, chat.counter, chat.image
+        FROM direct_chat JOIN chat ON chat.id = direct_chat.chat_id
+        WHERE direct_chat.user_low = $1 AND direct_chat.user_high = $2 ''')
+
+    _q_update_image = statements.register('chat.update_image', '''
+        UPDATE chat SET image = $1 WHERE id = $2 ''')
+
+    @classmethod
+    async def update_image(cls, chat_id: int, image: str | None):
+        query = cls._q_update_image
+        return await _DataBase.execute_query(query, image, chat_id, execute=True)
+
+    @classmethod
+    async def get_direct(cls, f_user_id: int, s_user_id: int):
+        ''' личный чат двух пользователей - один поиск по ключу (user_low, user_high) '''
+        query = cls._q_get_direct
+        res = await _DataBase.execute_query(query, *sorted((f_user_id, s_user_id)),
+                                            fetchrow=True, readonly=True)
+        if res is None:
+            return None
+        return Chat(*res)
+
     @classmethod
     async def get_chats_with_2_users(cls, f_user_id: int, s_user_id: int) -> list:
-        pass
+        chat = await cls.get_direct(f_user_id, s_user_id)
+        return [] if chat is None else [chat]
+
+    _q_get_direct_many = statements.register('chat.get_direct_many', '''
+        SELECT o.id, chat.id, chat.name, chat.counter, chat.image
+        FROM unnest($2::int[]) AS o(id)
+        JOIN direct_chat ON direct_chat.user_low = least($1, o.id)
+        AND direct_chat.user_high = greatest($1, o.id)
+        JOIN chat ON chat.id = direct_chat.chat_id ''')
+
+    @classmethod
+    async def get_direct_many(cls, user_id: int, other_ids: list[int]) -> dict:
+        ''' {other_id: Chat} для списка контактов, одним запросом '''
+        query = cls._q_get_direct_many
+        res = await _DataBase.execute_query(query, user_id, other_ids, fetch=True, readonly=True)
+        return {row[0]: Chat(*row[1:]) for row in res}
+
+    _q_claim_direct = statements.register('chat.claim_direct', '''
+        INSERT INTO direct_chat (user_low, user_high, chat_id)
+        VALUES ($1, $2, $3)
+        ON CONFLICT DO NOTHING
+        RETURNING chat_id ''')
+    _q_add_with_id = statements.register('chat.add_with_id', '''
+        INSERT INTO chat (id, name, counter, image)
+        VALUES ($1, $2, $3, $4) ''')
+
+    @classmethod
+    async def get_or_create_direct(cls, f_user_id: int, s_user_id: int, name: str = '') -> tuple:
+        '''
+        -> (Chat, создан ли); параллельные вызовы для одной пары дают один чат:
+        пара занимается в direct_chat до создания самого чата
+        '''
+        chat = await cls.get_direct(f_user_id, s_user_id)
+        if chat is not None:
+            return chat, False
+        low, high = sorted((f_user_id, s_user_id))
+        async with _DataBase.transaction() as con:
+            chat_id = (await _DataBase.next_ids(con, 'chat', 1))[0]
+            # ON CONFLICT ждёт транзакцию, занявшую ту же пару; если она закоммитилась,
+            # строка не вставляется и берётся уже созданный чат
+            claimed = await _DataBase.run(con, cls._q_claim_direct, low, high, chat_id, fetchval=True)
+            if claimed is None:
+                res = await _DataBase.run(con, cls._q_get_direct, low, high, fetchrow=True)
+                return Chat(*res), False
+            chat = Chat(id=chat_id, name=name)
+            await _DataBase.run(con, cls._q_add_with_id, chat.id, *chat.tup(), execute=True)
+            await UserInChat._insert_rows(con, [(user_id, chat_id) for user_id in {low, high}])
+        return chat, True
 
 
 class UserInChat(object):
+    @staticmethod
+    async def _insert_rows(con: Connection, rows: list) -> list:
+        await con.copy_records_to_table('user_in_chat', records=rows,
+                                        columns=('user_id', 'chat_id'))
+        return [None] * len(rows)
+
     @classmethod
     async def add(cls, user_id: int, chat_id: int):
-        query = ''' INSERT INTO user_in_chat (user_id, chat_id)
-        VALUES ($1, $2)'''
-        return await _DataBase.execute_query(query, user_id, chat_id, execute=True)
+        _DataBase.mark_write()
+        return await _user_in_chat_writer.submit((user_id, chat_id))
+
+    @classmethod
+    async def add_many(cls, chat_id: int, user_ids: list[int]):
+        ''' добавление участников группового чата одним COPY '''
+        async with _DataBase.transaction() as con:
+            await cls._insert_rows(con, [(user_id, chat_id) for user_id in user_ids])
 
     @classmethod
     async def delete(cls, user_id: int, chat_id: int):
         pass
 
+    _q_is_member = statements.register('user_in_chat.is_member', '''
+        SELECT EXISTS (SELECT 1 FROM user_in_chat
+        WHERE user_id = $1 AND chat_id = $2) ''')
+
     @classmethod
-    async def get_users_chats(cls, user_id: int) -> list | None:
-        query = ''' SELECT DISTINCT id, name, counter, image
+    async def is_member(cls, user_id: int, chat_id: int) -> bool:
+        query = cls._q_is_member
+        return await _DataBase.execute_query(query, user_id, chat_id, fetchval=True, readonly=True)
+
+    _q_get_users_chats = statements.register('user_in_chat.get_users_chats', '''
+        SELECT DISTINCT id, name, counter, image
         FROM user_in_chat JOIN chat ON user_in_chat.chat_id = chat.id
-        WHERE user_in_chat.user_id = $1 '''
-        res = await _DataBase.execute_query(query, user_id, fetch=True)
+        WHERE user_in_chat.user_id = $1 ''')
+
+    @classmethod
+    async def get_users_chats(cls, user_id: int) -> list | None:
+        query = cls._q_get_users_chats
+        res = await _DataBase.execute_query(query, user_id, fetch=True, readonly=True)
         if res is None or len(res) == 0:
             return None
         return list(map(lambda x: Chat(*x), res))
 
+    _q_get_users_chats_overview = statements.register('user_in_chat.get_users_chats_overview', '''
+        SELECT chat.id, chat.name, chat.counter, chat.image,
+        chat.counter - user_in_chat.last_read_seq AS unread,
+        message.id, message.user_id, message.mes_text, message.sends_time
+        FROM user_in_chat
+        JOIN chat ON chat.id = user_in_chat.chat_id
+        LEFT JOIN message ON message.chat_id = chat.id AND message.seq = chat.counter
+        WHERE user_in_chat.user_id = $1
+        ORDER BY chat.last_message_at DESC NULLS LAST, chat.id DESC ''')
+
+    @classmethod
+    async def get_users_chats_overview(cls, user_id: int) -> list:
+        '''
+        чаты пользователя с числом непрочитанных и последним сообщением,
+        недавно активные первыми; без подсчёта строк message
+        '''
+        query = cls._q_get_users_chats_overview
+        res = await _DataBase.execute_query(query, user_id, fetch=True, readonly=True)
+        chats = []
+        for row in res:
+            chat = Chat(*row[:4])
+            chat.unread = row['unread']
+            if row[5] is not None:
+                chat.last_message = Message(row[5], chat.id, row[6], None, row[7], row[8], chat.counter)
+            chats.append(chat)
+        return chats
+
+    _q_mark_read = statements.register('user_in_chat.mark_read', '''
+        UPDATE user_in_chat
+        SET last_read_message_id = message.id, last_read_seq = message.seq
+        FROM message
+        WHERE user_in_chat.user_id = $1 AND user_in_chat.chat_id = $2
+        AND message.id = $3 AND message.chat_id = $2
+        AND message.seq > user_in_chat.last_read_seq ''')
+
+    @classmethod
+    async def mark_read(cls, user_id: int, chat_id: int, message_id: int) -> bool:
+        ''' двигает курсор прочтения вперёд (назад - никогда) и рассылает read receipt '''
+        query = cls._q_mark_read
+        res = await _DataBase.execute_query(query, user_id, chat_id, message_id, execute=True)
+        if res == 'UPDATE 0':
+            return False
+        hub.publish(chat_id, {'type': 'read', 'user_id': user_id, 'message_id': message_id})
+        return True
+
+    _q_get_read_receipts = statements.register('user_in_chat.get_read_receipts', '''
+        SELECT user_id, last_read_message_id FROM user_in_chat
+        WHERE chat_id = $1 ''')
+
+    @classmethod
+    async def get_read_receipts(cls, chat_id: int) -> dict:
+        ''' {user_id: id последнего прочитанного сообщения} '''
+        query = cls._q_get_read_receipts
+        res = await _DataBase.execute_query(query, chat_id, fetch=True, readonly=True)
+        return {row[0]: row[1] for row in res}
+
 
 class Message(object):
+    __slots__ = ('id', 'chat_id', 'user_id', 'parent_id', 'mes_text', 'sends_time', 'seq',
+                 '_child_list', '_depth', '_has_more', '_author')
+
+    # поля не относящиеся к бд, создаются при первом обращении
+    # необходимо для формирования дерева сообщений (если оно формируется)
+    child_list = _LazyField(list)
+    # глубина сообщения в дереве
+    depth = _LazyField(int)
+    # у сообщения есть не загруженные ответы (дерево обрезано по max_depth)
+    has_more = _LazyField(bool)
+    # автор сообщения
+    author = _LazyField(_none)
+
     def __init__(self,
                  id: int = 0,
                  chat_id: int = 0,
                  user_id: int = 0,
                  parent_id: int | None = None,
                  mes_text: str = '',
-                 sends_time: datetime = datetime.now()):
+                 sends_time: datetime = datetime.now(),
+                 seq: int | None = None):
         self.id = id
         self.chat_id = chat_id
         self.user_id = user_id
         self.parent_id = parent_id
         self.mes_text = mes_text
         self.sends_time = sends_time
-        # поле не относящееся к бд
-        # необходимо для формирования дерева сообщений (если оно формируется)
-        self.child_list = []
-        # глубина сообщения в дереве
-        self.depth = 0
-        # автор сообщения
-        self.author: User | None = None
+        # порядковый номер сообщения в чате
+        self.seq = seq
 
     def tup(self) -> tuple:
         return (self.chat_id,
@@ -315,26 +932,252 @@ class Message(object):
     def __repr__(self):
         return f'<Message {self.id}>'
 
+    def to_dict(self) -> dict:
+        return {'id': self.id,
+                'chat_id': self.chat_id,
+                'user_id': self.user_id,
+                'parent_id': self.parent_id,
+                'mes_text': self.mes_text,
+                'sends_time': self.sends_time.isoformat(),
+                'seq': self.seq}
+
+    _q_lock_chats = statements.register('message.lock_chats', '''
+        SELECT id FROM chat WHERE id = ANY($1::int[]) ORDER BY id FOR UPDATE ''')
+    _q_advance_counters = statements.register('message.advance_counters', '''
+        UPDATE chat
+        SET counter = chat.counter + c.n,
+        last_message_at = greatest(chat.last_message_at, c.last_time)
+        FROM unnest($1::int[], $2::int[], $3::timestamp[]) AS c(id, n, last_time)
+        WHERE chat.id = c.id
+        RETURNING chat.id, chat.counter - c.n ''')
+    # свои сообщения отправитель уже прочитал
+    _q_advance_read = statements.register('message.advance_read', '''
+        UPDATE user_in_chat
+        SET last_read_seq = greatest(user_in_chat.last_read_seq, r.seq), last_read_message_id = r.id
+        FROM unnest($1::int[], $2::int[], $3::int[], $4::bigint[]) AS r(chat_id, user_id, id, seq)
+        WHERE user_in_chat.chat_id = r.chat_id AND user_in_chat.user_id = r.user_id
+        AND r.seq > user_in_chat.last_read_seq ''')
+
+    @staticmethod
+    async def _insert_rows(con: Connection, rows: list) -> list[tuple[int, int]]:
+        ''' -> [(id, seq)]; seq выдаются под блокировкой строк chat, без пропусков '''
+        per_chat: dict[int, list] = {}
+        for row in rows:
+            per_chat.setdefault(row[0], []).append(row)
+        chat_ids = sorted(per_chat)
+        # блокируем в порядке id, чтобы параллельные пачки не взаимоблокировались
+        await _DataBase.run(con, Message._q_lock_chats, chat_ids, fetch=True)
+        res = await _DataBase.run(con, Message._q_advance_counters, chat_ids,
+                                  [len(per_chat[chat_id]) for chat_id in chat_ids],
+                                  [max(row[4] for row in per_chat[chat_id]) for chat_id in chat_ids],
+                                  fetch=True)
+        next_seq = {row[0]: row[1] for row in res}
+        ids = await _DataBase.next_ids(con, 'message', len(rows))
+        records = []
+        for id, row in zip(ids, rows):
+            next_seq[row[0]] += 1
+            records.append((id, *row, next_seq[row[0]]))
+        await con.copy_records_to_table('message', records=records,
+                                        columns=('id', 'chat_id', 'user_id', 'parent_id',
+                                                 'mes_text', 'sends_time', 'seq'))
+        # (chat_id, user_id) -> (id, seq) последнего сообщения отправителя в пачке
+        last_sent = {}
+        for record in records:
+            last_sent[(record[1], record[2])] = (record[0], record[-1])
+        keys = list(last_sent)
+        await _DataBase.run(con, Message._q_advance_read,
+                            [chat_id for chat_id, _ in keys], [user_id for _, user_id in keys],
+                            [last_sent[key][0] for key in keys], [last_sent[key][1] for key in keys],
+                            execute=True)
+        return [(record[0], record[-1]) for record in records]
+
     @classmethod
     async def add(cls, message):
-        query = """ INSERT INTO message (chat_id, user_id, parent_id, mes_text, sends_time) 
-        VALUES ($1, $2, $3, '$4', '$5') """
-        return await _DataBase.execute_query(query, *message.tup(), execute=True)
+        # одновременные отправки объединяются в одну транзакцию (см. _message_writer)
+        _DataBase.mark_write()
+        message.id, message.seq = await _message_writer.submit(message.tup())
+        # транзакция уже закоммичена - рассылаем сообщение подписчикам чата
+        hub.publish(message.chat_id, {'type': 'message', 'message': message.to_dict()})
+        hub.publish(message.chat_id, {'type': 'read', 'user_id': message.user_id, 'message_id': message.id})
+        return message.id
 
     @classmethod
-    async def get_all_by_chat_id(cls, chat_id: int) -> list | None:
-        query = ''' SELECT * FROM message 
-        WHERE chat_id = $1 ORDER BY sends_time'''
-        res = await _DataBase.execute_query(query, chat_id, fetch=True)
+    async def add_many(cls, messages: list) -> list[int]:
+        async with _DataBase.transaction() as con:
+            res = await cls._insert_rows(con, [message.tup() for message in messages])
+        for message, (id, seq) in zip(messages, res):
+            message.id = id
+            message.seq = seq
+            hub.publish(message.chat_id, {'type': 'message', 'message': message.to_dict()})
+        # read receipt отправителя - по последнему его сообщению в чате
+        last_sent = {(message.chat_id, message.user_id): message.id for message in messages}
+        for (chat_id, user_id), message_id in last_sent.items():
+            hub.publish(chat_id, {'type': 'read', 'user_id': user_id, 'message_id': message_id})
+        return [id for id, _ in res]
+
+    def cursor(self) -> str:
+        return encode_cursor(self.sends_time, self.id)
+
+    _q_chat_tree = statements.register('message.chat_tree', '''
+        WITH RECURSIVE thread AS (
+                SELECT id, chat_id, user_id, parent_id, mes_text, sends_time, 0 AS depth
+                FROM message
+                WHERE chat_id = $1 AND parent_id IS NULL
+              UNION ALL
+                SELECT m.id, m.chat_id, m.user_id, m.parent_id, m.mes_text, m.sends_time, t.depth + 1
+                FROM message m JOIN thread t ON m.parent_id = t.id
+                WHERE t.depth < $2
+            )
+            SELECT t.*, t.depth = $2 AND EXISTS (SELECT 1 FROM message c WHERE c.parent_id = t.id) AS has_more
+            FROM thread t
+            ORDER BY t.depth, t.sends_time, t.id ''')
+    _q_branch_tree = statements.register('message.branch_tree', '''
+        WITH RECURSIVE thread AS (
+            SELECT id, chat_id, user_id, parent_id, mes_text, sends_time, 0 AS depth
+            FROM message
+            WHERE chat_id = $1 AND id = $2
+          UNION ALL
+            SELECT m.id, m.chat_id, m.user_id, m.parent_id, m.mes_text, m.sends_time, t.depth + 1
+            FROM message m JOIN thread t ON m.parent_id = t.id
+            WHERE t.depth < $3
+        )
+        SELECT t.*, t.depth = $3 AND EXISTS (SELECT 1 FROM message c WHERE c.parent_id = t.id) AS has_more
+        FROM thread t
+        ORDER BY t.depth, t.sends_time, t.id ''')
+
+    @classmethod
+    async def _fetch_tree(cls, chat_id: int, root_id: int | None, max_depth: int) -> list:
+        ''' всё поддерево одним рекурсивным запросом, родители раньше детей '''
+        if root_id is None:
+            query = cls._q_chat_tree
+            return await _DataBase.execute_query(query, chat_id, max_depth, fetch=True, readonly=True)
+        query = cls._q_branch_tree
+        return await _DataBase.execute_query(query, chat_id, root_id, max_depth, fetch=True, readonly=True)
+
+    @staticmethod
+    def _build_tree(rows, depth_offset: int = 0) -> list:
+        ''' один линейный проход по индексу id -> узел '''
+        nodes: dict[int, Message] = {}
+        roots = []
+        for row in rows:
+            message = Message(*row[:6])
+            message.depth = row['depth'] + depth_offset
+            message.has_more = row['has_more']
+            nodes[message.id] = message
+            parent = nodes.get(message.parent_id)
+            if parent is None:
+                roots.append(message)
+            else:
+                parent.child_list.append(message)
+        return roots
+
+    @classmethod
+    async def get_thread(cls, chat_id: int, root_id: int | None = None,
+                         max_depth: int = 5) -> list | None:
+        '''
+        дерево сообщений чата (или поддерево root_id) не глубже max_depth;
+        у обрезанных узлов has_more = True, догружаются через load_branch
+        '''
+        res = await cls._fetch_tree(chat_id, root_id, max_depth)
         if res is None or len(res) == 0:
             return None
-        return list(map(lambda x: Message(*x), res))
+        return cls._build_tree(res)
+
+    @classmethod
+    async def load_branch(cls, message, max_depth: int = 5):
+        ''' ленивая догрузка ответов на message '''
+        res = await cls._fetch_tree(message.chat_id, message.id, max_depth)
+        if res is None or len(res) == 0:
+            return message
+        root = cls._build_tree(res, message.depth)[0]
+        message.child_list = root.child_list
+        message.has_more = False
+        return message
+
+    _q_get_all_by_chat_id = statements.register('message.get_all_by_chat_id', '''
+        SELECT id, chat_id, user_id, parent_id, mes_text, sends_time
+            FROM message
+            WHERE chat_id = $1
+            ORDER BY sends_time DESC, id DESC
+            LIMIT $2 ''')
+    _q_get_all_by_chat_id_page = statements.register('message.get_all_by_chat_id_page', '''
+        SELECT id, chat_id, user_id, parent_id, mes_text, sends_time
+            FROM message
+            WHERE chat_id = $1 AND (sends_time, id) < ($2, $3)
+            ORDER BY sends_time DESC, id DESC
+            LIMIT $4 ''')
+
+    @classmethod
+    async def get_all_by_chat_id(cls, chat_id: int, limit: int = 50,
+                                 cursor: str | None = None,
+                                 with_authors: bool = False,
+                                 raw: bool = False) -> list | None:
+        '''
+        страница истории чата: limit сообщений старше cursor (или самые новые),
+        в хронологическом порядке; курсор следующей страницы - res[0].cursor()
+        raw - записи asyncpg как есть, без объектов Message
+        '''
+        if cursor is None:
+            query = cls._q_get_all_by_chat_id
+            res = await _DataBase.execute_query(query, chat_id, limit, fetch=True, readonly=True)
+        else:
+            query = cls._q_get_all_by_chat_id_page
+            res = await _DataBase.execute_query(query, chat_id, *decode_cursor(cursor), limit, fetch=True, readonly=True)
+        if res is None or len(res) == 0:
+            return None
+        if raw:
+            return res[::-1]
+        res = list(map(lambda x: Message(*x), reversed(res)))
+        if with_authors:
+            await _attach_authors(res, 'user_id')
+        return res
+
+    _q_export_by_chat_id = statements.register('message.export_by_chat_id', '''
+        SELECT id, chat_id, user_id, parent_id, mes_text, sends_time, seq
+        FROM message
+        WHERE chat_id = $1
+        ORDER BY sends_time, id
+        LIMIT $2 ''')
+    _q_export_by_chat_id_page = statements.register('message.export_by_chat_id_page', '''
+        SELECT id, chat_id, user_id, parent_id, mes_text, sends_time, seq
+        FROM message
+        WHERE chat_id = $1 AND (sends_time, id) > ($2, $3)
+        ORDER BY sends_time, id
+        LIMIT $4 ''')
+
+    @classmethod
+    async def iter_chunks_by_chat_id(cls, chat_id: int, chunk_size: int = 1000):
+        ''' история чата пачками записей (для экспорта) '''
+        async for chunk in _DataBase.keyset_chunks(cls._q_export_by_chat_id, cls._q_export_by_chat_id_page,
+                                                   chat_id, key=('sends_time', 'id'), chunk_size=chunk_size):
+            yield chunk
+
+    _q_iter_by_chat_id = statements.register('message.iter_by_chat_id', '''
+        SELECT id, chat_id, user_id, parent_id, mes_text, sends_time, seq
+        FROM message
+        WHERE chat_id = $1
+        ORDER BY sends_time, id ''')
+
+    @classmethod
+    async def iter_by_chat_id(cls, chat_id: int, raw: bool = False, prefetch: int = 1000):
+        ''' вся история чата потоком (серверный курсор), от старых к новым '''
+        query = cls._q_iter_by_chat_id
+        async for record in _DataBase.stream(query, chat_id, prefetch=prefetch):
+            yield record if raw else Message(*record)
 
 
 class Post(object):
     '''
     класс описывает пост
     '''
+    __slots__ = ('id', 'user_id', 'title', 'publication_date', 'last_edit_date', 'post_text', 'image',
+                 '_author', '_comments', '_comment_count')
+
+    # автор поста User (данные о нём непосредственно в запросе не получаются)
+    author = _LazyField(_none)
+    # коменты опять же получаем отдельно (load_comments: последние несколько + счётчик)
+    comments = _LazyField(_none)
+    comment_count = _LazyField(_none)
 
     def __init__(self,
                  id: int = 0,
@@ -351,80 +1194,298 @@ class Post(object):
         self.last_edit_date = last_edit_date
         self.post_text = post_text
         self.image = image
-        # автор поста User (данные о нём непосредственно в запросе не получаются)
-        self.author: User | None = None
-        # коменты опять же получаем отдельно
-        self.comments = None
 
     def tup(self) -> tuple:
-        last_edit_date: str | None
-        if self.last_edit_date is None:
-            last_edit_date = None
-        else:
-            last_edit_date = str(self.last_edit_date)
         return (self.user_id,
                 self.title,
-                str(self.publication_date),
-                last_edit_date,
+                self.publication_date,
+                self.last_edit_date,
                 self.post_text,
                 self.image,)
 
     def __repr__(self):
         return f'<Post {self.title}>'
 
+    def image_url(self, variant: str | None = 'medium') -> str | None:
+        ''' в ленте - уменьшенная копия, оригинал по variant=None '''
+        return media_url(self.image, variant)
+
+    def cursor(self) -> str:
+        return encode_cursor(self.publication_date, self.id)
+
+    _q_add = statements.register('post.add', '''
+        INSERT INTO post (user_id, title, publication_date, last_edit_date, post_text, image)  
+        VALUES ($1, $2, $3, $4, $5, $6)
+        RETURNING id ''')
+
     @classmethod
     async def add(cls, post):
-        query = ''' INSERT INTO post (user_id, title, publication_date, last_edit_date, post_text, image)  
-        VALUES ($1, '$2', '$3', '$4', '$5', '$6') '''
-        return await _DataBase.execute_query(query, *post.tup(), execute=True)
+        query = cls._q_add
+        post.id = await _DataBase.execute_query(query, *post.tup(), fetchval=True)
+        await cls._fan_out(post)
+        return post.id
+
+    _q_mark_pull_author = statements.register('post.mark_pull_author', '''
+        INSERT INTO timeline_pull_author (user_id) VALUES ($1)
+            ON CONFLICT DO NOTHING ''')
+    _q_followers = statements.register('post.followers', '''
+        SELECT follower_id FROM follows WHERE followed_id = $1 ''')
 
     @classmethod
-    async def get_posts_by_user_id(cls, user_id: int) -> list | None:
-        query = ''' SELECT * FROM post 
-        WHERE user_id = $1 
-        ORDER BY publication_date DESC '''
-        res = await _DataBase.execute_query(query, user_id, fetch=True)
-        return list(map(lambda x: Post(*x), res))
+    async def _fan_out(cls, post):
+        '''
+        fan-out-on-write: id поста попадает в ленты подписчиков;
+        у авторов с числом подписчиков больше TIMELINE_FANOUT_LIMIT
+        посты подмешиваются при чтении (fan-out-on-read)
+        '''
+        if await graph.follower_count(post.user_id) > _timeline_fanout_limit:
+            query = cls._q_mark_pull_author
+            await _DataBase.execute_query(query, post.user_id, execute=True)
+            return
+        query = cls._q_followers
+        res = await _DataBase.execute_query(query, post.user_id, fetch=True, readonly=True)
+        await _timeline.push([row[0] for row in res], post.id, post.user_id, post.publication_date)
+
+    _q_is_pull_author = statements.register('post.is_pull_author', '''
+        SELECT EXISTS (SELECT 1 FROM timeline_pull_author WHERE user_id = $1) ''')
 
     @classmethod
-    async def get_followed_posts(cls, user_id: int) -> list | None:
-        query = ''' SELECT id, user_id, title, publication_date, last_edit_date, post_text, image 
-        FROM post INNER JOIN follows ON post.user_id =  follows.followed_id 
-        WHERE follows.follower_id = $1 
-        ORDER BY publication_date DESC'''
-        res = await _DataBase.execute_query(query, user_id, fetch=True)
-        return list(map(lambda x: Post(*x), res))
+    async def _is_pull_author(cls, user_id: int) -> bool:
+        query = cls._q_is_pull_author
+        return await _DataBase.execute_query(query, user_id, fetchval=True, readonly=True)
+
+    _q_backfill_timeline = statements.register('post.backfill_timeline', '''
+        SELECT publication_date, id, user_id FROM post
+        WHERE user_id = $1
+        ORDER BY publication_date DESC, id DESC
+        LIMIT $2 ''')
+
+    @classmethod
+    async def backfill_timeline(cls, follower_id: int, followed_id: int):
+        ''' новая подписка: последние посты автора попадают в ленту подписчика '''
+        if not await _timeline.has(follower_id) or await cls._is_pull_author(followed_id):
+            return
+        query = cls._q_backfill_timeline
+        res = await _DataBase.execute_query(query, followed_id, _timeline_backfill, fetch=True, readonly=True)
+        await _timeline.backfill(follower_id, [tuple(row) for row in res])
+
+    _q_rebuild_timeline = statements.register('post.rebuild_timeline', '''
+        SELECT publication_date, post.id, post.user_id
+        FROM post INNER JOIN follows ON post.user_id = follows.followed_id
+        WHERE follows.follower_id = $1
+        AND post.user_id NOT IN (SELECT user_id FROM timeline_pull_author)
+        ORDER BY publication_date DESC, post.id DESC
+        LIMIT $2 ''')
+
+    @classmethod
+    async def _rebuild_timeline(cls, user_id: int):
+        ''' строит ленту заново из follows + post (память после рестарта, новый пользователь) '''
+        query = cls._q_rebuild_timeline
+        res = await _DataBase.execute_query(query, user_id, _timeline_capacity, fetch=True, readonly=True)
+        await _timeline.backfill(user_id, [tuple(row) for row in res])
+
+    _q_get_pulled_entries = statements.register('post.get_pulled_entries', '''
+        SELECT publication_date, id FROM post
+            WHERE user_id IN (SELECT follows.followed_id FROM follows
+                              JOIN timeline_pull_author ON timeline_pull_author.user_id = follows.followed_id
+                              WHERE follows.follower_id = $1)
+            ORDER BY publication_date DESC, id DESC
+            LIMIT $2 ''')
+    _q_get_pulled_entries_page = statements.register('post.get_pulled_entries_page', '''
+        SELECT publication_date, id FROM post
+            WHERE user_id IN (SELECT follows.followed_id FROM follows
+                              JOIN timeline_pull_author ON timeline_pull_author.user_id = follows.followed_id
+                              WHERE follows.follower_id = $1)
+            AND (publication_date, id) < ($2, $3)
+            ORDER BY publication_date DESC, id DESC
+            LIMIT $4 ''')
+
+    @classmethod
+    async def _get_pulled_entries(cls, user_id: int, limit: int,
+                                  before: tuple[datetime, int] | None) -> list:
+        ''' посты "популярных" авторов, на которых подписан user_id '''
+        if before is None:
+            query = cls._q_get_pulled_entries
+            res = await _DataBase.execute_query(query, user_id, limit, fetch=True, readonly=True)
+        else:
+            query = cls._q_get_pulled_entries_page
+            res = await _DataBase.execute_query(query, user_id, *before, limit, fetch=True, readonly=True)
+        return [tuple(row) for row in res]
+
+    _q_get_by_ids = statements.register('post.get_by_ids', '''
+        SELECT id, user_id, title, publication_date, last_edit_date, post_text, image, comment_count
+        FROM post WHERE id = ANY($1::int[]) ''')
+
+    @classmethod
+    async def get_by_ids(cls, post_ids: list[int]) -> list:
+        ''' посты (с comment_count) в порядке post_ids (отсутствующие пропускаются) '''
+        query = cls._q_get_by_ids
+        res = await _DataBase.execute_query(query, post_ids, fetch=True, readonly=True)
+        by_id = {}
+        for row in res:
+            post = Post(*row[:7])
+            post.comment_count = row[7]
+            by_id[post.id] = post
+        return [by_id[post_id] for post_id in post_ids if post_id in by_id]
+
+    _q_get_posts_by_user_id = statements.register('post.get_posts_by_user_id', '''
+        SELECT id, user_id, title, publication_date, last_edit_date, post_text, image
+            FROM post
+            WHERE user_id = $1
+            ORDER BY publication_date DESC, id DESC
+            LIMIT $2 ''')
+    _q_get_posts_by_user_id_page = statements.register('post.get_posts_by_user_id_page', '''
+        SELECT id, user_id, title, publication_date, last_edit_date, post_text, image
+            FROM post
+            WHERE user_id = $1 AND (publication_date, id) < ($2, $3)
+            ORDER BY publication_date DESC, id DESC
+            LIMIT $4 ''')
+
+    @classmethod
+    async def get_posts_by_user_id(cls, user_id: int, limit: int = 20,
+                                   cursor: str | None = None,
+                                   with_authors: bool = False,
+                                   raw: bool = False) -> list | None:
+        if cursor is None:
+            query = cls._q_get_posts_by_user_id
+            res = await _DataBase.execute_query(query, user_id, limit, fetch=True, readonly=True)
+        else:
+            query = cls._q_get_posts_by_user_id_page
+            res = await _DataBase.execute_query(query, user_id, *decode_cursor(cursor), limit, fetch=True, readonly=True)
+        if raw:
+            return res
+        res = list(map(lambda x: Post(*x), res))
+        if with_authors:
+            await _attach_authors(res, 'user_id')
+        return res
 
     @classmethod
-    async def get_all_posts(cls) -> list | None:
-        query = ''' SELECT * FROM post
-        ORDER BY publication_date DESC '''
-        res = await _DataBase.execute_query(query, fetch=True)
+    async def get_followed_posts(cls, user_id: int, limit: int = 20,
+                                 cursor: str | None = None,
+                                 with_authors: bool = False) -> list | None:
+        '''
+        домашняя лента: материализованная лента (fan-out-on-write)
+        + посты популярных авторов (fan-out-on-read), слитые по (publication_date, id)
+        '''
+        before = None if cursor is None else decode_cursor(cursor)
+        if not await _timeline.has(user_id):
+            await cls._rebuild_timeline(user_id)
+        entries = set(await _timeline.get(user_id, limit, before))
+        entries.update(await cls._get_pulled_entries(user_id, limit, before))
+        page = sorted(entries, reverse=True)[:limit]
+        res = await cls.get_by_ids([post_id for _, post_id in page])
+        if with_authors:
+            await _attach_authors(res, 'user_id')
+        return res
+
+    _q_get_all_posts = statements.register('post.get_all_posts', '''
+        SELECT id, user_id, title, publication_date, last_edit_date, post_text, image
+            FROM post
+            ORDER BY publication_date DESC, id DESC
+            LIMIT $1 ''')
+    _q_get_all_posts_page = statements.register('post.get_all_posts_page', '''
+        SELECT id, user_id, title, publication_date, last_edit_date, post_text, image
+            FROM post
+            WHERE (publication_date, id) < ($1, $2)
+            ORDER BY publication_date DESC, id DESC
+            LIMIT $3 ''')
+
+    @classmethod
+    async def get_all_posts(cls, limit: int = 20, cursor: str | None = None,
+                            with_authors: bool = False, raw: bool = False) -> list | None:
+        if cursor is None:
+            query = cls._q_get_all_posts
+            res = await _DataBase.execute_query(query, limit, fetch=True, readonly=True)
+        else:
+            query = cls._q_get_all_posts_page
+            res = await _DataBase.execute_query(query, *decode_cursor(cursor), limit, fetch=True, readonly=True)
         if res is None or len(res) == 0:
             return None
-        return list(map(lambda x: Post(*x), res))
+        if raw:
+            return res
+        res = list(map(lambda x: Post(*x), res))
+        if with_authors:
+            await _attach_authors(res, 'user_id')
+        return res
+
+    _q_export_by_user_id = statements.register('post.export_by_user_id', '''
+        SELECT id, user_id, title, publication_date, last_edit_date, post_text, image
+        FROM post
+        WHERE user_id = $1
+        ORDER BY publication_date, id
+        LIMIT $2 ''')
+    _q_export_by_user_id_page = statements.register('post.export_by_user_id_page', '''
+        SELECT id, user_id, title, publication_date, last_edit_date, post_text, image
+        FROM post
+        WHERE user_id = $1 AND (publication_date, id) > ($2, $3)
+        ORDER BY publication_date, id
+        LIMIT $4 ''')
+
+    @classmethod
+    async def iter_chunks_by_user_id(cls, user_id: int, chunk_size: int = 1000):
+        ''' все посты пользователя пачками записей (для экспорта) '''
+        async for chunk in _DataBase.keyset_chunks(cls._q_export_by_user_id, cls._q_export_by_user_id_page,
+                                                   user_id, key=('publication_date', 'id'),
+                                                   chunk_size=chunk_size):
+            yield chunk
+
+    @classmethod
+    async def load_authors(cls, posts: list):
+        ''' заполняет post.author для страницы постов одним запросом '''
+        await _attach_authors(posts, 'user_id')
+
+    @classmethod
+    async def load_comments(cls, posts: list, with_authors: bool = False, per_post: int | None = None):
+        '''
+        заполняет post.comments (последние per_post) и post.comment_count
+        для страницы постов одним запросом; остальные - Comment.get_page_by_post_id
+        '''
+        if not posts:
+            return
+        if per_post is None:
+            per_post = app.config.get('COMMENTS_PREVIEW', 3)
+        loaded = await Comment.get_latest_by_post_ids([post.id for post in posts], per_post, with_authors)
+        for post in posts:
+            post.comment_count, post.comments = loaded.get(post.id, (0, []))
+
+    _q_get_post_by_id = statements.register('post.get_post_by_id', '''
+        SELECT id, user_id, title, publication_date, last_edit_date, post_text, image
+        FROM post WHERE id = $1 ''')
 
     @classmethod
     async def get_post_by_id(cls, post_id: int):
-        query = ''' SELECT * FROM post WHERE id = $1 '''
-        res = await _DataBase.execute_query(query, post_id, fetchrow=True)
+        query = cls._q_get_post_by_id
+        res = await _DataBase.execute_query(query, post_id, fetchrow=True, readonly=True)
         if res is None:
             return None
         return Post(* res)
 
+    _q_update = statements.register('post.update', '''
+        UPDATE post
+        SET title = $1, post_text = $2, last_edit_date = $3
+        WHERE id = $4 ''')
+
     @classmethod
     async def update(cls, post):
-        query = ''' UPDATE post
-        SET title = '$1', post_text = '$2', last_edit_date = '$3',
-        WHERE id = $4 '''
+        query = cls._q_update
         return await _DataBase.execute_query(query, post.title, post.post_text,
                                              post.last_edit_date, post.id, execute=True)
 
+    _q_search_by_text = statements.register('post.search_by_text', '''
+        SELECT id, user_id, title, publication_date, last_edit_date, post_text, image
+        FROM post, websearch_to_tsquery('simple', $1) q
+        WHERE search_vector @@ q
+        ORDER BY ts_rank_cd(search_vector, q) DESC, id DESC
+        LIMIT $2 OFFSET $3 ''')
+
     @classmethod
-    async def search_by_text(cls, text: str) -> list | None:
-        query = ''' SELECT * FROM post
-        WHERE title LIKE '%$1%' OR post_text LIKE '%$1%'  '''
-        res = await _DataBase.execute_query(query, text, fetch=True)
+    async def search_by_text(cls, text: str, limit: int = 20, offset: int = 0) -> list | None:
+        '''
+        полнотекстовый поиск по post.search_vector (gin-индекс),
+        результаты ранжированы, заголовок весит больше текста
+        '''
+        query = cls._q_search_by_text
+        res = await _DataBase.execute_query(query, text, limit, offset, fetch=True, readonly=True)
         if res is None or len(res) == 0:
             return None
         return list(map(lambda x: Post(*x), res))
@@ -434,6 +1495,10 @@ class Comment(object):
     '''
     класс описывающий коментарий к посту
     '''
+    __slots__ = ('id', 'post_id', 'commentator_id', 'comment_text', 'sends_time', '_author')
+
+    # автор коммента
+    author = _LazyField(_none)
 
     def __init__(self,
                  id: int = 0,
@@ -446,26 +1511,204 @@ class Comment(object):
         self.commentator_id = commentator_id
         self.comment_text = comment_text
         self.sends_time = sends_time
-        # автор коммента
-        self.author: User | None = None
 
     def tup(self) -> tuple:
         return (self.post_id,
                 self.commentator_id,
                 self.comment_text,
-                str(self.sends_time),)
+                self.sends_time,)
+
+    def cursor(self) -> str:
+        return encode_cursor(self.sends_time, self.id)
+
+    def to_dict(self) -> dict:
+        return {'id': self.id,
+                'post_id': self.post_id,
+                'commentator_id': self.commentator_id,
+                'comment_text': self.comment_text,
+                'sends_time': self.sends_time.isoformat()}
+
+    _q_lock_posts = statements.register('comment.lock_posts', '''
+        SELECT id FROM post WHERE id = ANY($1::int[]) ORDER BY id FOR UPDATE ''')
+    _q_add_counts = statements.register('comment.add_counts', '''
+        UPDATE post
+        SET comment_count = post.comment_count + c.n
+        FROM unnest($1::int[], $2::int[]) AS c(id, n)
+        WHERE post.id = c.id ''')
+
+    @staticmethod
+    async def _insert_rows(con: Connection, rows: list) -> list[int]:
+        ''' вставка пачки + post.comment_count в той же транзакции '''
+        per_post: dict[int, int] = {}
+        for row in rows:
+            per_post[row[0]] = per_post.get(row[0], 0) + 1
+        post_ids = sorted(per_post)
+        # блокируем в порядке id, чтобы параллельные пачки не взаимоблокировались
+        await _DataBase.run(con, Comment._q_lock_posts, post_ids, fetch=True)
+        await _DataBase.run(con, Comment._q_add_counts, post_ids,
+                            [per_post[post_id] for post_id in post_ids], execute=True)
+        ids = await _DataBase.next_ids(con, 'comment', len(rows))
+        await con.copy_records_to_table('comment',
+                                        records=[(id, *row) for id, row in zip(ids, rows)],
+                                        columns=('id', 'post_id', 'commentator_id', 'comment_text', 'sends_time'))
+        return ids
 
     @classmethod
     async def add(cls, comment):
-        query = """ INSERT INTO comment (post_id, commentator_id, parent_id, comment_text, sends_time) 
-        VALUES ($1, $2, $3, '$4', '$5') """
-        return await _DataBase.execute_query(query, comment.tup(), execute=True)
+        _DataBase.mark_write()
+        comment.id = await _comment_writer.submit(comment.tup())
+        return comment.id
 
     @classmethod
-    async def get_all_by_post_id(cls, post_id: int) -> list | None:
-        query = ''' SELECT * FROM comment WHERE post_id = $1 '''
-        res = await _DataBase.execute_query(query, post_id, fetch=True)
+    async def add_many(cls, comments: list) -> list[int]:
+        async with _DataBase.transaction() as con:
+            ids = await cls._insert_rows(con, [comment.tup() for comment in comments])
+        for comment, id in zip(comments, ids):
+            comment.id = id
+        return ids
+
+    _q_get_all_by_post_id = statements.register('comment.get_all_by_post_id', '''
+        SELECT id, post_id, commentator_id, comment_text, sends_time
+        FROM comment WHERE post_id = $1 ''')
+
+    @classmethod
+    async def get_all_by_post_id(cls, post_id: int, with_authors: bool = False,
+                                 raw: bool = False) -> list | None:
+        query = cls._q_get_all_by_post_id
+        res = await _DataBase.execute_query(query, post_id, fetch=True, readonly=True)
         if res is None or len(res) == 0:
             return None
-        return list(map(lambda x: Comment(*x), res))
-    
+        if raw:
+            return res
+        res = list(map(lambda x: Comment(*x), res))
+        if with_authors:
+            await _attach_authors(res, 'commentator_id')
+        return res
+
+    _q_export_by_commentator_id = statements.register('comment.export_by_commentator_id', '''
+        SELECT id, post_id, commentator_id, comment_text, sends_time
+        FROM comment
+        WHERE commentator_id = $1
+        ORDER BY sends_time, id
+        LIMIT $2 ''')
+    _q_export_by_commentator_id_page = statements.register('comment.export_by_commentator_id_page', '''
+        SELECT id, post_id, commentator_id, comment_text, sends_time
+        FROM comment
+        WHERE commentator_id = $1 AND (sends_time, id) > ($2, $3)
+        ORDER BY sends_time, id
+        LIMIT $4 ''')
+
+    @classmethod
+    async def iter_chunks_by_commentator_id(cls, user_id: int, chunk_size: int = 1000):
+        ''' все комментарии пользователя пачками записей (для экспорта) '''
+        async for chunk in _DataBase.keyset_chunks(cls._q_export_by_commentator_id,
+                                                   cls._q_export_by_commentator_id_page,
+                                                   user_id, key=('sends_time', 'id'), chunk_size=chunk_size):
+            yield chunk
+
+    # последние per_post комментариев каждого поста + счётчик из post, одним запросом;
+    # посты без комментариев тоже возвращаются (строка с NULL вместо комментария)
+    _q_get_latest_by_post_ids = statements.register('comment.get_latest_by_post_ids', '''
+        SELECT post.id, post.comment_count,
+               c.id, c.commentator_id, c.comment_text, c.sends_time
+        FROM post
+        LEFT JOIN (
+            SELECT id, post_id, commentator_id, comment_text, sends_time,
+                   row_number() OVER (PARTITION BY post_id ORDER BY sends_time DESC, id DESC) AS rn
+            FROM comment WHERE post_id = ANY($1::int[])
+        ) c ON c.post_id = post.id AND c.rn <= $2
+        WHERE post.id = ANY($1::int[])
+        ORDER BY post.id, c.sends_time, c.id ''')
+
+    @classmethod
+    async def get_latest_by_post_ids(cls, post_ids: list[int], per_post: int = 3,
+                                     with_authors: bool = False) -> dict:
+        ''' {post_id: (comment_count, [последние per_post Comment от старых к новым])} '''
+        query = cls._q_get_latest_by_post_ids
+        res = await _DataBase.execute_query(query, post_ids, per_post, fetch=True, readonly=True)
+        by_post: dict[int, tuple[int, list]] = {}
+        comments = []
+        for row in res:
+            if row[0] not in by_post:
+                by_post[row[0]] = (row[1], [])
+            if row[2] is not None:
+                comment = Comment(row[2], row[0], row[3], row[4], row[5])
+                by_post[row[0]][1].append(comment)
+                comments.append(comment)
+        if with_authors:
+            await _attach_authors(comments, 'commentator_id')
+        return by_post
+
+    _q_get_page_by_post_id = statements.register('comment.get_page_by_post_id', '''
+        SELECT id, post_id, commentator_id, comment_text, sends_time
+        FROM comment
+        WHERE post_id = $1
+        ORDER BY sends_time DESC, id DESC
+        LIMIT $2 ''')
+    _q_get_page_by_post_id_page = statements.register('comment.get_page_by_post_id_page', '''
+        SELECT id, post_id, commentator_id, comment_text, sends_time
+        FROM comment
+        WHERE post_id = $1 AND (sends_time, id) < ($2, $3)
+        ORDER BY sends_time DESC, id DESC
+        LIMIT $4 ''')
+
+    @classmethod
+    async def get_page_by_post_id(cls, post_id: int, limit: int = 20,
+                                  cursor: str | None = None,
+                                  with_authors: bool = False) -> list:
+        ''' "показать ещё": страница от новых к старым, курсор - последний комментарий страницы '''
+        if cursor is None:
+            query = cls._q_get_page_by_post_id
+            res = await _DataBase.execute_query(query, post_id, limit, fetch=True, readonly=True)
+        else:
+            query = cls._q_get_page_by_post_id_page
+            res = await _DataBase.execute_query(query, post_id, *decode_cursor(cursor), limit,
+                                                fetch=True, readonly=True)
+        res = list(map(lambda x: Comment(*x), res))
+        if with_authors:
+            await _attach_authors(res, 'commentator_id')
+        return res
+
+
+# write-behind батчинг вставок (см. app.batching)
+_batch_size = app.config.get('WRITE_BATCH_MAX_SIZE', 500)
+_batch_delay = app.config.get('WRITE_BATCH_MAX_DELAY', 0.005)
+_message_writer = BatchWriter(_DataBase.transaction, Message._insert_rows, _batch_size, _batch_delay)
+_comment_writer = BatchWriter(_DataBase.transaction, Comment._insert_rows, _batch_size, _batch_delay)
+_follows_writer = BatchWriter(_DataBase.transaction, Follows._insert_rows, _batch_size, _batch_delay)
+_user_in_chat_writer = BatchWriter(_DataBase.transaction, UserInChat._insert_rows, _batch_size, _batch_delay)
+
+
+async def drain_writers():
+    for writer in (_message_writer, _comment_writer, _follows_writer, _user_in_chat_writer):
+        await writer.drain()
+
+
+# события между воркерами (см. app.events, serve.py): чат, инвалидация кэшей, ленты, граф
+if app.config.get('EVENT_BUS', 'memory') == 'postgres':
+    bus = PostgresEventBus(_DataBase, _DataBase._dsn(),
+                           app.config.get('EVENT_BUS_CHANNEL', 'app_events'),
+                           app.config.get('EVENT_BUS_MAX_PAYLOAD', 7000),
+                           app.config.get('EVENT_BUS_BATCH_SIZE', 100))
+else:
+    bus = InMemoryEventBus()
+hub.attach_bus(bus)
+set_event_bus(bus)
+
+
+# домашние ленты (см. app.timeline)
+_timeline_capacity = app.config.get('TIMELINE_CAPACITY', 800)
+_timeline_backfill = app.config.get('TIMELINE_BACKFILL', 50)
+_timeline_fanout_limit = app.config.get('TIMELINE_FANOUT_LIMIT', 10000)
+if app.config.get('TIMELINE_STORE', 'postgres') == 'memory':
+    _timeline = ReplicatedTimelineStore(InMemoryTimelineStore(_timeline_capacity,
+                                                              app.config.get('TIMELINE_MAX_USERS', 10000)),
+                                        bus)
+else:
+    _timeline = PostgresTimelineStore(_DataBase, _timeline_capacity)
+
+graph = SocialGraph(_DataBase,
+                    app.config.get('GRAPH_HOT_FOLLOWERS', 10000),
+                    app.config.get('GRAPH_HOT_CACHE_SIZE', 100),
+                    app.config.get('GRAPH_HOT_CACHE_TTL', 600.0))
+graph.attach_bus(bus)
@@ -0,0 +1,6 @@
+
+from quart import Blueprint
+
+bp = Blueprint('monitoring', __name__)
+
+from app.monitoring import routes
@@ -0,0 +1,49 @@
+
+from app import metrics
+from app.cache import cache_stats
+from app.hashing import hasher
+from app.models import _DataBase, bus, graph
+from app.ratelimit import limiter
+from app.statements import statements
+from app.storage import media
+
+# import monitoring blueprint
+from app.monitoring import bp
+
+# ключи stats(), которые только растут - отдаются как counter, остальные как gauge
+_CACHE_COUNTERS = {'hits', 'misses', 'evictions', 'shared_hits', 'shared_misses'}
+_MEDIA_COUNTERS = {'rejected', 'deduplicated'}
+_BUS_COUNTERS = {'sent', 'received', 'send_errors'}
+
+
+def _add_stats(out: metrics.Exposition, prefix: str, help: str, stats: dict, counters: set,
+               labels: dict | None = None):
+    for key, value in stats.items():
+        add = out.counter if key in counters else out.gauge
+        add(f'{prefix}_{key}', f'{help} {key}', value, labels)
+
+
+@bp.route('/metrics')
+async def prometheus_metrics():
+    pool = _DataBase.pool_stats()
+    out = metrics.Exposition()
+    out.gauge('db_pool_size', 'Open connections', pool['size'])
+    out.gauge('db_pool_in_use', 'Connections checked out', pool['in_use'])
+    out.gauge('db_pool_idle', 'Idle connections', pool['idle'])
+    out.counter('db_pool_acquire_timeouts', 'Acquire timeouts since start', pool['acquire_timeouts'])
+    out.counter('bcrypt_rejected', 'Hash requests shed by admission control', hasher.rejected)
+    for name, count in limiter.rejected.items():
+        out.counter('rate_limited', 'Requests rejected by the rate limiter', count, {'limit': name})
+    for name, stats in cache_stats().items():
+        _add_stats(out, 'cache', 'Cache', stats, _CACHE_COUNTERS, {'cache': name})
+    _add_stats(out, 'cache', 'Cache', graph.stats(), _CACHE_COUNTERS, {'cache': 'graph_hot'})
+    _add_stats(out, 'media', 'Media', media.stats(), _MEDIA_COUNTERS)
+    _add_stats(out, 'event_bus', 'Event bus', bus.stats(), _BUS_COUNTERS)
+    for name, stats in statements.stats().items():
+        labels = {'statement': name}
+        out.counter('db_statement_calls', 'Executions of a prepared statement', stats['calls'], labels)
+        out.counter('db_statement_errors', 'Failed executions', stats['errors'], labels)
+        out.counter('db_statement_seconds_total', 'Total execution time', stats['total_time'], labels)
+        out.gauge('db_statement_seconds_max', 'Slowest execution', stats['max_time'], labels)
+    body = metrics.render() + out.render()
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4'}
@@ -0,0 +1,19 @@
+import base64
+from datetime import datetime
+
+
+def encode_cursor(sort_key: datetime, row_id: int) -> str:
+    ''' непрозрачный курсор (sort_key, id) для keyset-пагинации '''
+    raw = f'{sort_key.isoformat()}|{row_id}'
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    ''' ValueError, если курсор испорчен '''
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+        sort_key, row_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(sort_key), int(row_id)
+    except (UnicodeError, ValueError) as ex:
+        raise ValueError(f'invalid cursor: {cursor!r}') from ex
@@ -0,0 +1,265 @@
+import asyncio
+import time
+
+from app import app
+from app.hub import hub, ChatHub
+
+
+class PresenceBackend(object):
+    '''
+    состояние присутствия; общий вариант (например redis) нужен,
+    когда воркеров несколько - интерфейс тот же. время - time.time()
+    '''
+
+    async def heartbeat(self, user_id: int, expires_at: float) -> bool:
+        ''' True, если пользователь был offline '''
+        raise NotImplementedError
+
+    async def connect(self, user_id: int):
+        ''' +1 открытое соединение пользователя (во всех воркерах) '''
+        raise NotImplementedError
+
+    async def disconnect(self, user_id: int) -> bool:
+        ''' -1 соединение; True и offline, если соединений не осталось '''
+        raise NotImplementedError
+
+    async def online(self, user_ids: list[int]) -> set[int]:
+        raise NotImplementedError
+
+    async def join_chat(self, chat_id: int, user_id: int):
+        ''' +1 соединение пользователя с чатом '''
+        raise NotImplementedError
+
+    async def leave_chat(self, chat_id: int, user_id: int) -> bool:
+        ''' -1 соединение; True, если пользователь закрыл чат везде '''
+        raise NotImplementedError
+
+    async def chat_users(self, chat_id: int) -> set[int]:
+        ''' пользователи с открытым чатом '''
+        raise NotImplementedError
+
+    async def set_typing(self, chat_id: int, user_id: int, expires_at: float) -> bool:
+        ''' True, если пользователь только начал печатать '''
+        raise NotImplementedError
+
+    async def clear_typing(self, chat_id: int, user_id: int) -> bool:
+        raise NotImplementedError
+
+    async def typing(self, chat_id: int) -> set[int]:
+        raise NotImplementedError
+
+    async def expire(self, now: float) -> set[int]:
+        ''' удаляет просроченное, возвращает чаты, где что-то изменилось '''
+        raise NotImplementedError
+
+
+class InMemoryPresenceBackend(PresenceBackend):
+    def __init__(self):
+        self._online: dict[int, float] = {}
+        self._connections: dict[int, int] = {}
+        # chat_id -> {user_id: число соединений}
+        self._chats: dict[int, dict[int, int]] = {}
+        # user_id -> чаты, где он открыт (для рассылки при уходе в offline)
+        self._user_chats: dict[int, set[int]] = {}
+        self._typing: dict[int, dict[int, float]] = {}
+
+    async def heartbeat(self, user_id: int, expires_at: float) -> bool:
+        was_offline = self._online.get(user_id, 0) <= time.time()
+        self._online[user_id] = expires_at
+        return was_offline
+
+    async def connect(self, user_id: int):
+        self._connections[user_id] = self._connections.get(user_id, 0) + 1
+
+    async def disconnect(self, user_id: int) -> bool:
+        left = self._connections.get(user_id, 0) - 1
+        if left > 0:
+            self._connections[user_id] = left
+            return False
+        self._connections.pop(user_id, None)
+        self._online.pop(user_id, None)
+        return True
+
+    async def online(self, user_ids: list[int]) -> set[int]:
+        now = time.time()
+        return {user_id for user_id in user_ids if self._online.get(user_id, 0) > now}
+
+    async def join_chat(self, chat_id: int, user_id: int):
+        users = self._chats.setdefault(chat_id, {})
+        users[user_id] = users.get(user_id, 0) + 1
+        self._user_chats.setdefault(user_id, set()).add(chat_id)
+
+    async def leave_chat(self, chat_id: int, user_id: int) -> bool:
+        users = self._chats.get(chat_id)
+        if users is None or user_id not in users:
+            return True
+        if users[user_id] > 1:
+            users[user_id] -= 1
+            return False
+        del users[user_id]
+        if not users:
+            del self._chats[chat_id]
+        chats = self._user_chats.get(user_id)
+        if chats is not None:
+            chats.discard(chat_id)
+            if not chats:
+                del self._user_chats[user_id]
+        return True
+
+    async def chat_users(self, chat_id: int) -> set[int]:
+        return set(self._chats.get(chat_id, ()))
+
+    async def set_typing(self, chat_id: int, user_id: int, expires_at: float) -> bool:
+        typing = self._typing.setdefault(chat_id, {})
+        started = user_id not in typing
+        typing[user_id] = expires_at
+        return started
+
+    async def clear_typing(self, chat_id: int, user_id: int) -> bool:
+        typing = self._typing.get(chat_id)
+        if typing is None or typing.pop(user_id, None) is None:
+            return False
+        if not typing:
+            del self._typing[chat_id]
+        return True
+
+    async def typing(self, chat_id: int) -> set[int]:
+        return set(self._typing.get(chat_id, ()))
+
+    async def expire(self, now: float) -> set[int]:
+        changed = set()
+        for user_id in [user_id for user_id, expires_at in self._online.items() if expires_at <= now]:
+            del self._online[user_id]
+            changed.update(self._user_chats.get(user_id, ()))
+        for chat_id, typing in list(self._typing.items()):
+            for user_id in [user_id for user_id, expires_at in typing.items() if expires_at <= now]:
+                del typing[user_id]
+                changed.add(chat_id)
+            if not typing:
+                del self._typing[chat_id]
+        return changed
+
+
+class PresenceService(object):
+    '''
+    online/typing для открытых websocket-ов чатов; без обращений к postgres
+
+    онлайн продлевается heartbeat-ом (любое сообщение клиента), истекает через ttl;
+    соединения считает backend (общий для воркеров), так что закрытие последней
+    вкладки в одном воркере не делает offline пользователя, открытого в другом;
+    изменения копятся coalesce_delay секунд и уходят в hub одним снимком на чат
+    '''
+
+    def __init__(self, backend: PresenceBackend, chat_hub: ChatHub,
+                 ttl: float = 30.0, typing_ttl: float = 5.0, coalesce_delay: float = 0.25):
+        self.backend = backend
+        self.hub = chat_hub
+        self.ttl = ttl
+        self.typing_ttl = typing_ttl
+        self.coalesce_delay = coalesce_delay
+        # соединения этого процесса: (chat_id, user_id) -> сколько вкладок;
+        # нужны только чтобы знать, в какие чаты сообщить о возвращении в online
+        self._connections: dict[tuple[int, int], int] = {}
+        self._dirty: set[int] = set()
+        self._flush_timer: asyncio.TimerHandle | None = None
+        self._flushes: set[asyncio.Task] = set()
+        self._sweeper: asyncio.Task | None = None
+
+    async def join(self, chat_id: int, user_id: int):
+        key = (chat_id, user_id)
+        self._connections[key] = self._connections.get(key, 0) + 1
+        await self.backend.connect(user_id)
+        await self.heartbeat(user_id)
+        await self.backend.join_chat(chat_id, user_id)
+        self._mark(chat_id)
+        if self._sweeper is None:
+            self._sweeper = asyncio.ensure_future(self._sweep_loop())
+
+    async def leave(self, chat_id: int, user_id: int):
+        key = (chat_id, user_id)
+        left = self._connections.get(key, 0) - 1
+        if left > 0:
+            self._connections[key] = left
+        else:
+            self._connections.pop(key, None)
+        if await self.backend.leave_chat(chat_id, user_id):
+            await self.backend.clear_typing(chat_id, user_id)
+        await self.backend.disconnect(user_id)
+        self._mark(chat_id)
+
+    async def heartbeat(self, user_id: int):
+        if await self.backend.heartbeat(user_id, time.time() + self.ttl):
+            # вернулся после истечения ttl - сообщаем в открытые им чаты
+            for chat_id, other in self._connections:
+                if other == user_id:
+                    self._mark(chat_id)
+
+    async def typing(self, chat_id: int, user_id: int):
+        ''' повторные typing в пределах typing_ttl только продлевают, без рассылки '''
+        if await self.backend.set_typing(chat_id, user_id, time.time() + self.typing_ttl):
+            self._mark(chat_id)
+
+    async def stop_typing(self, chat_id: int, user_id: int):
+        if await self.backend.clear_typing(chat_id, user_id):
+            self._mark(chat_id)
+
+    async def online(self, user_ids: list[int]) -> set[int]:
+        return await self.backend.online(user_ids)
+
+    async def chat_state(self, chat_id: int) -> dict:
+        users = await self.backend.chat_users(chat_id)
+        online = await self.backend.online(list(users))
+        typing = await self.backend.typing(chat_id)
+        return {'type': 'presence',
+                'chat_id': chat_id,
+                'online': sorted(online),
+                'typing': sorted(typing & online)}
+
+    def _mark(self, chat_id: int):
+        self._dirty.add(chat_id)
+        if self._flush_timer is None:
+            loop = asyncio.get_running_loop()
+            self._flush_timer = loop.call_later(self.coalesce_delay, self._flush_now)
+
+    def _flush_now(self):
+        self._flush_timer = None
+        dirty, self._dirty = self._dirty, set()
+        if dirty:
+            # loop держит задачи слабыми ссылками - храним до завершения
+            task = asyncio.ensure_future(self._flush(dirty))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, chat_ids: set[int]):
+        try:
+            for chat_id in chat_ids:
+                self.hub.publish(chat_id, await self.chat_state(chat_id))
+        except Exception:
+            app.logger.exception('presence flush failed')
+
+    async def _sweep_loop(self):
+        interval = min(self.ttl, self.typing_ttl) / 2
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                for chat_id in await self.backend.expire(time.time()):
+                    self._mark(chat_id)
+            except Exception:
+                app.logger.exception('presence sweep failed')
+
+    def close(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        for task in self._flushes:
+            task.cancel()
+
+
+presence = PresenceService(app.config.get('PRESENCE_BACKEND') or InMemoryPresenceBackend(),
+                           hub,
+                           app.config.get('PRESENCE_TTL', 30.0),
+                           app.config.get('PRESENCE_TYPING_TTL', 5.0),
+                           app.config.get('PRESENCE_COALESCE_DELAY', 0.25))
@@ -0,0 +1,158 @@
+import math
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from quart import request
+from quart_auth import current_user
+
+from app import app
+
+_PERIODS = {'second': 1.0, 'minute': 60.0, 'hour': 3600.0, 'day': 86400.0}
+
+
+class RateLimited(Exception):
+    ''' лимит исчерпан, повторить не раньше чем через retry_after секунд '''
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(name, retry_after)
+        self.name = name
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class Limit(object):
+    '''
+    token bucket: burst запросов сразу, дальше rate в секунду
+    '''
+    __slots__ = ('rate', 'burst')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+
+    @classmethod
+    def parse(cls, value: 'str | Limit') -> 'Limit':
+        ''' "10/minute" -> 10 запросов подряд, затем 1 раз в 6 секунд '''
+        if isinstance(value, Limit):
+            return value
+        count, _, period = value.partition('/')
+        count = float(count)
+        return cls(count / _PERIODS[period.strip()], count)
+
+    def __repr__(self):
+        return f'<Limit {self.rate:g}/s burst={self.burst:g}>'
+
+
+class RateLimitBackend(object):
+    '''
+    хранилище корзин; общий (межпроцессный) вариант, например redis,
+    реализует тот же метод атомарно на своей стороне
+    '''
+
+    async def take(self, key: str, limit: Limit, cost: float = 1.0) -> float:
+        ''' 0 - разрешено, иначе через сколько секунд появятся токены '''
+        raise NotImplementedError
+
+
+class InMemoryRateLimitBackend(RateLimitBackend):
+    '''
+    корзины в памяти процесса в порядке последнего обращения; больше max_keys
+    не бывает - вытесняется самая давно не использованная (O(1) на запрос)
+    '''
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        # key -> [tokens, updated_at]
+        self._buckets: OrderedDict[str, list] = OrderedDict()
+        self.evictions = 0
+
+    async def take(self, key: str, limit: Limit, cost: float = 1.0) -> float:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = limit.burst
+            bucket = self._buckets[key] = [tokens, now]
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+        else:
+            tokens = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+            self._buckets.move_to_end(key)
+        if tokens < cost:
+            bucket[0], bucket[1] = tokens, now
+            return (cost - tokens) / limit.rate
+        bucket[0], bucket[1] = tokens - cost, now
+        return 0.0
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RateLimiter(object):
+    '''
+    лимиты по именам (обычно endpoint), у каждого свои ключи:
+    ip - адрес клиента, user - auth_id, login - логин из формы входа
+    '''
+
+    def __init__(self, backend: RateLimitBackend, limits: dict, enabled: bool = True):
+        self.backend = backend
+        self.enabled = enabled
+        self.limits = {name: {scope: Limit.parse(value) for scope, value in scopes.items()}
+                       for name, scopes in limits.items()}
+        self.rejected: dict[str, int] = {}
+
+    async def hit(self, name: str, cost: float = 1.0, **keys):
+        '''
+        списывает по токену из корзины каждого ключа, RateLimited если хоть одна пуста;
+        keys - значения областей: ip=..., user=..., login=...
+        '''
+        if not self.enabled:
+            return
+        for scope, limit in self.limits.get(name, {}).items():
+            value = keys.get(scope)
+            if value is None:
+                continue
+            retry_after = await self.backend.take(f'{name}:{scope}:{value}', limit, cost)
+            if retry_after:
+                self.rejected[name] = self.rejected.get(name, 0) + 1
+                raise RateLimited(name, retry_after)
+
+    async def _request_keys(self) -> dict:
+        keys = {'ip': request.remote_addr}
+        if await current_user.is_authenticated:
+            keys['user'] = current_user.auth_id
+        if 'login' in self.limits.get(request.endpoint, {}):
+            form = await request.form
+            keys['login'] = form.get('login', '').strip().lower() or None
+        return keys
+
+    def limit(self, methods: tuple = ('POST',)):
+        '''
+        декоратор view: проверка до любой работы обработчика (форма, БД, bcrypt);
+        лимит берётся по request.endpoint
+        '''
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                if self.enabled and request.method in methods:
+                    await self.hit(request.endpoint, **await self._request_keys())
+                return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+# вход и регистрация ограничены по адресу и по логину (перебор паролей),
+# сообщения в websocket и загрузки картинок - по пользователю
+DEFAULT_LIMITS = {'auth.login': {'ip': '20/minute', 'login': '10/minute'},
+                  'auth.register': {'ip': '5/minute'},
+                  'chat.send': {'user': '10/second'},
+                  'media.upload': {'user': '30/minute'}}
+
+limiter = RateLimiter(app.config.get('RATE_LIMIT_BACKEND') or
+                      InMemoryRateLimitBackend(app.config.get('RATE_LIMIT_MAX_KEYS', 100000)),
+                      {**DEFAULT_LIMITS, **app.config.get('RATE_LIMITS', {})},
+                      app.config.get('RATE_LIMIT_ENABLED', True))
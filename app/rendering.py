@@ -0,0 +1,60 @@
+import hashlib
+
+from markupsafe import Markup
+from quart import Quart, Response, make_response, render_template, request
+
+from app.cache import post_card_cache
+
+# хэш исходников шаблонов: входит в ETag и ключи фрагментов,
+# чтобы после выкладки новых шаблонов не отдавать старый html
+templates_version = ''
+
+
+async def render_post_cards(posts: list) -> list[Markup]:
+    ''' html карточек постов, из кэша фрагментов где возможно '''
+    cards = []
+    for post in posts:
+        async def load(post=post):
+            return Markup(await render_template('_post_card.html', post=post))
+
+        # новый комментарий меняет comment_count, а с ним и ключ
+        key = (post.id, post.last_edit_date, post.comment_count, templates_version)
+        cards.append(await post_card_cache.get_or_load(key, load))
+    return cards
+
+
+def make_etag(*parts) -> str:
+    return hashlib.blake2b(repr((templates_version, parts)).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def not_modified(etag: str) -> bool:
+    ''' у клиента актуальная версия страницы - можно ответить 304 без рендера '''
+    # только ETag: комментарий меняет страницу, не меняя дат постов,
+    # так что If-Modified-Since здесь не годится
+    return bool(request.if_none_match) and request.if_none_match.contains_weak(etag)
+
+
+async def conditional_response(body: str, etag: str, status: int = 200) -> Response:
+    ''' ответ с ETag для следующей проверки клиентом '''
+    response = await make_response(body, status)
+    response.set_etag(etag, weak=True)
+    # страница своя у каждого пользователя, браузер перепроверяет каждый раз
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+def precompile_templates(quart_app: Quart):
+    ''' компилирует все шаблоны при старте, чтобы первый запрос не платил за компиляцию '''
+    global templates_version
+    env = quart_app.jinja_env
+    names = env.list_templates(extensions=('html',))
+    # скомпилированные шаблоны живут в env.cache, он должен вместить все
+    if env.cache is not None and env.cache.capacity < len(names):
+        quart_app.logger.warning('jinja template cache is smaller than the number of templates')
+    digest = hashlib.blake2b(digest_size=8)
+    for name in names:
+        source, _, _ = env.loader.get_source(env, name)
+        digest.update(source.encode('utf-8'))
+        env.get_template(name)
+    templates_version = digest.hexdigest()
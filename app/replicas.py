@@ -0,0 +1,102 @@
+import asyncio
+import itertools
+
+import asyncpg
+from asyncpg.pool import Pool
+
+from app import app
+
+# соединение с сервером потеряно или не получено (в отличие от ошибок самого запроса)
+CONNECTION_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.InterfaceError, asyncpg.PostgresConnectionError)
+
+
+class ReplicaLost(Exception):
+    ''' реплика отказала во время запроса; чтение можно повторить на primary '''
+    pass
+
+
+class Replica(object):
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.pool: Pool | None = None
+        self.healthy = False
+
+    def in_use(self) -> int:
+        return self.pool.get_size() - self.pool.get_idle_size()
+
+
+class ReplicaSet(object):
+    '''
+    пулы реплик только для чтения: выбор round_robin / least_loaded,
+    нездоровые реплики исключаются фоновой проверкой health_interval
+    '''
+
+    def __init__(self, dsns: list[str], strategy: str = 'round_robin',
+                 health_interval: float = 5.0, health_timeout: float = 1.0):
+        if strategy not in ('round_robin', 'least_loaded'):
+            raise ValueError(f'unknown replica strategy: {strategy}')
+        self.replicas = [Replica(dsn) for dsn in dsns]
+        self.strategy = strategy
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self._rr = itertools.count()
+        self._health_task: asyncio.Task | None = None
+        self._pool_kwargs: dict = {}
+
+    async def _connect(self, replica: Replica):
+        try:
+            replica.pool = await asyncpg.create_pool(replica.dsn, **self._pool_kwargs)
+            replica.healthy = True
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as ex:
+            app.logger.warning('replica %s unavailable: %s', replica.dsn.rsplit('@', 1)[-1], ex)
+
+    async def start(self, **pool_kwargs):
+        # реплика, недоступная при старте, не мешает воркеру подняться -
+        # пул для неё создаст проверка здоровья, когда она появится
+        self._pool_kwargs = pool_kwargs
+        for replica in self.replicas:
+            await self._connect(replica)
+        if self.replicas:
+            self._health_task = asyncio.ensure_future(self._health_loop())
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        for replica in self.replicas:
+            if replica.pool is not None:
+                await replica.pool.close()
+                replica.pool = None
+            replica.healthy = False
+
+    def choose(self) -> Replica | None:
+        healthy = [r for r in self.replicas if r.healthy and r.pool is not None]
+        if not healthy:
+            return None
+        if self.strategy == 'least_loaded':
+            return min(healthy, key=Replica.in_use)
+        return healthy[next(self._rr) % len(healthy)]
+
+    def mark_unhealthy(self, replica: Replica):
+        replica.healthy = False
+
+    async def _check(self, replica: Replica):
+        if replica.pool is None:
+            await self._connect(replica)
+            return
+        try:
+            await replica.pool.fetchval('SELECT 1', timeout=self.health_timeout)
+            replica.healthy = True
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError):
+            replica.healthy = False
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await asyncio.gather(*[self._check(r) for r in self.replicas])
+
+    def stats(self) -> list[dict]:
+        return [{'dsn': r.dsn.rsplit('@', 1)[-1],
+                 'healthy': r.healthy,
+                 'in_use': r.in_use() if r.pool is not None else 0}
+                for r in self.replicas]
@@ -0,0 +1,121 @@
+import time
+
+import asyncpg
+from asyncpg.prepared_stmt import PreparedStatement
+
+
+class StatementError(Exception):
+    ''' запросы не прошли проверку по схеме при старте '''
+    pass
+
+
+class Statement(object):
+    '''
+    именованный запрос модели; готовится один раз на каждом соединении пула,
+    типы параметров и колонок берутся из схемы при проверке на старте
+    '''
+    __slots__ = ('name', 'sql', 'param_types', 'columns', 'calls', 'errors', 'total_time', 'max_time')
+
+    def __init__(self, name: str, sql: str):
+        self.name = name
+        self.sql = sql
+        self.param_types: tuple[str, ...] | None = None
+        self.columns: tuple[str, ...] | None = None
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def __repr__(self):
+        return f'<Statement {self.name}>'
+
+    def record(self, seconds: float, failed: bool = False):
+        self.calls += 1
+        self.total_time += seconds
+        if seconds > self.max_time:
+            self.max_time = seconds
+        if failed:
+            self.errors += 1
+
+
+class StatementConnection(asyncpg.Connection):
+    ''' соединение пула со своим набором подготовленных запросов '''
+    __slots__ = ('prepared_statements',)
+
+
+class StatementRegistry(object):
+    def __init__(self):
+        self._statements: dict[str, Statement] = {}
+
+    def __iter__(self):
+        return iter(self._statements.values())
+
+    def register(self, name: str, sql: str) -> Statement:
+        if name in self._statements:
+            raise ValueError(f'statement {name!r} is already registered')
+        stmt = self._statements[name] = Statement(name, sql)
+        return stmt
+
+    async def prepare_all(self, con: StatementConnection):
+        '''
+        init-хук пула: готовит все запросы на новом соединении;
+        любая ошибка (нет таблицы/колонки, синтаксис) роняет создание пула
+        '''
+        con.prepared_statements = {}
+        failures = []
+        for stmt in self._statements.values():
+            try:
+                ps = await con.prepare(stmt.sql)
+            except asyncpg.PostgresError as ex:
+                failures.append(f'{stmt.name}: {ex}')
+                continue
+            con.prepared_statements[stmt.name] = ps
+            if stmt.param_types is None:
+                stmt.param_types = tuple(t.name for t in ps.get_parameters())
+                stmt.columns = tuple(a.name for a in ps.get_attributes())
+        if failures:
+            raise StatementError('invalid statements:\n' + '\n'.join(failures))
+
+    async def prepared(self, con, stmt: Statement) -> PreparedStatement:
+        cache = getattr(con, 'prepared_statements', None)
+        if cache is None:
+            # соединение не из нашего пула - готовим без кэша
+            return await con.prepare(stmt.sql)
+        ps = cache.get(stmt.name)
+        if ps is None:
+            ps = cache[stmt.name] = await con.prepare(stmt.sql)
+        return ps
+
+    async def run(self, con, stmt: Statement, args: tuple,
+                  execute: bool = False, fetch: bool = False,
+                  fetchrow: bool = False, fetchval: bool = False):
+        ps = await self.prepared(con, stmt)
+        start = time.perf_counter()
+        failed = True
+        try:
+            if execute:
+                await ps.fetch(*args)
+                result = ps.get_statusmsg()
+            elif fetch:
+                result = await ps.fetch(*args)
+            elif fetchrow:
+                result = await ps.fetchrow(*args)
+            elif fetchval:
+                result = await ps.fetchval(*args)
+            else:
+                result = None
+            failed = False
+            return result
+        finally:
+            stmt.record(time.perf_counter() - start, failed)
+
+    def stats(self) -> dict:
+        return {stmt.name: {'calls': stmt.calls,
+                            'errors': stmt.errors,
+                            'total_time': stmt.total_time,
+                            'max_time': stmt.max_time,
+                            'avg_time': stmt.total_time / stmt.calls if stmt.calls else 0.0}
+                for stmt in self._statements.values()}
+
+
+statements = StatementRegistry()
@@ -0,0 +1,257 @@
+import asyncio
+import hashlib
+import os
+import re
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterable
+
+from quart import url_for
+
+from app import app
+
+# Pillow необязателен: без него варианты не создаются и отдаётся оригинал
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+
+class MediaRejected(Exception):
+    ''' загрузка не принята: reason - 'too_large' или 'unsupported' '''
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class MediaBusy(Exception):
+    ''' очередь обработки изображений переполнена '''
+    pass
+
+
+# сигнатура первых байт -> расширение
+_SIGNATURES = ((b'\xff\xd8\xff', 'jpg'),
+               (b'\x89PNG\r\n\x1a\n', 'png'),
+               (b'GIF87a', 'gif'),
+               (b'GIF89a', 'gif'))
+
+CONTENT_TYPES = {'jpg': 'image/jpeg', 'png': 'image/png', 'gif': 'image/gif', 'webp': 'image/webp'}
+
+# варианты сохраняются в формате оригинала, анимация gif - первым кадром в png
+_VARIANT_FORMATS = {'jpg': ('jpg', 'JPEG'), 'png': ('png', 'PNG'), 'gif': ('png', 'PNG'),
+                    'webp': ('webp', 'WEBP')}
+
+# значение Profile.profile_img / Chat.image / Post.image: '<sha256>.<ext>'
+_KEY_RE = re.compile(r'^([0-9a-f]{64})\.(jpg|png|gif|webp)$')
+
+
+def sniff(head: bytes) -> str | None:
+    for signature, ext in _SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def parse_key(key: str | None) -> tuple[str, str] | None:
+    ''' (digest, ext) для ключа медиа, None для старых значений (url или путь) '''
+    match = _KEY_RE.match(key or '')
+    return None if match is None else match.groups()
+
+
+def _make_variants(src: str, directory: str, ext: str, variants: dict[str, int], max_pixels: int):
+    ''' в потоке пула: уменьшенные копии, вписанные в квадрат size x size (без увеличения) '''
+    out_ext, fmt = _VARIANT_FORMATS[ext]
+    with Image.open(src) as original:
+        # размеры известны из заголовка, до декодирования
+        if original.width * original.height > max_pixels:
+            raise ValueError(f'{original.width}x{original.height} exceeds {max_pixels} pixels')
+        image = ImageOps.exif_transpose(original)
+        if fmt == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        elif fmt == 'PNG' and image.mode == 'P':
+            image = image.convert('RGBA')
+        for name, size in variants.items():
+            variant = image.copy()
+            variant.thumbnail((size, size), Image.LANCZOS)
+            path = os.path.join(directory, f'{name}.{out_ext}')
+            tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+            variant.save(tmp, fmt, quality=85, optimize=True)
+            os.replace(tmp, path)
+
+
+class MediaStore(object):
+    '''
+    content-addressed хранилище: файл лежит в root/<aa>/<sha256>/orig.<ext>,
+    одинаковые загрузки - один файл. запись атомарная (tmp + os.replace),
+    так что каталог можно делить между воркерами
+
+    варианты (thumb, small ...) делает Pillow в ограниченном пуле потоков
+    (декодирование и resize отпускают GIL) с admission control, как в app.hashing
+    '''
+
+    def __init__(self, root: str, variants: dict[str, int],
+                 max_size: int = 10 * 1024 * 1024, max_pixels: int = 40_000_000,
+                 workers: int = 2, max_pending: int = 32):
+        self.root = root
+        self.variants = variants
+        self.max_size = max_size
+        self.max_pixels = max_pixels
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: ThreadPoolExecutor | None = None
+        self._pending = 0
+        # одновременные запросы одного отсутствующего варианта делают его один раз
+        self._in_progress: dict[str, asyncio.Future] = {}
+        self.rejected = 0
+        self.deduplicated = 0
+        if Image is None:
+            app.logger.warning('Pillow is not installed: media variants are disabled, originals are served')
+
+    def _directory(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def original_path(self, digest: str, ext: str) -> str:
+        return os.path.join(self._directory(digest), f'orig.{ext}')
+
+    def variant_path(self, digest: str, ext: str, variant: str) -> str:
+        return os.path.join(self._directory(digest), f'{variant}.{_VARIANT_FORMATS[ext][0]}')
+
+    async def save(self, chunks: AsyncIterable[bytes]) -> str:
+        '''
+        поток байтов -> ключ '<sha256>.<ext>'; хэш считается по ходу записи,
+        файл целиком в памяти не держится
+        '''
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp = os.path.join(tmp_dir, uuid.uuid4().hex)
+        sha = hashlib.sha256()
+        head = b''
+        size = 0
+        created = False
+        try:
+            with open(tmp, 'wb') as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_size:
+                        raise MediaRejected('too_large')
+                    if len(head) < 16:
+                        head += chunk[:16]
+                    sha.update(chunk)
+                    # небольшие куски в page cache - запись без пула потоков
+                    f.write(chunk)
+            ext = sniff(head)
+            if ext is None:
+                raise MediaRejected('unsupported')
+            digest = sha.hexdigest()
+            path = self.original_path(digest, ext)
+            if os.path.exists(path):
+                self.deduplicated += 1
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp, path)
+                created = True
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        try:
+            await self.ensure_variants(digest, ext)
+        except MediaRejected:
+            if created:
+                shutil.rmtree(self._directory(digest), ignore_errors=True)
+            raise
+        return f'{digest}.{ext}'
+
+    async def ensure_variants(self, digest: str, ext: str):
+        ''' создаёт отсутствующие варианты; без Pillow ничего не делает '''
+        if Image is None:
+            return
+        missing = {name: size for name, size in self.variants.items()
+                   if not os.path.exists(self.variant_path(digest, ext, name))}
+        if not missing:
+            return
+        future = self._in_progress.get(digest)
+        if future is None:
+            future = asyncio.ensure_future(self._make_variants(digest, ext, missing))
+            self._in_progress[digest] = future
+            future.add_done_callback(lambda _: self._in_progress.pop(digest, None))
+        await asyncio.shield(future)
+
+    async def _make_variants(self, digest: str, ext: str, variants: dict[str, int]):
+        try:
+            await self._submit(_make_variants, self.original_path(digest, ext),
+                               self._directory(digest), ext, variants, self.max_pixels)
+        except (OSError, ValueError, Image.DecompressionBombError) as ex:
+            # сигнатура совпала, но картинка не читается или слишком большая
+            app.logger.warning(f'media {digest}: cannot make variants: {ex}')
+            raise MediaRejected('unsupported') from ex
+
+    async def _submit(self, fn, *args):
+        if self._pending >= self.max_pending:
+            self.rejected += 1
+            raise MediaBusy()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='media')
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def resolve(self, key: str, variant: str | None = None) -> tuple[str, str] | None:
+        '''
+        (путь файла, content-type) для отдачи; неизвестный вариант или
+        отсутствие Pillow - оригинал
+        '''
+        parsed = parse_key(key)
+        if parsed is None:
+            return None
+        digest, ext = parsed
+        original = self.original_path(digest, ext)
+        if not os.path.exists(original):
+            return None
+        if variant is None or variant not in self.variants or Image is None:
+            return original, CONTENT_TYPES[ext]
+        path = self.variant_path(digest, ext, variant)
+        if not os.path.exists(path):
+            # набор вариантов поменялся или файл загружен до установки Pillow
+            try:
+                await self.ensure_variants(digest, ext)
+            except (MediaRejected, MediaBusy):
+                return original, CONTENT_TYPES[ext]
+        return path, CONTENT_TYPES[_VARIANT_FORMATS[ext][0]]
+
+    def stats(self) -> dict:
+        return {'pending': self._pending,
+                'rejected': self.rejected,
+                'deduplicated': self.deduplicated}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+def media_url(key: str | None, variant: str | None = None) -> str | None:
+    '''
+    url варианта для значения поля модели; старые значения (готовый url или путь)
+    возвращаются как есть
+    '''
+    if not key:
+        return None
+    if parse_key(key) is None:
+        return key
+    if variant is None:
+        return url_for('media.get', key=key)
+    return url_for('media.get_variant', key=key, variant=variant)
+
+
+media = MediaStore(app.config.get('MEDIA_ROOT', os.path.join(os.path.dirname(app.root_path), 'media')),
+                   app.config.get('MEDIA_VARIANTS', {'thumb': 128, 'small': 320, 'medium': 960}),
+                   app.config.get('MEDIA_MAX_SIZE', 10 * 1024 * 1024),
+                   app.config.get('MEDIA_MAX_PIXELS', 40_000_000),
+                   app.config.get('MEDIA_WORKERS', 2),
+                   app.config.get('MEDIA_MAX_PENDING', 32))
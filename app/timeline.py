@@ -0,0 +1,205 @@
+import bisect
+from collections import OrderedDict
+from datetime import datetime
+
+
+class TimelineStore(object):
+    '''
+    материализованные ленты: user_id -> записи (publication_date, post_id, author_id)
+    get() отдаёт (publication_date, post_id) от новых к старым, before - keyset курсор
+    '''
+
+    async def has(self, user_id: int) -> bool:
+        ''' лента пользователя уже построена '''
+        raise NotImplementedError
+
+    async def push(self, user_ids: list[int], post_id: int, author_id: int, publication_date: datetime):
+        raise NotImplementedError
+
+    async def backfill(self, user_id: int, entries: list[tuple[datetime, int, int]]):
+        raise NotImplementedError
+
+    async def prune(self, user_id: int, author_id: int):
+        raise NotImplementedError
+
+    async def get(self, user_id: int, limit: int,
+                  before: tuple[datetime, int] | None = None) -> list[tuple[datetime, int]]:
+        raise NotImplementedError
+
+
+class PostgresTimelineStore(TimelineStore):
+    '''
+    таблица timeline (migrations/004_timeline.sql), db - models._DataBase;
+    у каждого пользователя хранится не больше capacity последних записей
+    '''
+
+    def __init__(self, db, capacity: int = 800):
+        self._db = db
+        self.capacity = capacity
+
+    async def has(self, user_id: int) -> bool:
+        # отметку ставит backfill, в том числе для пустой ленты
+        query = ''' SELECT EXISTS (SELECT 1 FROM timeline_built WHERE user_id = $1) '''
+        return await self._db.execute_query(query, user_id, fetchval=True, readonly=True)
+
+    async def _trim(self, user_ids: list[int]):
+        ''' удаляет записи старше capacity-й по счёту (по индексу timeline_user_date_idx) '''
+        query = ''' DELETE FROM timeline
+        USING (SELECT u.user_id, edge.publication_date, edge.post_id
+               FROM unnest($1::int[]) AS u(user_id)
+               CROSS JOIN LATERAL (SELECT publication_date, post_id FROM timeline
+                                   WHERE timeline.user_id = u.user_id
+                                   ORDER BY publication_date DESC, post_id DESC
+                                   OFFSET $2 - 1 LIMIT 1) AS edge) AS cut
+        WHERE timeline.user_id = cut.user_id
+        AND (timeline.publication_date, timeline.post_id) < (cut.publication_date, cut.post_id) '''
+        await self._db.execute_query(query, user_ids, self.capacity, execute=True)
+
+    async def push(self, user_ids: list[int], post_id: int, author_id: int, publication_date: datetime):
+        if not user_ids:
+            return
+        query = ''' INSERT INTO timeline (user_id, post_id, author_id, publication_date)
+        SELECT unnest($1::int[]), $2, $3, $4
+        ON CONFLICT DO NOTHING '''
+        await self._db.execute_query(query, user_ids, post_id, author_id, publication_date, execute=True)
+        await self._trim(user_ids)
+
+    async def backfill(self, user_id: int, entries: list[tuple[datetime, int, int]]):
+        if not entries:
+            await self._mark_built(user_id)
+            return
+        query = ''' INSERT INTO timeline (user_id, post_id, author_id, publication_date)
+        SELECT $1, e.post_id, e.author_id, e.publication_date
+        FROM unnest($2::timestamp[], $3::int[], $4::int[]) AS e(publication_date, post_id, author_id)
+        ON CONFLICT DO NOTHING '''
+        dates, post_ids, author_ids = zip(*entries)
+        await self._db.execute_query(query, user_id, list(dates), list(post_ids), list(author_ids),
+                                     execute=True)
+        await self._trim([user_id])
+        await self._mark_built(user_id)
+
+    async def _mark_built(self, user_id: int):
+        query = ''' INSERT INTO timeline_built (user_id) VALUES ($1)
+        ON CONFLICT DO NOTHING '''
+        await self._db.execute_query(query, user_id, execute=True)
+
+    async def prune(self, user_id: int, author_id: int):
+        query = ''' DELETE FROM timeline
+        WHERE user_id = $1 AND author_id = $2 '''
+        await self._db.execute_query(query, user_id, author_id, execute=True)
+
+    async def get(self, user_id: int, limit: int,
+                  before: tuple[datetime, int] | None = None) -> list[tuple[datetime, int]]:
+        if before is None:
+            query = ''' SELECT publication_date, post_id FROM timeline
+            WHERE user_id = $1
+            ORDER BY publication_date DESC, post_id DESC
+            LIMIT $2 '''
+            res = await self._db.execute_query(query, user_id, limit, fetch=True, readonly=True)
+        else:
+            query = ''' SELECT publication_date, post_id FROM timeline
+            WHERE user_id = $1 AND (publication_date, post_id) < ($2, $3)
+            ORDER BY publication_date DESC, post_id DESC
+            LIMIT $4 '''
+            res = await self._db.execute_query(query, user_id, *before, limit, fetch=True, readonly=True)
+        return [tuple(row) for row in res]
+
+
+class InMemoryTimelineStore(TimelineStore):
+    '''
+    ограниченные по размеру ленты в памяти процесса (capacity последних записей)
+    не больше max_users лент: давно не читавшие теряют ленту и при следующем
+    чтении получают её заново через rebuild
+    '''
+
+    def __init__(self, capacity: int = 800, max_users: int = 10000):
+        self.capacity = capacity
+        self.max_users = max_users
+        # отсортировано по возрастанию (publication_date, post_id); порядок ключей - LRU
+        self._timelines: OrderedDict[int, list[tuple[datetime, int, int]]] = OrderedDict()
+        self.evictions = 0
+
+    async def has(self, user_id: int) -> bool:
+        return user_id in self._timelines
+
+    def _insert(self, user_id: int, entry: tuple[datetime, int, int]):
+        timeline = self._timelines.setdefault(user_id, [])
+        i = bisect.bisect_left(timeline, entry)
+        if i < len(timeline) and timeline[i][:2] == entry[:2]:
+            return
+        timeline.insert(i, entry)
+        if len(timeline) > self.capacity:
+            del timeline[:len(timeline) - self.capacity]
+
+    async def push(self, user_ids: list[int], post_id: int, author_id: int, publication_date: datetime):
+        for user_id in user_ids:
+            # лента ещё не построена - её соберёт rebuild при первом чтении
+            if user_id in self._timelines:
+                self._insert(user_id, (publication_date, post_id, author_id))
+
+    async def backfill(self, user_id: int, entries: list[tuple[datetime, int, int]]):
+        self._timelines.setdefault(user_id, [])
+        self._timelines.move_to_end(user_id)
+        for entry in entries:
+            self._insert(user_id, entry)
+        while len(self._timelines) > self.max_users:
+            self._timelines.popitem(last=False)
+            self.evictions += 1
+
+    async def prune(self, user_id: int, author_id: int):
+        timeline = self._timelines.get(user_id)
+        if timeline is not None:
+            timeline[:] = [entry for entry in timeline if entry[2] != author_id]
+
+    async def get(self, user_id: int, limit: int,
+                  before: tuple[datetime, int] | None = None) -> list[tuple[datetime, int]]:
+        if user_id in self._timelines:
+            self._timelines.move_to_end(user_id)
+        timeline = self._timelines.get(user_id, [])
+        end = len(timeline) if before is None else bisect.bisect_left(timeline, before)
+        return [entry[:2] for entry in reversed(timeline[max(0, end - limit):end])]
+
+
+class ReplicatedTimelineStore(TimelineStore):
+    '''
+    InMemoryTimelineStore в каждом воркере: изменения применяются локально
+    и рассылаются остальным через шину событий (app.events)
+    '''
+
+    def __init__(self, store: InMemoryTimelineStore, bus):
+        self.store = store
+        self._bus = bus
+        bus.subscribe('timeline', self._on_remote)
+
+    async def _on_remote(self, payload: dict):
+        op = payload['op']
+        if op == 'push':
+            await self.store.push(payload['user_ids'], payload['post_id'], payload['author_id'],
+                                  datetime.fromisoformat(payload['publication_date']))
+        elif op == 'backfill':
+            await self.store.backfill(payload['user_id'],
+                                      [(datetime.fromisoformat(date), post_id, author_id)
+                                       for date, post_id, author_id in payload['entries']])
+        elif op == 'prune':
+            await self.store.prune(payload['user_id'], payload['author_id'])
+
+    async def has(self, user_id: int) -> bool:
+        return await self.store.has(user_id)
+
+    async def push(self, user_ids: list[int], post_id: int, author_id: int, publication_date: datetime):
+        await self.store.push(user_ids, post_id, author_id, publication_date)
+        self._bus.publish('timeline', {'op': 'push', 'user_ids': user_ids, 'post_id': post_id,
+                                       'author_id': author_id, 'publication_date': publication_date},
+                          local=False)
+
+    async def backfill(self, user_id: int, entries: list[tuple[datetime, int, int]]):
+        await self.store.backfill(user_id, entries)
+        self._bus.publish('timeline', {'op': 'backfill', 'user_id': user_id, 'entries': entries}, local=False)
+
+    async def prune(self, user_id: int, author_id: int):
+        await self.store.prune(user_id, author_id)
+        self._bus.publish('timeline', {'op': 'prune', 'user_id': user_id, 'author_id': author_id}, local=False)
+
+    async def get(self, user_id: int, limit: int,
+                  before: tuple[datetime, int] | None = None) -> list[tuple[datetime, int]]:
+        return await self.store.get(user_id, limit, before)
@@ -0,0 +1,109 @@
+'''
+проверка write-behind стадии (app.batching.BatchWriter) без базы: транзакция и
+flush_fn подменены записью в список
+
+    python benchmarks/batch_writer_check.py
+needs config.py (the app package is imported)
+
+- одновременные submit() уходят одной пачкой, каждый получает свой id
+- плохая строка откатывает пачку: остальные переписываются по одной,
+  ошибку получает только её отправитель
+- отменённый вызывающий не ломает разбор пачки
+- drain() при остановке сбрасывает накопленное, не дожидаясь max_delay
+'''
+import asyncio
+import os
+import sys
+from contextlib import asynccontextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.batching import BatchWriter  # noqa: E402
+
+
+class BadRow(Exception):
+    pass
+
+
+class FakeTable(object):
+    ''' транзакция + flush_fn: пачка либо записана целиком, либо не записана вовсе '''
+
+    def __init__(self):
+        self.rows: list = []
+        self.transactions = 0
+        self.batches: list[list] = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        self.transactions += 1
+        yield self
+
+    async def insert_rows(self, con, rows: list) -> list[int]:
+        self.batches.append(list(rows))
+        # как COPY: отказ любой строки откатывает всю пачку
+        if any(row == 'bad' for row in rows):
+            raise BadRow(rows)
+        ids = list(range(len(self.rows) + 1, len(self.rows) + len(rows) + 1))
+        self.rows.extend(rows)
+        return ids
+
+
+async def check_coalescing():
+    table = FakeTable()
+    writer = BatchWriter(table.transaction, table.insert_rows, max_size=100, max_delay=0.01)
+    ids = await asyncio.gather(*(writer.submit(f'row-{i}') for i in range(10)))
+    assert ids == list(range(1, 11)), ids
+    assert table.transactions == 1, table.transactions
+    print('coalescing: 10 submits -> 1 transaction')
+
+
+async def check_error_isolation():
+    table = FakeTable()
+    writer = BatchWriter(table.transaction, table.insert_rows, max_size=100, max_delay=0.01)
+    results = await asyncio.gather(writer.submit('a'), writer.submit('bad'), writer.submit('c'),
+                                   return_exceptions=True)
+    assert isinstance(results[1], BadRow), results
+    assert results[0] == 1 and results[2] == 2, results
+    assert table.rows == ['a', 'c'], table.rows
+    # пачка целиком, затем по одной строке
+    assert table.batches == [['a', 'bad', 'c'], ['a'], ['bad'], ['c']], table.batches
+    print('error isolation: only the bad row failed, others were retried one by one')
+
+
+async def check_cancelled_caller():
+    table = FakeTable()
+    writer = BatchWriter(table.transaction, table.insert_rows, max_size=100, max_delay=0.01)
+    cancelled = asyncio.ensure_future(writer.submit('gone'))
+    kept = asyncio.ensure_future(writer.submit('kept'))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    assert await kept == 2, 'the surviving caller must get its own id'
+    assert table.rows == ['gone', 'kept'], table.rows
+    print('cancelled caller: the batch still resolves the others')
+
+
+async def check_drain():
+    table = FakeTable()
+    # max_delay больше времени проверки: записать может только drain()
+    writer = BatchWriter(table.transaction, table.insert_rows, max_size=100, max_delay=60.0)
+    pending = [asyncio.ensure_future(writer.submit(row)) for row in ('x', 'bad', 'y')]
+    await asyncio.sleep(0)
+    assert table.transactions == 0
+    await asyncio.wait_for(writer.drain(), 1.0)
+    assert all(task.done() for task in pending)
+    assert [task.result() for task in (pending[0], pending[2])] == [1, 2]
+    assert isinstance(pending[1].exception(), BadRow)
+    assert table.rows == ['x', 'y'], table.rows
+    print('drain: pending rows flushed on shutdown, errors delivered per row')
+
+
+async def main():
+    await check_coalescing()
+    await check_error_isolation()
+    await check_cancelled_caller()
+    await check_drain()
+    print('ok')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+'''
+event-loop latency under a burst of logins: bcrypt inline vs bounded thread pool
+(the approach used by app.hashing.PasswordHasher)
+
+    python benchmarks/bcrypt_loop_latency.py --logins 50 --rounds 12 --workers 2
+'''
+import argparse
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+
+async def probe(stop: asyncio.Event, interval: float, lags: list[float]):
+    ''' как сильно опаздывает таймер - столько же ждёт любой websocket/страница '''
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - start - interval) * 1000)
+
+
+async def login_inline(password: bytes, hashed: bytes):
+    bcrypt.checkpw(password, hashed)
+
+
+async def login_offloaded(executor: ThreadPoolExecutor, password: bytes, hashed: bytes):
+    await asyncio.get_running_loop().run_in_executor(executor, bcrypt.checkpw, password, hashed)
+
+
+async def run(mode: str, logins: int, hashed: bytes, workers: int, interval: float) -> dict:
+    lags: list[float] = []
+    stop = asyncio.Event()
+    prober = asyncio.ensure_future(probe(stop, interval, lags))
+    await asyncio.sleep(interval * 5)
+    start = time.perf_counter()
+    if mode == 'inline':
+        await asyncio.gather(*[login_inline(b'password', hashed) for _ in range(logins)])
+    else:
+        with ThreadPoolExecutor(workers) as executor:
+            await asyncio.gather(*[login_offloaded(executor, b'password', hashed) for _ in range(logins)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await prober
+    lags.sort()
+    return {'mode': mode,
+            'elapsed_s': elapsed,
+            'lag_p50_ms': statistics.median(lags),
+            'lag_p99_ms': lags[int(len(lags) * 0.99) - 1] if len(lags) > 1 else lags[-1],
+            'lag_max_ms': lags[-1]}
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logins', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--interval', type=float, default=0.005, help='probe period, seconds')
+    args = parser.parse_args()
+
+    hashed = bcrypt.hashpw(b'password', bcrypt.gensalt(args.rounds))
+    print(f'{args.logins} concurrent logins, cost {args.rounds}, {args.workers} workers')
+    print(f'{"mode":<10} {"elapsed s":>10} {"lag p50 ms":>11} {"lag p99 ms":>11} {"lag max ms":>11}')
+    for mode in ('inline', 'offloaded'):
+        r = await run(mode, args.logins, hashed, args.workers, args.interval)
+        print(f'{r["mode"]:<10} {r["elapsed_s"]:>10.2f} {r["lag_p50_ms"]:>11.2f} '
+              f'{r["lag_p99_ms"]:>11.2f} {r["lag_max_ms"]:>11.2f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
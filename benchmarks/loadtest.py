@@ -0,0 +1,195 @@
+'''
+in-process load test: concurrent virtual users against the Quart app
+
+needs config.py and a database seeded by benchmarks/seed.py
+    python benchmarks/loadtest.py --users 50 --duration 30 --out results.json
+    python benchmarks/loadtest.py --users 50 --duration 30 --compare results.json
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quart import url_for  # noqa: E402
+from quart_auth import authenticated_client  # noqa: E402
+
+from app import app, metrics  # noqa: E402
+from app.models import UserInChat  # noqa: E402
+from app.ratelimit import limiter  # noqa: E402
+
+WORDS = ('quart async message chat post follow user profile comment image '
+         'python postgres index search vector rank pool worker stream cache').split()
+
+# scenario -> (weight, endpoint used for queries-per-request)
+SCENARIOS = {'feed': (40, 'blog.index'),
+             'chat_history': (25, 'chat.history'),
+             'send_message': (15, None),
+             'search': (10, 'blog.search'),
+             'login': (10, 'auth.login')}
+
+
+class VirtualUser(object):
+    def __init__(self, test_app, user_id: int, chat_ids: list[int], index_path: str):
+        self.test_app = test_app
+        self.user_id = user_id
+        self.chat_ids = chat_ids
+        self.index_path = index_path
+
+    async def feed(self, client):
+        response = await client.get('/index')
+        assert response.status_code == 200, response.status_code
+
+    async def chat_history(self, client):
+        if not self.chat_ids:
+            return await self.feed(client)
+        response = await client.get(f'/chat/{random.choice(self.chat_ids)}/messages')
+        assert response.status_code == 200, response.status_code
+
+    async def send_message(self, client):
+        if not self.chat_ids:
+            return await self.feed(client)
+        async with client.websocket(f'/chat/{random.choice(self.chat_ids)}/ws') as ws:
+            await ws.send(json.dumps({'text': ' '.join(random.sample(WORDS, 6))}))
+            # собственное сообщение возвращается через hub после коммита
+            while True:
+                event = json.loads(await ws.receive())
+                if event.get('type') == 'message':
+                    break
+                if event.get('type') == 'error':
+                    # сообщение отброшено (rate_limited) - ждать его бесполезно
+                    raise RuntimeError(f'send rejected: {event.get("error")}')
+
+    async def search(self, client):
+        response = await client.get('/search', query_string={'q': random.choice(WORDS)})
+        assert response.status_code == 200, response.status_code
+
+    async def login(self, client):
+        # отдельный неаутентифицированный клиент
+        anonymous = self.test_app.test_client()
+        response = await anonymous.post('/auth/login', form={'login': f'user{self.user_id}',
+                                                             'password': 'password'})
+        assert response.status_code == 302, response.status_code
+        # неудачный вход тоже 302, но обратно на форму входа
+        location = urlsplit(response.headers['Location']).path
+        assert location == self.index_path, f'login redirected to {location}'
+
+    async def run(self, deadline: float, timings: dict, errors: dict):
+        names = list(SCENARIOS)
+        weights = [SCENARIOS[name][0] for name in names]
+        client = self.test_app.test_client()
+        async with authenticated_client(client, str(self.user_id)):
+            while time.perf_counter() < deadline:
+                name = random.choices(names, weights)[0]
+                start = time.perf_counter()
+                try:
+                    await getattr(self, name)(client)
+                except Exception as ex:
+                    errors[name] = errors.get(name, 0) + 1
+                    errors.setdefault('samples', {})[name] = repr(ex)
+                    continue
+                timings[name].append(time.perf_counter() - start)
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def queries_per_request(endpoint: str | None) -> float | None:
+    if endpoint is None:
+        return None
+    series = metrics.request_queries._series.get((endpoint,))
+    if not series or not series[-1]:
+        return None
+    return series[-2] / series[-1]
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds')
+    parser.add_argument('--user-pool', type=int, default=10_000, help='seeded users to pick from')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='write machine-readable results to this JSON file')
+    parser.add_argument('--compare', help='previous results JSON to diff against')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    app.config['WTF_CSRF_ENABLED'] = False
+    # все виртуальные пользователи приходят с адреса тестового клиента -
+    # лимиты по ip отклоняли бы вход уже после ~20 попыток
+    limiter.enabled = False
+    metrics.enabled = True
+    metrics.init_app(app)
+
+    timings: dict[str, list[float]] = {name: [] for name in SCENARIOS}
+    errors: dict = {}
+    async with app.test_request_context('/'):
+        index_path = url_for('blog.index')
+    async with app.test_app() as test_app:
+        user_ids = random.sample(range(1, args.user_pool + 1), args.users)
+        vus = []
+        for user_id in user_ids:
+            chats = await UserInChat.get_users_chats(user_id) or []
+            vus.append(VirtualUser(test_app, user_id, [chat.id for chat in chats], index_path))
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*[vu.run(deadline, timings, errors) for vu in vus])
+        elapsed = time.perf_counter() - start
+
+    results = {'commit': git_commit(),
+               'timestamp': datetime.now().isoformat(),
+               'params': vars(args),
+               'elapsed_s': elapsed,
+               'errors': errors,
+               'scenarios': {}}
+    print(f'{"scenario":<14} {"count":>7} {"rps":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"q/req":>6}')
+    for name, (_, endpoint) in SCENARIOS.items():
+        values = timings[name]
+        qpr = queries_per_request(endpoint)
+        row = {'count': len(values),
+               'rps': len(values) / elapsed,
+               'p50_ms': percentile(values, 0.50) * 1000,
+               'p95_ms': percentile(values, 0.95) * 1000,
+               'p99_ms': percentile(values, 0.99) * 1000,
+               'queries_per_request': qpr}
+        results['scenarios'][name] = row
+        print(f'{name:<14} {row["count"]:>7} {row["rps"]:>8.1f} {row["p50_ms"]:>8.1f} '
+              f'{row["p95_ms"]:>8.1f} {row["p99_ms"]:>8.1f} {"-" if qpr is None else f"{qpr:.1f}":>6}')
+    if errors:
+        print('errors:', json.dumps(errors, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print(f'\nvs {previous.get("commit") or args.compare}')
+        for name, row in results['scenarios'].items():
+            old = previous['scenarios'].get(name)
+            if not old or not old['p95_ms'] or not old['rps']:
+                continue
+            print(f'{name:<14} p95 {100 * (row["p95_ms"] / old["p95_ms"] - 1):+6.1f}%  '
+                  f'rps {100 * (row["rps"] / old["rps"] - 1):+6.1f}%')
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+'''
+memory/time of mapping 1M message rows: legacy __dict__ objects vs slotted models vs raw records
+
+    python benchmarks/row_mapping_bench.py --rows 1000000
+    python benchmarks/row_mapping_bench.py --rows 1000000 --chat-id 42   # + real fetch from the database
+needs config.py (app.models is imported)
+'''
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app  # noqa: E402
+from app.models import Message  # noqa: E402
+
+
+class LegacyMessage(object):
+    ''' Message до перехода на __slots__ (для сравнения) '''
+
+    def __init__(self, id=0, chat_id=0, user_id=0, parent_id=None, mes_text='',
+                 sends_time=None, seq=None):
+        self.id = id
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.parent_id = parent_id
+        self.mes_text = mes_text
+        self.sends_time = sends_time
+        self.seq = seq
+        self.child_list = []
+        self.depth = 0
+        self.has_more = False
+        self.author = None
+
+
+def make_rows(count: int) -> list[tuple]:
+    start = datetime(2024, 1, 1)
+    return [(i, 1, i % 100, None, 'hello there', start + timedelta(seconds=i), i) for i in range(count)]
+
+
+def measure(label: str, fn):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{label:<28} {elapsed:>8.2f} s {peak / 2 ** 20:>10.1f} MiB')
+    return result
+
+
+async def measure_async(label: str, fn):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = await fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{label:<28} {elapsed:>8.2f} s {peak / 2 ** 20:>10.1f} MiB')
+    return result
+
+
+async def database(chat_id: int, rows: int):
+    async def fetch(raw: bool):
+        return await Message.get_all_by_chat_id(chat_id, rows, raw=raw)
+
+    async def stream():
+        count = 0
+        async for _ in Message.iter_by_chat_id(chat_id, raw=True):
+            count += 1
+        return count
+
+    async with app.test_app():
+        await measure_async('db fetch -> Message', lambda: fetch(False))
+        await measure_async('db fetch raw records', lambda: fetch(True))
+        await measure_async('db stream raw (cursor)', stream)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--chat-id', type=int, help='also fetch this chat from the database')
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    print(f'{args.rows} rows')
+    print(f'{"mode":<28} {"time":>10} {"peak mem":>14}')
+    measure('legacy __dict__ objects', lambda: [LegacyMessage(*row) for row in rows])
+    measure('slotted Message', lambda: [Message(*row) for row in rows])
+    measure('raw rows (no objects)', lambda: list(rows))
+    if args.chat_id is not None:
+        asyncio.run(database(args.chat_id, args.rows))
+
+
+if __name__ == '__main__':
+    main()
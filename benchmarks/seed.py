@@ -0,0 +1,140 @@
+'''
+synthetic dataset for load tests: users, follows graph, chats, messages, posts, comments
+
+expects a migrated schema (migrations/*.sql); --reset truncates the tables first
+    python benchmarks/seed.py --scale 1 --reset
+every user has the password "password"
+'''
+import argparse
+import asyncio
+import time
+
+import asyncpg
+import bcrypt
+
+WORDS = ('quart async message chat post follow user profile comment image '
+         'python postgres index search vector rank pool worker stream cache '
+         'socket thread reply feed timeline night morning city river music '
+         'book travel coffee code release bug review deploy test summer winter').split()
+
+# rows per unit of --scale
+BASE = {'users': 10_000,
+        'follows_per_user': 50,
+        'chats': 5_000,
+        'members_per_chat': 4,
+        'messages_per_chat': 100,
+        'posts_per_user': 10,
+        'comments_per_post': 3}
+
+TABLES = ('timeline', 'timeline_pull_author', 'comment', 'post', 'message',
+          'user_in_chat', 'chat', 'follow_stats', 'follows', 'profile_info', 'users')
+
+
+def dsn_from_config() -> str:
+    from config import Config
+    return (f'postgres://{Config.DB_USER}:{Config.USER_PASSWORD}@'
+            f'{Config.DB_HOST}:{Config.DB_PORT}/{Config.DB_NAME}')
+
+
+def sentence(length: int) -> str:
+    ''' SQL-выражение случайной фразы, пересчитывается для каждой строки внешнего запроса '''
+    words = 'ARRAY[' + ', '.join(f"'{w}'" for w in WORDS) + ']'
+    return (f"(SELECT string_agg(({words})[1 + (random() * {len(WORDS) - 1})::int], ' ') "
+            f"FROM generate_series(1, {length}) WHERE g.n > 0)")
+
+
+async def seed(con, scale: float, rounds: int):
+    n = {key: max(1, int(value * scale)) if key in ('users', 'chats') else value
+         for key, value in BASE.items()}
+    users = n['users']
+    password_hash = bcrypt.hashpw(b'password', bcrypt.gensalt(rounds)).decode('utf-8')
+
+    steps = [
+        ('users', '''
+         INSERT INTO users (login, password_hash, name)
+         SELECT 'user' || g.n, $1, 'User ' || g.n FROM generate_series(1, $2) AS g(n)''',
+         (password_hash, users)),
+        ('follows', '''
+         INSERT INTO follows (follower_id, followed_id)
+         SELECT DISTINCT f.follower_id, f.followed_id FROM (
+             SELECT u.id AS follower_id,
+                    -- power-law-ish popularity: low ids are followed far more often
+                    1 + floor(power(random(), 2.5) * $1)::int AS followed_id
+             FROM users u, generate_series(1, $2)) f
+         WHERE f.follower_id <> f.followed_id''',
+         (users, n['follows_per_user'])),
+        ('follow stats', '''
+         INSERT INTO follow_stats (user_id, followers, followings)
+         SELECT users.id,
+                (SELECT count(*) FROM follows WHERE follows.followed_id = users.id),
+                (SELECT count(*) FROM follows WHERE follows.follower_id = users.id)
+         FROM users''', ()),
+        ('chats', '''
+         INSERT INTO chat (name, counter, image)
+         SELECT 'chat ' || g.n, 0, NULL FROM generate_series(1, $1) AS g(n)''',
+         (n['chats'],)),
+        ('members', '''
+         INSERT INTO user_in_chat (user_id, chat_id)
+         SELECT DISTINCT 1 + floor(random() * $1)::int, c.id
+         FROM chat c, generate_series(1, $2)''',
+         (users, n['members_per_chat'])),
+        ('messages', f'''
+         INSERT INTO message (chat_id, user_id, parent_id, mes_text, sends_time, seq)
+         SELECT m.chat_id, m.user_id, NULL, {sentence(12)},
+                now() - (g.n * interval '1 minute'),
+                $1 - g.n + 1
+         FROM (SELECT DISTINCT ON (chat_id) chat_id, user_id FROM user_in_chat) m,
+              generate_series(1, $1) AS g(n)''',
+         (n['messages_per_chat'],)),
+        ('chat counters', '''
+         UPDATE chat SET counter = last.seq, last_message_at = last.sends_time
+         FROM (SELECT chat_id, max(seq) AS seq, max(sends_time) AS sends_time
+               FROM message GROUP BY chat_id) last
+         WHERE chat.id = last.chat_id''', ()),
+        ('posts', f'''
+         INSERT INTO post (user_id, title, publication_date, last_edit_date, post_text, image)
+         SELECT u.id, {sentence(4)}, now() - random() * interval '365 days', NULL, {sentence(40)}, ''
+         FROM users u, generate_series(1, $1) AS g(n)''',
+         (n['posts_per_user'],)),
+        ('comments', f'''
+         INSERT INTO comment (post_id, commentator_id, comment_text, sends_time)
+         SELECT p.id, 1 + floor(random() * $1)::int, {sentence(8)}, p.publication_date + interval '1 hour'
+         FROM post p, generate_series(1, $2) AS g(n)''',
+         (users, n['comments_per_post'])),
+        ('comment counts', '''
+         UPDATE post SET comment_count = counted.n
+         FROM (SELECT post_id, count(*) AS n FROM comment GROUP BY post_id) counted
+         WHERE post.id = counted.post_id''', ()),
+        ('timelines', '''
+         INSERT INTO timeline (user_id, post_id, author_id, publication_date)
+         SELECT follows.follower_id, post.id, post.user_id, post.publication_date
+         FROM follows JOIN post ON post.user_id = follows.followed_id
+         ON CONFLICT DO NOTHING''', ()),
+    ]
+    for name, query, args in steps:
+        start = time.perf_counter()
+        status = await con.execute(query, *args)
+        print(f'{name:<14} {status:<20} {time.perf_counter() - start:.1f}s')
+    for table in ('users', 'follows', 'chat', 'user_in_chat', 'message', 'post', 'comment', 'timeline'):
+        await con.execute(f'ANALYZE {table}')
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', help='defaults to the DB_* settings in config.py')
+    parser.add_argument('--scale', type=float, default=1.0, help=f'1.0 = {BASE["users"]} users')
+    parser.add_argument('--rounds', type=int, default=12, help='bcrypt cost of the seeded password')
+    parser.add_argument('--reset', action='store_true', help='truncate the tables first')
+    args = parser.parse_args()
+
+    con = await asyncpg.connect(args.dsn or dsn_from_config())
+    try:
+        if args.reset:
+            await con.execute(f'TRUNCATE {", ".join(TABLES)} RESTART IDENTITY CASCADE')
+        await seed(con, args.scale, args.rounds)
+    finally:
+        await con.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,13 @@
+-- keyset pagination: every page is an index range scan on (key, sort_key, id)
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS message_chat_time_idx
+    ON message (chat_id, sends_time DESC, id DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS post_user_date_idx
+    ON post (user_id, publication_date DESC, id DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS post_date_idx
+    ON post (publication_date DESC, id DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS follows_follower_idx
+    ON follows (follower_id, followed_id);
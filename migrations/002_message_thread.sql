@@ -0,0 +1,5 @@
+-- message tree: the recursive step of Message.get_thread walks parent_id
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS message_parent_idx
+    ON message (parent_id, sends_time, id)
+    WHERE parent_id IS NOT NULL;
@@ -0,0 +1,19 @@
+-- full-text search for posts, trigram search for user login/name
+-- CREATE INDEX CONCURRENTLY must run outside a transaction block
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE post ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(post_text, '')), 'B')
+    ) STORED;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS post_search_idx
+    ON post USING gin (search_vector);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_login_trgm_idx
+    ON users USING gin (login gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_name_trgm_idx
+    ON users USING gin (name gin_trgm_ops);
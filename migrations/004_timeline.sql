@@ -0,0 +1,44 @@
+-- fan-out-on-write home timelines (TIMELINE_STORE = 'postgres')
+
+CREATE TABLE IF NOT EXISTS timeline (
+    user_id integer NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    post_id integer NOT NULL REFERENCES post (id) ON DELETE CASCADE,
+    author_id integer NOT NULL,
+    publication_date timestamp NOT NULL,
+    PRIMARY KEY (user_id, post_id)
+);
+
+CREATE INDEX IF NOT EXISTS timeline_user_date_idx
+    ON timeline (user_id, publication_date DESC, post_id DESC);
+
+CREATE INDEX IF NOT EXISTS timeline_user_author_idx
+    ON timeline (user_id, author_id);
+
+-- users whose feed is materialized (possibly empty); the others are rebuilt on first read
+CREATE TABLE IF NOT EXISTS timeline_built (
+    user_id integer PRIMARY KEY REFERENCES users (id) ON DELETE CASCADE
+);
+
+-- authors with too many followers: their posts are merged in at read time
+CREATE TABLE IF NOT EXISTS timeline_pull_author (
+    user_id integer PRIMARY KEY REFERENCES users (id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS follows_followed_idx
+    ON follows (followed_id, follower_id);
+
+-- materialize existing feeds, newest 800 entries per user (TIMELINE_CAPACITY default)
+INSERT INTO timeline (user_id, post_id, author_id, publication_date)
+SELECT follower_id, post_id, author_id, publication_date
+FROM (
+    SELECT follows.follower_id, post.id AS post_id, post.user_id AS author_id, post.publication_date,
+           row_number() OVER (PARTITION BY follows.follower_id
+                              ORDER BY post.publication_date DESC, post.id DESC) AS rn
+    FROM follows JOIN post ON post.user_id = follows.followed_id
+) AS feed
+WHERE rn <= 800
+ON CONFLICT DO NOTHING;
+
+INSERT INTO timeline_built (user_id)
+SELECT id FROM users
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,22 @@
+-- per-chat message sequence (chat.counter = seq of the last message)
+-- and per-member read cursors: unread = chat.counter - user_in_chat.last_read_seq
+
+ALTER TABLE chat ADD COLUMN IF NOT EXISTS last_message_at timestamp;
+ALTER TABLE message ADD COLUMN IF NOT EXISTS seq bigint;
+ALTER TABLE user_in_chat ADD COLUMN IF NOT EXISTS last_read_message_id integer;
+ALTER TABLE user_in_chat ADD COLUMN IF NOT EXISTS last_read_seq bigint NOT NULL DEFAULT 0;
+
+UPDATE message SET seq = numbered.seq
+FROM (SELECT id, row_number() OVER (PARTITION BY chat_id ORDER BY sends_time, id) AS seq
+      FROM message) AS numbered
+WHERE message.id = numbered.id;
+
+UPDATE chat SET counter = coalesce(last.seq, 0), last_message_at = last.sends_time
+FROM (SELECT DISTINCT ON (chat_id) chat_id, seq, sends_time
+      FROM message ORDER BY chat_id, seq DESC) AS last
+WHERE chat.id = last.chat_id;
+
+UPDATE chat SET counter = 0 WHERE id NOT IN (SELECT DISTINCT chat_id FROM message);
+
+CREATE UNIQUE INDEX IF NOT EXISTS message_chat_seq_idx ON message (chat_id, seq);
+CREATE INDEX IF NOT EXISTS user_in_chat_user_idx ON user_in_chat (user_id, chat_id);
@@ -0,0 +1,27 @@
+-- follower/following counters maintained on write (Follows._insert_rows / Follows.delete)
+-- and a unique (follower_id, followed_id) pair, so a repeated follow is neither stored nor counted
+
+DELETE FROM follows a USING follows b
+WHERE a.ctid < b.ctid
+AND a.follower_id = b.follower_id
+AND a.followed_id = b.followed_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS follows_pair_uidx
+    ON follows (follower_id, followed_id);
+
+-- same columns as follows_pair_uidx
+DROP INDEX IF EXISTS follows_follower_idx;
+
+CREATE TABLE IF NOT EXISTS follow_stats (
+    user_id integer PRIMARY KEY REFERENCES users (id) ON DELETE CASCADE,
+    followers integer NOT NULL DEFAULT 0,
+    followings integer NOT NULL DEFAULT 0
+);
+
+INSERT INTO follow_stats (user_id, followers, followings)
+SELECT users.id,
+       (SELECT count(*) FROM follows WHERE follows.followed_id = users.id),
+       (SELECT count(*) FROM follows WHERE follows.follower_id = users.id)
+FROM users
+ON CONFLICT (user_id) DO UPDATE
+SET followers = excluded.followers, followings = excluded.followings;
@@ -0,0 +1,21 @@
+-- canonical 1:1 chats: one row per ordered user pair (user_low <= user_high)
+-- chat_id is deferred so Chat.get_or_create_direct can claim the pair before the chat row exists
+
+CREATE TABLE IF NOT EXISTS direct_chat (
+    user_low integer NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    user_high integer NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    chat_id integer NOT NULL UNIQUE
+        REFERENCES chat (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+    PRIMARY KEY (user_low, user_high),
+    CHECK (user_low <= user_high)
+);
+
+-- existing chats with exactly two members become their pair's direct chat (oldest wins)
+INSERT INTO direct_chat (user_low, user_high, chat_id)
+SELECT DISTINCT ON (pair.user_low, pair.user_high) pair.user_low, pair.user_high, pair.chat_id
+FROM (SELECT chat_id, min(user_id) AS user_low, max(user_id) AS user_high
+      FROM user_in_chat
+      GROUP BY chat_id
+      HAVING count(DISTINCT user_id) = 2) AS pair
+ORDER BY pair.user_low, pair.user_high, pair.chat_id
+ON CONFLICT DO NOTHING;
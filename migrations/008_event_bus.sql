@@ -0,0 +1,12 @@
+-- payloads of event bus messages larger than the NOTIFY limit (app.events.PostgresEventBus):
+-- the notification carries only the id, listeners read the row, old rows are deleted by the bus
+-- unlogged: lost on crash, which only drops in-flight events
+
+CREATE UNLOGGED TABLE IF NOT EXISTS event_payload (
+    id bigserial PRIMARY KEY,
+    payload text NOT NULL,
+    created_at timestamp NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS event_payload_created_idx
+    ON event_payload (created_at);
@@ -0,0 +1,11 @@
+-- post.comment_count maintained on insert (Comment._insert_rows), so the feed never counts comments,
+-- and an index for the latest-K window per post and keyset "load more" pages
+
+ALTER TABLE post ADD COLUMN IF NOT EXISTS comment_count integer NOT NULL DEFAULT 0;
+
+UPDATE post SET comment_count = counted.n
+FROM (SELECT post_id, count(*) AS n FROM comment GROUP BY post_id) AS counted
+WHERE post.id = counted.post_id;
+
+CREATE INDEX IF NOT EXISTS comment_post_time_idx
+    ON comment (post_id, sends_time DESC, id DESC);
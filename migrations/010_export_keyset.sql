@@ -0,0 +1,4 @@
+-- keyset batches for the comment export (Comment.iter_chunks_by_commentator_id)
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS comment_commentator_time_idx
+    ON comment (commentator_id, sends_time, id);
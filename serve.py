@@ -0,0 +1,50 @@
+'''
+production entry point: N ASGI workers (hypercorn) на одном сокете
+
+каждый воркер - отдельный процесс со своим пулом соединений (before_serving /
+after_serving в app/__init__.py), так что к postgres открывается до
+workers * DB_POOL_MAX_SIZE соединений. события чата, инвалидации кэшей и ленты
+доходят до остальных воркеров только при EVENT_BUS = 'postgres'
+
+python serve.py --workers 4 --bind 0.0.0.0:8000
+'''
+
+import argparse
+import logging
+import os
+
+from hypercorn.config import Config as HypercornConfig
+from hypercorn.run import run
+
+from config import Config
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='run the messenger with several worker processes')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='worker processes (default: number of cores); DB pool size applies per worker')
+    parser.add_argument('--bind', action='append',
+                        help='host:port or unix:path, may be repeated (default: 127.0.0.1:8000)')
+    parser.add_argument('--graceful-timeout', type=float, default=10.0,
+                        help='seconds a worker waits for open requests on shutdown')
+    parser.add_argument('--worker-class', default='asyncio', choices=('asyncio', 'uvloop'))
+    parser.add_argument('--access-log', default=None, help="file or '-' for stdout")
+    args = parser.parse_args()
+
+    if args.workers > 1 and getattr(Config, 'EVENT_BUS', 'memory') != 'postgres':
+        logging.warning("%d workers with EVENT_BUS != 'postgres': chat events and cache "
+                        "invalidations stay inside the worker that produced them", args.workers)
+
+    config = HypercornConfig()
+    # воркеры запускаются через spawn и сами импортируют приложение
+    config.application_path = 'app:app'
+    config.workers = args.workers
+    config.worker_class = args.worker_class
+    config.bind = args.bind or ['127.0.0.1:8000']
+    config.graceful_timeout = args.graceful_timeout
+    config.accesslog = args.access_log
+    return run(config)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())